@@ -6,7 +6,8 @@ import argparse
 from .gtfs import GTFS, CachedGTFS
 from .logger import log_to_stderr
 from .web_routes import register_routes
-from .web_server import build_flask_app, serve_forever
+from .web_server import build_flask_app, serve_forever, serve_async, ServerOptions
+from .workers import serve_with_workers
 from . import settings
 
 
@@ -27,19 +28,30 @@ def main():
     if args.cached:
         log.info('Cached GTFS debug server is starting up...')
         gtfs = CachedGTFS(static_assets_path=CACHED_STATIC_ASSETS,
-                          realtime_data_path=CACHED_REALTIME_DATA)
+                          realtime_data_path=CACHED_REALTIME_DATA,
+                          snapshot_dir=settings.SNAPSHOT_DIR,
+                          filter_stops=args.filter)
     else:
         log.info('GTFS is starting up...')
         gtfs = GTFS(static_asset_url=settings.GTFS_STATIC_URL,
                     realtime_data_url=settings.GTFS_REALTIME_URL,
-                    start=True)
+                    start=True, snapshot_dir=settings.SNAPSHOT_DIR,
+                    filter_stops=args.filter)
 
     gtfs.wait_for_data_available(timeout=60)
 
-    app = build_flask_app()
-    register_routes(app, gtfs)
+    options = ServerOptions(threads=args.threads, connection_limit=args.connection_limit,
+                            backlog=args.backlog, channel_timeout=args.channel_timeout)
 
-    serve_forever(app, settings.HOST, settings.PORT)
+    if args.workers > 1:
+        serve_with_workers(gtfs, settings.HOST, settings.PORT, args.workers,
+                           options, args.server, debug=args.debug, verbose=args.verbose)
+    else:
+        app = build_flask_app()
+        register_routes(app, gtfs, None if args.server == 'async' else args.threads)
+
+        serve = serve_async if args.server == 'async' else serve_forever
+        serve(app, settings.HOST, settings.PORT, options)
 
 
 def get_args():
@@ -47,6 +59,21 @@ def get_args():
 
     parser.add_argument('--cached', action='store_true',
                         help='run the server using unittest cached data, not live data.')
+    parser.add_argument('--workers', type=int, default=settings.WORKERS,
+                        help='the number of worker processes serving requests.')
+    parser.add_argument('--threads', type=int, default=settings.THREADS,
+                        help='the number of threads serving requests in each process.')
+    parser.add_argument('--connection-limit', type=int, default=settings.CONNECTION_LIMIT,
+                        help='the number of open connections to each process.')
+    parser.add_argument('--backlog', type=int, default=settings.BACKLOG,
+                        help='the number of connections waiting to be accepted.')
+    parser.add_argument('--channel-timeout', type=int, default=settings.CHANNEL_TIMEOUT,
+                        help='close idle connections after this many seconds.')
+    parser.add_argument('--server', choices=['waitress', 'async'], default=settings.SERVER,
+                        help='handle each connection in a thread, or hold them in an event loop.')
+    parser.add_argument('--filter', type=_stop_numbers, default=settings.FILTER_STOPS,
+                        help='a comma separated list of stop numbers, only the data '
+                             'for these stops is kept in memory.')
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--debug", help="print debug info", action='store_true')
@@ -55,5 +82,9 @@ def get_args():
     return parser.parse_args()
 
 
+def _stop_numbers(value: str):
+    return [int(n) for n in value.split(',') if n.strip()]
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,228 @@
+"""Micro-benchmarks of loading the static assets, decoding the realtime
+data, querying departures and formatting the responses, run offline
+against the cached test data. The results are written as JSON, so runs on
+different commits can be compared:
+
+    python -m tfi_gtfs.bench --output before.json
+    python -m tfi_gtfs.bench --output after.json --compare before.json
+"""
+
+import sys
+import json
+import time
+import logging
+import zipfile
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+
+from typing import Callable, Dict, List, Optional
+from datetime import datetime, date, time as day_time, timedelta
+
+from .gtfs import CachedGTFS, RealtimeData, StaticAssets, build_service_calendar
+from .gtfs.static_assets import TABLE_LOADERS, load_stop_times
+from .gtfs.utils import peak_memory_usage, format_bytes
+from .web_server import build_flask_app, format_response
+from .web_server.format import VALID_MIME_TYPES
+from .__main__ import CACHED_STATIC_ASSETS, CACHED_REALTIME_DATA
+
+
+log = logging.getLogger(__name__)
+
+# the version of the results file format.
+RESULTS_VERSION = 1
+
+# the departures are queried at a fixed time of day, so runs are comparable.
+QUERY_TIME = day_time(8, 0)
+QUERY_WINDOW = timedelta(minutes=90)
+
+# the stop of the single stop query, and the number of stops in the multi
+# stop query, which are the first stops with a stop number.
+SINGLE_STOP = 271
+MULTI_STOP_COUNT = 20
+
+# the loading benchmarks take much longer than the rest, so they're
+# repeated this fraction of the requested times, at least twice.
+LOAD_REPEAT_FRACTION = 0.2
+
+
+def measure(func: Callable, repeat: int, items: int = 1, warmup: int = 1) -> dict:
+    """Time `repeat` calls of the function, after `warmup` untimed calls.
+    `items` is the number of things each call processes, for the throughput.
+    The peak RSS is the high-water mark of the process after the calls."""
+
+    for _ in range(warmup):
+        func()
+
+    times = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times[i] = time.perf_counter() - start
+
+    return {
+        'repeat': repeat,
+        'mean_ms': times.mean() * 1e3,
+        'p50_ms': np.percentile(times, 50) * 1e3,
+        'p99_ms': np.percentile(times, 99) * 1e3,
+        'min_ms': times.min() * 1e3,
+        'max_ms': times.max() * 1e3,
+        'throughput': items / times.mean(),
+        'peak_rss': peak_memory_usage(),
+    }
+
+
+def run_benchmarks(static_assets_path: str = CACHED_STATIC_ASSETS,
+                   realtime_data_path: str = CACHED_REALTIME_DATA,
+                   repeat: int = 50, only: Optional[List[str]] = None) -> dict:
+    """Run the benchmarks, returning the results of each by name. If `only`
+    is given, just the benchmarks with a name containing one of its strings
+    are run."""
+
+    results = {}
+    load_repeat = max(2, round(repeat * LOAD_REPEAT_FRACTION))
+
+    def bench(name: str, func: Callable, repeat: int = repeat, items: int = 1):
+        if only and not any(s in name for s in only):
+            return
+
+        log.info(f'running {name}')
+        results[name] = measure(func, repeat, items)
+
+    # static asset loading, each table on its own, then the whole zip file
+    # parsed in this process, and loaded from a snapshot.
+    with zipfile.ZipFile(static_assets_path) as zf:
+        loaders = dict(TABLE_LOADERS, stop_times=load_stop_times)
+        for name, loader in loaders.items():
+            bench(f'static.load.{name}', lambda: loader(zf), load_repeat)
+
+    bench('static.load.all', lambda: StaticAssets(static_assets_path, workers=1).close(),
+          load_repeat)
+
+    sa = StaticAssets(static_assets_path, workers=1)
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshot = sa.save_snapshot(snapshot_dir)
+        bench('static.load.snapshot', lambda: StaticAssets.from_snapshot(snapshot).close(),
+              load_repeat)
+
+    bench('calendar.build_service_calendar',
+          lambda: build_service_calendar(sa.calendar, sa.calendar_exceptions))
+    sa.close()
+
+    with open(realtime_data_path, 'rb') as f:
+        realtime_data = f.read()
+    bench('realtime.decode', lambda: RealtimeData(realtime_data))
+
+    # the departures queries and the response formats
+    gtfs = CachedGTFS(static_assets_path=static_assets_path,
+                      realtime_data_path=realtime_data_path)
+    now = datetime.combine(date.today(), QUERY_TIME)
+    stops = gtfs.static_assets.stops.index.dropna().astype(int)[:MULTI_STOP_COUNT].tolist()
+
+    bench('departures.single', lambda: gtfs.get_scheduled_departures(SINGLE_STOP, now, QUERY_WINDOW))
+    bench('departures.multi', lambda: gtfs.get_departures_for_stops(stops, now, QUERY_WINDOW),
+          items=len(stops))
+
+    departures = gtfs.get_departures_for_stops(stops, now, QUERY_WINDOW)
+    data = {stop_number: {'stop_name': stop_name, 'departures': departures[stop_number]}
+            for stop_number, stop_name in gtfs.stop_names(stops).items()}
+    respond = format_response(lambda: data)
+
+    app = build_flask_app()
+    for mime_type in VALID_MIME_TYPES:
+        with app.test_request_context(headers={'Accept': mime_type}):
+            bench(f'format.{mime_type}', lambda: respond().get_data(), items=len(data))
+
+    return results
+
+
+def results_document(results: dict) -> dict:
+    """The results with the details of the run, as written to the JSON file."""
+
+    return {
+        'version': RESULTS_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def compare(old: dict, new: dict) -> Dict[str, float]:
+    """The ratio of the new p50 to the old p50 of each benchmark in both
+    results documents, above 1 is slower."""
+
+    old_results, new_results = old['results'], new['results']
+    return {name: new_results[name]['p50_ms'] / old_results[name]['p50_ms']
+            for name in new_results if name in old_results and old_results[name]['p50_ms'] > 0}
+
+
+def summary(results: dict, ratios: Optional[Dict[str, float]] = None) -> str:
+    """A table of the results, for printing."""
+
+    lines = [f'{"benchmark":<36}{"p50 ms":>10}{"p99 ms":>10}{"per sec":>12}{"peak RSS":>12}'
+             + ('  vs old' if ratios else '')]
+    for name, r in results.items():
+        line = f'{name:<36}{r["p50_ms"]:>10.3f}{r["p99_ms"]:>10.3f}' \
+               f'{r["throughput"]:>12.1f}{format_bytes(r["peak_rss"]):>12}'
+        if ratios and name in ratios:
+            line += f'  {ratios[name]:.2f}x'
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def _git_commit() -> Optional[str]:
+    """The commit being benchmarked, if running from a git checkout."""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None):
+    args = get_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    document = results_document(run_benchmarks(args.static_assets, args.realtime_data,
+                                               args.repeat, args.only))
+
+    ratios = None
+    if args.compare:
+        with open(args.compare) as f:
+            ratios = compare(json.load(f), document)
+
+    print(summary(document['results'], ratios))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+
+
+def get_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the GTFS data and API")
+
+    parser.add_argument('--static-assets', default=CACHED_STATIC_ASSETS,
+                        help='the GTFS zip file to benchmark with.')
+    parser.add_argument('--realtime-data', default=CACHED_REALTIME_DATA,
+                        help='the GTFS-R feed to benchmark with.')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='the number of timed calls of each benchmark.')
+    parser.add_argument('--only', action='append',
+                        help='only run the benchmarks with a name containing this, '
+                             'can be given more than once.')
+    parser.add_argument('--output', help='write the results to this JSON file.')
+    parser.add_argument('--compare', help='compare with the results in this JSON file.')
+    parser.add_argument('--verbose', action='store_true', help='log each benchmark as it runs.')
+
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,5 +1,6 @@
 
 from .static_assets import StaticAssets
+from .static_assets import load_static_assets
 
 from .static_assets import load_stops
 from .static_assets import load_stop_times
@@ -7,12 +8,15 @@ from .static_assets import load_stop_times
 from .static_assets import load_calendar
 from .static_assets import load_calendar_exceptions
 from .static_assets import build_service_calendar
+from .static_assets import build_service_bitmask
+from .trip_metadata import build_trip_metadata
 
 from .static_assets import load_trips
 from .static_assets import load_routes
 from .static_assets import load_agencies
 
 from .realtime_data import RealtimeData
+from .realtime_store import RealtimeStore
 
 from .panda_size import memory_report_from_private_pandas_objs
 
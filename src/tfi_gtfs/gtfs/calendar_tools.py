@@ -2,6 +2,7 @@
 import pytz
 import datetime
 
+import numpy as np
 import pandas as pd
 
 from .constants import CalendarException
@@ -14,73 +15,123 @@ def now(timezone):
     return datetime.datetime.now(tz)
 
 
-# The GTFS-R spec contains a file "calendar.txt" that defines:
-#   - the service
-#   - which days of the week it runs
-#   - the start date and end date of that schedule (inclusive)
-# The file "calendar_dates.txt" turns on or off services for specific days
-# and operates as exceptions to what's in "calendar.txt"
-# This function will combine the two and produce a full expanded dataframe
-# of dates each service will run on.
-def _expand_calendar_txt(calendar_df: pd.DataFrame,
-                         from_date: datetime.date, to_date: datetime.date):
-    """Expand the calendar.txt into an exhaustive list of dates that each service
-    travels on. `from_date` and `to_date` are inclusive dates to calculate the
-    expanded list of travel dates."""
+DAYS_OF_WEEK = ['monday', 'tuesday', 'wednesday', 'thursday',
+                'friday', 'saturday', 'sunday']
 
-    cal = calendar_df.copy().reset_index(names='service_id')
+# the running days of each service are stored as bits in one integer,
+# which limits the length of the schedule period.
+MAX_DAYS = 32
 
-    def _services_running(my_date):
-        """For a timestamp, returns a pandas series of whether the service
-        is running on that day of the week."""
 
-        running_on_date = cal[my_date.day_name().lower()]
-        schedule_is_valid = (cal.start_date.le(my_date)) & \
-                            (cal.end_date.ge(my_date))
+class ServiceCalendar:
+    """A bitmask of the days each service runs on. Bit `n` of a service's
+    mask is set if the service runs `n` days after the `from_date`."""
 
-        return running_on_date & schedule_is_valid
+    def __init__(self, from_date: datetime.date, n_days: int,
+                 service_ids: pd.Index, masks: np.ndarray):
 
-    dates = pd.date_range(start=from_date, end=to_date)
-    expanded_df = pd.DataFrame({pd.to_datetime(d): _services_running(d) for d in dates})
+        self._from_date = np.datetime64(from_date, 'D')
+        self._n_days = n_days
+        self._service_ids = service_ids
+        self._masks = masks
 
-    expanded_df['service_id'] = cal.service_id
-    expanded_df = expanded_df.melt(id_vars='service_id', var_name='date', value_name='running')
-    expanded_df = expanded_df[expanded_df.running].drop('running', axis=1).copy()
-    expanded_df['date'] = pd.to_datetime(expanded_df['date'])
+    @property
+    def from_date(self) -> datetime.date:
+        return self._from_date.astype(datetime.date)
 
-    return expanded_df
+    @property
+    def n_days(self) -> int:
+        return self._n_days
 
+    @property
+    def service_ids(self) -> pd.Index:
+        return self._service_ids
 
+    @property
+    def masks(self) -> np.ndarray:
+        return self._masks
 
-def build_service_calendar(calendar_df: pd.DataFrame, cal_exception_df: pd.DataFrame,
-                           start_offset=-2, stop_offset=7):
+    def is_running(self, service_ids: np.ndarray, dates: np.ndarray) -> np.ndarray:
+        """Return whether each service runs on the matching date. Services
+        or dates outside of the calendar are not running."""
+
+        return self.rows_running(self._service_ids.get_indexer(service_ids), dates)
+
+    def rows_running(self, rows: np.ndarray, dates: np.ndarray) -> np.ndarray:
+        """Like `is_running()`, with each service given by its row in
+        `service_ids`, or -1 for a service that isn't in the calendar."""
+
+        days = (dates.astype('datetime64[D]') - self._from_date).astype(np.int64)
+
+        valid = (rows >= 0) & (days >= 0) & (days < self._n_days)
+        bits = self._masks[rows] >> np.clip(days, 0, self._n_days - 1).astype(np.uint32)
+
+        return valid & (bits & 1).astype(bool)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Expand the bitmask to a dataframe of every (service_id, date) running."""
+
+        running = (self._masks[None, :] >> np.arange(self._n_days, dtype=np.uint32)[:, None]) & 1
+        days, rows = np.nonzero(running)
+
+        return pd.DataFrame({'service_id': self._service_ids.to_numpy()[rows],
+                             'date': (self._from_date + days).astype('datetime64[ns]')})
+
+
+# The GTFS-R spec contains a file "calendar.txt" that defines:
+#   - the service
+#   - which days of the week it runs
+#   - the start date and end date of that schedule (inclusive)
+# The file "calendar_dates.txt" turns on or off services for specific days
+# and operates as exceptions to what's in "calendar.txt"
+# This function will combine the two and produce a bitmask of the dates
+# each service will run on.
+def build_service_bitmask(calendar_df: pd.DataFrame, cal_exception_df: pd.DataFrame,
+                          start_offset=-2, stop_offset=7) -> ServiceCalendar:
     """Calculate the standard schedule based on calendar.txt, then apply the exceptions."""
 
     from_date = datetime.date.today() + datetime.timedelta(days=start_offset)
-    to_date = datetime.date.today() + datetime.timedelta(days=stop_offset)
+    n_days = stop_offset - start_offset + 1
+    if n_days > MAX_DAYS:
+        raise ValueError(f'the service calendar can cover at most {MAX_DAYS} days')
+
+    dates = pd.date_range(start=from_date, periods=n_days)
+    day_bits = np.left_shift(np.uint32(1), np.arange(n_days, dtype=np.uint32))
+
+    # services can be defined in calendar_dates.txt only, so they need a row too
+    service_ids = calendar_df.index.union(pd.Index(cal_exception_df.service_id.unique()))
+    cal = calendar_df.reindex(service_ids)
+
+    # the standard schedule, for each service and each day of the period
+    runs_on_weekday = cal[DAYS_OF_WEEK].fillna(0).to_numpy(dtype=bool)[:, dates.dayofweek]
+    schedule_is_valid = (cal.start_date.to_numpy()[:, None] <= dates.to_numpy()[None, :]) & \
+                        (cal.end_date.to_numpy()[:, None] >= dates.to_numpy()[None, :])
 
-    # first generate the standard schedule
-    cal = _expand_calendar_txt(calendar_df, from_date=from_date, to_date=to_date)
+    running = runs_on_weekday & schedule_is_valid
+    masks = np.bitwise_or.reduce(np.where(running, day_bits, np.uint32(0)), axis=1,
+                                 dtype=np.uint32, initial=np.uint32(0))
 
-    # now filter the exception df for exceptions that occur within this period
-    _period_selector = (cal_exception_df['date'].ge(pd.to_datetime(from_date)) &
-                        cal_exception_df['date'].le(pd.to_datetime(to_date)))
+    # now apply the exceptions that occur within this period
+    exc_days = (cal_exception_df.date.to_numpy().astype('datetime64[D]') -
+                np.datetime64(from_date, 'D')).astype(np.int64)
+    in_period = (exc_days >= 0) & (exc_days < n_days)
+    exc_rows = service_ids.get_indexer(cal_exception_df.service_id.to_numpy())
+    exc_type = cal_exception_df.exception_type.to_numpy()
 
-    # add in the service additions
-    _for_addition = cal_exception_df[_period_selector &
-          (cal_exception_df.exception_type == CalendarException.ServiceAdded)].copy()
-    _for_addition.drop('exception_type', axis=1, inplace=True)
-    cal = pd.concat([cal, _for_addition])
-    cal.reset_index(drop=True, inplace=True)
+    # add in the service additions, then take away any removed services
+    added = in_period & (exc_type == CalendarException.ServiceAdded)
+    np.bitwise_or.at(masks, exc_rows[added], day_bits[exc_days[added]])
 
-    # take away any removed services
-    _for_removal = cal_exception_df[_period_selector &
-          (cal_exception_df.exception_type == CalendarException.ServiceRemoved)].copy()
-    _for_removal.drop('exception_type', axis=1, inplace=True)
-    _remove_indices = cal[['service_id', 'date']].apply(tuple, axis=1).isin(
-                                                    _for_removal.apply(tuple, axis=1))
+    removed = in_period & (exc_type == CalendarException.ServiceRemoved)
+    np.bitwise_and.at(masks, exc_rows[removed], ~day_bits[exc_days[removed]])
 
-    cal.drop(index=_remove_indices[_remove_indices].index, axis='rows', inplace=True)
+    return ServiceCalendar(from_date, n_days, service_ids, masks)
 
-    return cal
 
+def build_service_calendar(calendar_df: pd.DataFrame, cal_exception_df: pd.DataFrame,
+                           start_offset=-2, stop_offset=7):
+    """Calculate the expanded calendar, a dataframe with a row for each service
+    and each date it runs on."""
+
+    return build_service_bitmask(calendar_df, cal_exception_df,
+                                 start_offset=start_offset, stop_offset=stop_offset).to_frame()
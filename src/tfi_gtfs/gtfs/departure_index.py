@@ -0,0 +1,123 @@
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+from typing import Tuple
+
+# the number of seconds in a service day, GTFS times can go past this
+# for trips that started on the previous service day.
+SECONDS_PER_DAY = 86400
+
+# departure times are stored in the low 31 bits of the index keys.
+MAX_DEPARTURE_SECS = 2 ** 31 - 1
+
+# the departure time of stop times that don't have one, GTFS allows this
+# for stops that aren't timepoints. They aren't in the index.
+NO_DEPARTURE_TIME = -1
+
+
+class DepartureIndex:
+    """A CSR style index of the stop times. All departures are stored in
+    contiguous arrays, sorted by stop and then by departure time, with an
+    offsets array giving the slice of departures for each stop code.
+
+    The stop code and departure time are stored together as one int64 key,
+    `stop_code << 32 | departure_secs`, so the departures of any number of
+    stops are found with one binary search over the whole index."""
+
+    def __init__(self, offsets: np.ndarray, keys: np.ndarray,
+                 trip_codes: np.ndarray, stop_sequence: np.ndarray):
+
+        self._offsets = offsets
+        self._keys = keys
+        self._trip_codes = trip_codes
+        self._stop_sequence = stop_sequence
+
+        # the departure times are the low 32 bits of the keys, as a view
+        self._departure_secs = keys.view(np.int32)[0 if sys.byteorder == 'little' else 1::2]
+
+    @classmethod
+    def from_stop_times(cls, stop_times: pd.DataFrame):
+        """Build the index from the stop times dataframe. The stop codes and
+        trip codes are the categorical codes of `stop_id` and `trip_id`, and
+        `departure_time` is in seconds since the service day started, or
+        NO_DEPARTURE_TIME."""
+
+        departure_secs = stop_times.departure_time.to_numpy(np.int64)
+        timed = departure_secs != NO_DEPARTURE_TIME
+
+        stop_codes = stop_times.stop_id.cat.codes.to_numpy()[timed]
+        keys = departure_keys(stop_codes, departure_secs[timed])
+
+        # sort by stop, then by departure time within each stop
+        order = np.argsort(keys, kind='stable')
+        stop_counts = np.bincount(stop_codes, minlength=len(stop_times.stop_id.cat.categories))
+
+        offsets = np.zeros(len(stop_counts) + 1, dtype=np.int64)
+        np.cumsum(stop_counts, out=offsets[1:])
+
+        return cls(offsets,
+                   keys[order],
+                   stop_times.trip_id.cat.codes.to_numpy().astype(np.int32)[timed][order],
+                   stop_times.stop_sequence.to_numpy().astype(np.int32)[timed][order])
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return self._offsets
+
+    @property
+    def keys(self) -> np.ndarray:
+        return self._keys
+
+    @property
+    def departure_secs(self) -> np.ndarray:
+        return self._departure_secs
+
+    @property
+    def trip_codes(self) -> np.ndarray:
+        return self._trip_codes
+
+    @property
+    def stop_sequence(self) -> np.ndarray:
+        return self._stop_sequence
+
+    def stop_slice(self, stop_code: int) -> slice:
+        """The slice of the departure arrays for the given stop code."""
+        return slice(self._offsets[stop_code], self._offsets[stop_code + 1])
+
+    def window(self, stop_code: int, start: int, end: int) -> slice:
+        """The slice of the departure arrays for a stop, where the departure
+        time is in [start, end), given in seconds since the service day started."""
+
+        first, last = self.windows(np.array([stop_code]), np.array([start]), np.array([end]))
+        return slice(first[0], last[0])
+
+    def windows(self, stop_codes: np.ndarray, start: np.ndarray,
+                end: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The bounds of the departures in [start, end) for each of the stop
+        codes, the same as `window` for each, as arrays of first and last."""
+
+        return (np.searchsorted(self._keys, departure_keys(stop_codes, start), side='left'),
+                np.searchsorted(self._keys, departure_keys(stop_codes, end), side='left'))
+
+
+def departure_keys(stop_codes: np.ndarray, departure_secs: np.ndarray) -> np.ndarray:
+    """The index keys of the stop codes and departure times. Times before
+    the service day are clipped to 0, so they can't reach into the keys of
+    the previous stop."""
+
+    secs = np.clip(np.asarray(departure_secs, dtype=np.int64), 0, MAX_DEPARTURE_SECS)
+    return np.asarray(stop_codes, dtype=np.int64) << 32 | secs
+
+
+def ranges_to_rows(first: np.ndarray, last: np.ndarray) -> np.ndarray:
+    """Concatenate the ranges [first, last) into one array of rows."""
+
+    counts = last - first
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(first - (ends - counts), counts)
@@ -3,7 +3,10 @@
  web resource on a schedule, execute a callback when an update
  is available, and re-download failed resources."""
 
+import os
+import json
 import logging
+import tempfile
 import threading
 
 # When creating your callback function, if the data received is
@@ -17,6 +20,18 @@ import threading
 # Cache-Control headers to know when the remote resource has
 # updated, and when the next version should be downloaded.
 #
+# Every request is conditional on the Etag and Last-Modified headers
+# of the last version passed to the callbacks. If the server replies
+# with 304 Not Modified, the callbacks aren't executed.
+#
+# Each agent keeps its connection to the server open between updates
+# with a pooled session, and times out requests to a hung server.
+#
+# If any callback is registered for ResponseType.File, the response is
+# streamed to a temporary file in the download directory, rather than
+# held in memory, and the callback receives the path of the file. The
+# file is deleted once all callbacks have executed.
+#
 
 import re
 import time
@@ -28,7 +43,9 @@ from typing import Optional, Callable, Union
 from datetime import datetime, timedelta
 
 from requests import RequestException
+from requests.adapters import HTTPAdapter
 from requests.structures import CaseInsensitiveDict
+from urllib3 import PoolManager
 
 from .utils import next_scheduled_exec_time
 from .utils import seconds_until_timestamp, clip_at_zero
@@ -46,6 +63,16 @@ DEFAULT_WAIT = 3600   # 1 hour
 EXP_BACKOFF_MAX_WAIT = 60  # 1 minutes
 
 
+# the size of the chunks written to disk when streaming a download to a file.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+# the default seconds to wait to connect to the server, and to wait
+# between bytes received from the server.
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+
 log = logging.getLogger(__name__)
 
 
@@ -56,6 +83,33 @@ class ResponseType(IntEnum):
     Bytes = 1
     Text = 2
     JsonDecoded = 3
+    File = 4
+
+
+class ConnectionMetrics:
+    """Counters for the requests made by an agent, to show how often
+    a connection is reused and how long new connections take."""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.connect_time = 0.0        # total secs. to connect, including the TLS handshake
+        self.last_connect_time = 0.0
+        self.request_time = 0.0        # total secs. from sending a request to the headers arriving
+        self.last_request_time = 0.0
+
+    def record_connect(self, duration: float):
+        self.connections += 1
+        self.connect_time += duration
+        self.last_connect_time = duration
+
+    def record_request(self, duration: float):
+        self.requests += 1
+        self.request_time += duration
+        self.last_request_time = duration
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
 
 
 class DownloadAgent:
@@ -72,9 +126,18 @@ class DownloadAgent:
         self._headers = {}
         self._callbacks = []
 
+        self._metrics = ConnectionMetrics()
+        self._session = _pooled_session(self._metrics)
+        self._timeout = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+        self._download_dir = tempfile.gettempdir()
+
         self._last_response: Optional[requests.Response] = None
         self._error_wait = 0
 
+        # the validators of the last version of the resource passed to the callbacks
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+
         self._agent_thread = threading.Thread(target=self._run)
         self._agent_thread.name = f'{name}-thread'
         self._agent_thread.daemon = True
@@ -123,22 +186,30 @@ class DownloadAgent:
 
         self._callbacks.append((function, response_type))
 
-    def _broadcast_update(self, response: requests.Response) -> bool:
-        """Broadcast the response to all registered callbacks."""
+    def _broadcast_update(self, response: requests.Response, path: Optional[str] = None) -> bool:
+        """Broadcast the response to all registered callbacks. If the response was
+        streamed to a file, `path` is the file and the content is read from it."""
 
         if len(self._callbacks) == 0:
             log.warning(f'No callbacks were registered for agent: {self._name}')
             return True
 
+        def content() -> bytes:
+            with open(path, 'rb') as f:
+                return f.read()
+
         success = True
         for callback, response_type in self._callbacks:
             try:
-                if response_type == ResponseType.Bytes:
-                    callback(response.content)
+                if response_type == ResponseType.File:
+                    callback(path)
+                elif response_type == ResponseType.Bytes:
+                    callback(response.content if path is None else content())
                 elif response_type == ResponseType.Text:
-                    callback(response.text)
+                    callback(response.text if path is None else
+                             content().decode(response.encoding or 'utf-8'))
                 elif response_type == ResponseType.JsonDecoded:
-                    callback(response.json())
+                    callback(response.json() if path is None else json.loads(content()))
                 elif response_type == ResponseType.NoData:
                     callback()
             except Exception:
@@ -149,11 +220,49 @@ class DownloadAgent:
 
         return success
 
+    @property
+    def _streams_to_file(self) -> bool:
+        return any(response_type == ResponseType.File for _, response_type in self._callbacks)
+
+    def _download_to_file(self, response: requests.Response) -> str:
+        """Write the response body to a temporary file in chunks, returning its path."""
+
+        os.makedirs(self._download_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self._download_dir, prefix='.download-')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+
+        return path
+
     def set_headers(self, headers: dict):
         """Set the headers to be used for the URL requests."""
 
         self._headers = headers
 
+    def set_download_dir(self, directory: str):
+        """Set the directory that responses are streamed to for File callbacks."""
+
+        self._download_dir = directory
+
+    def set_timeouts(self, connect: float, read: float):
+        """Set the seconds to wait to connect, and to wait between bytes received."""
+
+        self._timeout = (connect, read)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def metrics(self) -> ConnectionMetrics:
+        return self._metrics
+
     @property
     def response_headers(self) -> CaseInsensitiveDict[str]:
         return self._last_response.headers
@@ -205,7 +314,7 @@ class DownloadAgent:
          until trying again, the wait time backs off exponentially. If
          a 429 error was returned, wait the max time immediately."""
 
-        if self._last_response.status_code == 429:
+        if self._last_response is not None and self._last_response.status_code == 429:
             log.error('Too many requests, using max exponential backoff wait...')
             cur_wait = EXP_BACKOFF_MAX_WAIT
         else:
@@ -228,7 +337,7 @@ class DownloadAgent:
         """Returns the headers for the resource, using a HEAD request."""
 
         try:
-            head = requests.head(self._url, headers=self._headers)
+            head = self._session.head(self._url, headers=self._headers, timeout=self._timeout)
             return head.headers
         except requests.RequestException:
             return {}
@@ -237,54 +346,129 @@ class DownloadAgent:
     def etag_header(self):
         return self.resource_headers().get('Etag')
 
-    def resource_needs_update(self):
-        """Return false if the resource has an Etag and it shows the resource
-        is unchanged."""
+    def _request_headers(self) -> dict:
+        """The headers for the next request, including the validators from the
+        last successful update, so an unchanged resource returns a 304."""
 
-        if self.resource_has_etag:
-            headers = self.resource_headers()
-            current_etag = headers.get('Etag')
-            old_etag = self.response_headers.get('Etag')
-            if current_etag == old_etag:
-                log.warning(f'{self._name} agent may have woken up too early.')
-                log.warning(f'   -> Etag is unchanged: {current_etag}')
-                log.warning(f'      remote resource will not be updated...')
-                return False
+        headers = dict(self._headers)
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified is not None:
+            headers['If-Modified-Since'] = self._last_modified
 
-        return True
+        return headers
 
     def _update(self) -> bool:
         """Run an update of the remote resource."""
 
+        response, path = None, None
         try:
-            self._last_response = requests.get(self._url, headers=self._headers)
-            self._last_response.raise_for_status()
-        except RequestException as e:
+            connections = self._metrics.connections
+            response = self._session.get(self._url, headers=self._request_headers(),
+                                         timeout=self._timeout, stream=self._streams_to_file)
+            self._last_response = response
+            self._metrics.record_request(response.elapsed.total_seconds())
+            response.raise_for_status()
+
+            if response.status_code != 304 and self._streams_to_file:
+                path = self._download_to_file(response)
+        except (RequestException, OSError) as e:
             log.error(f'{self._name} agent encountered an exception:\n', exc_info=True)
             return False
+        finally:
+            # returns the connection to the pool, a streamed response has been read to the file
+            if response is not None:
+                response.close()
+
+        if self._metrics.connections > connections:
+            log.debug(f'{self._name} agent -> new connection took '
+                      f'{self._metrics.last_connect_time:.3f} secs.')
+        log.debug(f'{self._name} agent -> {response.status_code} response in '
+                  f'{self._metrics.last_request_time:.3f} secs.')
+
+        if response.status_code == 304:
+            log.info(f'{self._name} agent -> resource is unchanged (304 Not Modified)')
+            return True
 
-        return self._broadcast_update(self._last_response)
+        try:
+            success = self._broadcast_update(response, path)
+        finally:
+            if path is not None:
+                os.remove(path)
+
+        # the validators are only kept once the callbacks have accepted the
+        # new version, otherwise a failed update would never be retried.
+        if success:
+            self._etag = response.headers.get('Etag')
+            self._last_modified = response.headers.get('Last-Modified')
+
+        return success
 
     def _run(self):
         """Main agent thread."""
 
         while True:
-            if self.resource_needs_update:
-                success = self._update()
+            success = self._update()
 
-                if success:
-                    self._reset_error_wait()
-                else:
-                    self._wait_after_error()
-                    continue
+            if success:
+                self._reset_error_wait()
+            else:
+                self._wait_after_error()
+                continue
 
             self._wait()
 
 
+class _TimedPoolManager(PoolManager):
+    """A pool manager whose connections record how long they took to connect."""
+
+    def __init__(self, metrics: ConnectionMetrics, *args, **kwargs):
+        self._metrics = metrics
+        super().__init__(*args, **kwargs)
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        metrics = self._metrics
+
+        class TimedConnection(pool.ConnectionCls):
+            def connect(self):
+                start = time.perf_counter()
+                super().connect()
+                metrics.record_connect(time.perf_counter() - start)
+
+        pool.ConnectionCls = TimedConnection
+        return pool
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+
+    def __init__(self, metrics: ConnectionMetrics):
+        self._metrics = metrics
+        super().__init__()
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self.poolmanager = _TimedPoolManager(self._metrics, num_pools=connections,
+                                             maxsize=maxsize, block=block, **pool_kwargs)
+
+
+def _pooled_session(metrics: ConnectionMetrics) -> requests.Session:
+    """A session that keeps connections alive between requests, and
+    records the connection times to the metrics."""
+
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    adapter = _TimedHTTPAdapter(metrics)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
 def cache_control_sleep(headers):
     """Return the number of seconds to sleep based on the cache control headers"""
 
-    cc_header = headers.get('Cache-Control').lower()
+    cc_header = headers.get('Cache-Control', '').lower()
 
     if 'no-cache' in cc_header:
         return 0
@@ -307,7 +491,7 @@ def expires_sleep(headers):
     """return the number of seconds to sleep based on the expires header"""
 
     exp_header = headers.get('Expires')
-    if exp_header == '0':
+    if exp_header is None or exp_header == '0':
         return 0   # resource already expired
 
     return seconds_until_timestamp(exp_header)
@@ -1,13 +1,20 @@
 
+import pytz
 import logging
 import threading
 
+import numpy as np
 import pandas as pd
-from typing import Optional
+
+from typing import Optional, List, Callable, Dict, Iterable
+from datetime import datetime, timedelta
 
 from .realtime_data import RealtimeData
-from .static_assets import StaticAssets
+from .realtime_store import RealtimeStore, RealtimeSnapshot
+from .static_assets import StaticAssets, ZipSource, load_static_assets
+from .snapshot import find_snapshot, snapshot_key
 from .downloader import DownloadAgent, ResponseType
+from .utils import peak_memory_usage, format_bytes
 
 from .. import settings
 
@@ -20,20 +27,40 @@ REALTIME_HEADERS = {
     'X-API-KEY': settings.API_KEY
 }
 
+# a service that was scheduled to depart before now may still be
+# at the stop if it's running late, so scheduled departures are
+# searched for from this far back, then filtered using the delays.
+MAX_DELAY = timedelta(minutes=30)
+
+# a replaced generation of static assets is torn down after this many
+# seconds, so requests that started before the swap can finish with it.
+RETIRE_DELAY = 60
+
+# the columns of each departure returned to the web server.
+DEPARTURE_COLUMNS = ['route', 'headsign', 'agency',
+                     'scheduled_arrival', 'real_time_arrival']
+
 
 class GTFS:
     """A wrapper for maintaining the latest GTFS-R static and live data."""
 
     def __init__(self, static_asset_url: str, realtime_data_url: str,
-                 start=False, api_key_check=True):
+                 start=False, api_key_check=True, snapshot_dir: Optional[str] = None,
+                 filter_stops: Optional[List[int]] = None):
 
+        self._snapshot_dir = snapshot_dir
+        self._filter_stops = sorted(filter_stops) if filter_stops else None
         self._static_assets: Optional[StaticAssets] = None
+        self._static_asset_generation = 0
+        self._static_lock = threading.Lock()
         self._realtime_data: Optional[RealtimeData] = None
+        self._realtime_store = RealtimeStore()
 
         self._static_asset_agent: Optional[DownloadAgent] = None
         self._realtime_data_agent: Optional[DownloadAgent] = None
 
         self._data_available = threading.Event()
+        self._update_callbacks: List[Callable[['GTFS'], None]] = []
 
         if api_key_check and settings.API_KEY is None:
             raise ValueError('API key must be set in environment variables')
@@ -49,7 +76,8 @@ class GTFS:
         self._static_asset_agent = DownloadAgent.auto_sleep('static assets',
                                                             static_asset_url)
         self._static_asset_agent.register_callback(self.new_static_assets,
-                                                   ResponseType.Bytes)
+                                                   ResponseType.File)
+        self._static_asset_agent.set_download_dir(settings.DATA_DIR)
 
         # configure the downloader for realtime assets
         self._realtime_data_agent = DownloadAgent.every_minute('realtime data',
@@ -58,6 +86,9 @@ class GTFS:
                                                     ResponseType.Bytes)
         self._realtime_data_agent.set_headers(REALTIME_HEADERS)
 
+        for agent in [self._static_asset_agent, self._realtime_data_agent]:
+            agent.set_timeouts(settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+
         # add a callback to set the data available event.
         self._static_asset_agent.register_callback(self._manage_data_available_event)
         self._realtime_data_agent.register_callback(self._manage_data_available_event)
@@ -66,31 +97,131 @@ class GTFS:
     def start_agents(self):
         """Start the download agents."""
 
+        self.load_latest_snapshot()
+
         self._static_asset_agent.start()
         self._realtime_data_agent.start()
 
-    def new_static_assets(self, new_static_asset_zip: bytes):
-        """Callback for an updated static asset Zip file."""
-
-        sa = StaticAssets(new_static_asset_zip)
-        log.info('Updating static assets')
-        self._static_assets = sa
+    def new_static_assets(self, new_static_asset_zip: ZipSource):
+        """Callback for an updated static asset Zip file, given as the path
+        of the downloaded file, or as bytes. The new assets are built and
+        validated while the current ones are still served, then swapped in."""
+
+        with self._static_lock:
+            current = self._static_assets
+            if current is not None and \
+                    current.key == snapshot_key(new_static_asset_zip, self._filter_stops):
+                log.info('Static assets are unchanged')
+                return
+
+            log.info('Building new static assets')
+            self._swap_static_assets(load_static_assets(new_static_asset_zip,
+                                                        self._snapshot_dir,
+                                                        self._filter_stops))
+
+        self._notify_update()
+
+    def load_latest_snapshot(self):
+        """Load the static assets from the latest snapshot, so departures can be
+        served before the static asset zip file has been downloaded."""
+
+        if self._snapshot_dir is None:
+            return
+
+        path = find_snapshot(self._snapshot_dir)
+        if path is None:
+            log.info(f'No static asset snapshot in {self._snapshot_dir}')
+            return
+
+        try:
+            sa = StaticAssets.from_snapshot(path)
+        except Exception:
+            log.error(f'Unable to load the static asset snapshot {path}\n', exc_info=True)
+            return
+
+        if sa.filter_stops != self._filter_stops:
+            log.info(f'The static asset snapshot {path} has a different stop filter')
+            sa.close()
+            return
+
+        log.info(f'Loaded static assets from snapshot {path}')
+        with self._static_lock:
+            self._swap_static_assets(sa)
+
+        self._notify_update()
+
+    def _swap_static_assets(self, static_assets: StaticAssets):
+        """Replace the static assets with a new generation, which is a single
+        reference assignment, so requests see either the old or the new one.
+        The old generation is torn down once in-flight requests are done with
+        it. This is called with the static lock held."""
+
+        old = self._static_assets
+        self._static_assets = static_assets
+        self._static_asset_generation += 1
+
+        log.info(f'Static asset generation {self._static_asset_generation} is live '
+                 f'(key {static_assets.key}), peak memory usage: '
+                 f'{format_bytes(peak_memory_usage())}')
+
+        if old is not None and old is not static_assets:
+            retire = threading.Timer(RETIRE_DELAY, old.close)
+            retire.daemon = True
+            retire.start()
 
     def new_realtime_data(self, new_realtime_data: bytes):
         """Callback for an updated static asset Zip file."""
 
-        rd = RealtimeData(new_realtime_data)
+        static_assets = self._static_assets
+        rd = RealtimeData(new_realtime_data, static_assets.realtime_filter
+                                             if static_assets is not None else None)
         log.debug('Updating realtime data')
+        self._realtime_store.merge(rd)
         self._realtime_data = rd
+        self._notify_update()
+
+    def register_update_callback(self, callback: Callable[['GTFS'], None]):
+        """Register a function to be called with this instance each time the
+        static assets or the realtime data are updated."""
+
+        self._update_callbacks.append(callback)
+
+    def _notify_update(self):
+        for callback in self._update_callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.error(f'while executing update callback: {callback}\n', exc_info=True)
 
     @property
     def realtime_dataframe(self) -> pd.DataFrame:
         return self._realtime_data.dataframe
 
+    @property
+    def realtime_snapshot(self) -> RealtimeSnapshot:
+        return self._realtime_store.snapshot()
+
+    @property
+    def realtime_generation(self) -> int:
+        """Incremented each time realtime data is merged, this is cheaper
+        than the generation of `realtime_snapshot`, which builds the snapshot."""
+        return self._realtime_store.generation
+
     @property
     def static_assets(self) -> StaticAssets:
         return self._static_assets
 
+    @property
+    def static_asset_generation(self) -> int:
+        """Incremented each time the static assets are replaced."""
+        return self._static_asset_generation
+
+    def download_metrics(self) -> dict:
+        """The connection metrics of each download agent."""
+
+        agents = [self._static_asset_agent, self._realtime_data_agent]
+        return {agent.name: agent.metrics.as_dict() for agent in agents if agent is not None}
+
     def _manage_data_available_event(self):
         """A callback to check whether both static assets and realtime data is
         available and set the Event() when both are."""
@@ -108,18 +239,171 @@ class GTFS:
     def stop_name(self, stop_number: int):
         return self.static_assets.stop_number_to_name(stop_number)
 
+    def stop_names(self, stop_numbers: Iterable[int]) -> Dict[int, str]:
+        """The names of the stops, in the order given, leaving out unknown stops."""
+
+        return self.static_assets.stop_names(stop_numbers)
+
+    def get_scheduled_departures(self, stop_number: int, now: datetime,
+                                 window: timedelta) -> List[dict]:
+        """Return the departures from a stop in the next `window` of time,
+        with the realtime departure estimate where one is available."""
+
+        return self.get_departures_for_stops([stop_number], now, window).get(stop_number, [])
+
+    def get_departures_for_stops(self, stop_numbers: Iterable[int], now: datetime,
+                                 window: timedelta) -> Dict[int, List[dict]]:
+        """Return the departures from each stop in the next `window` of time,
+        keyed by stop number, leaving out unknown stops. All of the stops are
+        queried, and the realtime data applied, in one pass."""
+
+        # the static assets and realtime data can be replaced by another
+        # thread at any time, so each is only read once, and used throughout.
+        static_assets, realtime = self.static_assets, self.realtime_snapshot
+        now = _local_time(now, static_assets.timezone)
+
+        stop_ids = static_assets.stop_ids(stop_numbers)
+        departures = static_assets.departure_arrays(stop_ids, now - MAX_DELAY, now + window)
+        departures = apply_realtime_delays(departures, realtime, static_assets.timezone)
+
+        added = added_departures(static_assets, realtime, stop_ids)
+        if added is not None:
+            departures = {name: np.concatenate([departures[name], added[name]])
+                          for name in added}
+
+        # keep anything that hasn't left yet, by the schedule or by the live
+        # estimate, and that is due to leave before the end of the window.
+        now, end = np.datetime64(now, 'ns'), np.datetime64(now + window, 'ns')
+        scheduled, realtime_departure = departures['scheduled_departure'], \
+                                        departures['realtime_departure']
+        expected = np.where(np.isnat(realtime_departure), scheduled, realtime_departure)
+        keep = ((scheduled >= now) | (realtime_departure >= now)) & (expected < end)
+
+        return _departure_records({name: column[keep] for name, column in departures.items()},
+                                  list(stop_ids))
+
+
+def apply_realtime_delays(departures: Dict[str, np.ndarray], realtime: RealtimeSnapshot,
+                          timezone: str) -> Dict[str, np.ndarray]:
+    """Add a `realtime_departure` column to the scheduled departures, using
+    the latest realtime update for that trip, and drop cancelled trips."""
+
+    running = ~realtime.is_cancelled(departures['trip_id'])
+    departures = {name: column[running] for name, column in departures.items()}
+    delays, times = realtime.departure_delays(departures['trip_id'],
+                                              departures['stop_sequence'])
+
+    realtime_departure = departures['scheduled_departure'] + _seconds(delays)
+    has_time = times > 0
+    realtime_departure[has_time] = epoch_to_local(times[has_time], timezone)
+
+    return {**departures, 'realtime_departure': realtime_departure}
+
+
+def added_departures(static_assets: StaticAssets, realtime: RealtimeSnapshot,
+                     stop_ids: Dict[int, str]) -> Optional[Dict[str, np.ndarray]]:
+    """Return the departures from the stops for trips added by the realtime feed,
+    where `stop_ids` maps stop numbers to stop IDs, or None if there are none.
+    These have no schedule, so the scheduled and realtime departure are the same."""
+
+    added = realtime.added_at_stops(stop_ids.values())
+    if not len(added['trip_id']):
+        return None
+
+    # added trips are only usable if the route is known
+    route, agency = static_assets.route_details(added['route_id'].tolist())
+    known = pd.notna(route)
+
+    stop_numbers = {stop_id: stop_number for stop_number, stop_id in stop_ids.items()}
+    departure = epoch_to_local(added['time'][known], static_assets.timezone)
+    return {
+        'stop_number': np.array([stop_numbers[stop_id] for stop_id
+                                 in added['stop_id'][known].tolist()], dtype=np.int64),
+        'scheduled_departure': departure,
+        'realtime_departure': departure,
+        'route': route[known],
+        'headsign': np.full(len(departure), '', dtype=object),
+        'agency': agency[known],
+    }
+
+
+def _local_time(now: datetime, timezone: str) -> datetime:
+    """The static schedule is in naive local time, convert any
+    timezone aware timestamps to match."""
+
+    if now.tzinfo is None:
+        return now
+
+    return now.astimezone(pytz.timezone(timezone)).replace(tzinfo=None)
+
+
+def epoch_to_local(epochs: np.ndarray, timezone: str) -> np.ndarray:
+    """Convert unix timestamps to naive local datetimes. The UTC offset is
+    almost always the same for all of them, so it's only looked up per
+    timestamp when they span a change of offset."""
+
+    epochs = np.asarray(epochs, dtype=np.int64)
+    if not len(epochs):
+        return epochs.astype('datetime64[ns]')
+
+    tz = pytz.timezone(timezone)
+    offsets = {datetime.fromtimestamp(epoch, tz).utcoffset()
+               for epoch in [epochs.min().item(), epochs.max().item()]}
+    if len(offsets) > 1:
+        offsets = [datetime.fromtimestamp(epoch, tz).utcoffset() for epoch in epochs.tolist()]
+
+    offset = np.array([offset.total_seconds() for offset in offsets], dtype=np.int64)
+    return (epochs + offset).astype('datetime64[s]').astype('datetime64[ns]')
+
+
+def _seconds(delays: np.ndarray) -> np.ndarray:
+    """Convert delays in seconds, possibly NaN, to timedeltas."""
+
+    seconds = np.where(np.isnan(delays), 0, delays).astype('timedelta64[s]')
+    seconds[np.isnan(delays)] = np.timedelta64('NaT')
+    return seconds
+
+
+def _departure_records(departures: Dict[str, np.ndarray],
+                       stop_numbers: List[int]) -> Dict[int, List[dict]]:
+    """Convert the departures to a list of dicts for the web server for each
+    stop, sorted by when the service is expected to leave."""
+
+    positions = {stop_number: position for position, stop_number in enumerate(stop_numbers)}
+    stop_position = np.array([positions[stop_number] for stop_number
+                              in departures['stop_number'].tolist()], dtype=np.int64)
+
+    scheduled, realtime = departures['scheduled_departure'], departures['realtime_departure']
+    expected = np.where(np.isnat(realtime), scheduled, realtime)
+    order = np.lexsort((expected, stop_position))
+
+    # datetime64[us] converts to datetime objects, with NaT as None
+    columns = [departures['route'][order].tolist(),
+               departures['headsign'][order].tolist(),
+               departures['agency'][order].tolist(),
+               scheduled[order].astype('datetime64[us]').tolist(),
+               realtime[order].astype('datetime64[us]').tolist()]
+    records = [dict(zip(DEPARTURE_COLUMNS, values)) for values in zip(*columns)]
+
+    # the records are in order of stop, so each stop's records are a slice
+    ends = np.cumsum(np.bincount(stop_position, minlength=len(stop_numbers))).tolist()
+    return {stop_number: records[start:end]
+            for stop_number, start, end in zip(stop_numbers, [0] + ends[:-1], ends)}
+
 
 class CachedGTFS(GTFS):
     """A version of the GTFS class that only uses cached
     assets and never updates them. For debug purposes only."""
 
-    def __init__(self, static_assets_path: str,
-                       realtime_data_path: str):
+    def __init__(self, static_assets_path: str, realtime_data_path: str,
+                 snapshot_dir: Optional[str] = None, filter_stops: Optional[List[int]] = None):
 
-        GTFS.__init__(self, '', '',
-                      api_key_check=False)
+        GTFS.__init__(self, '', '', api_key_check=False,
+                      snapshot_dir=snapshot_dir, filter_stops=filter_stops)
 
-        self._static_assets = StaticAssets.from_file(static_assets_path)
+        with self._static_lock:
+            self._swap_static_assets(load_static_assets(static_assets_path, snapshot_dir,
+                                                        self._filter_stops))
 
         with open(realtime_data_path, 'rb') as f:
             self.new_realtime_data(f.read())
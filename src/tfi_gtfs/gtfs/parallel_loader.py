@@ -0,0 +1,139 @@
+"""Parsing the members of a GTFS zip file in parallel, across a pool of
+processes. The small members are each parsed by one worker. The large
+members are extracted once, split into byte ranges on line boundaries,
+and each range is parsed by a worker, the chunks are then concatenated
+with the categorical columns recoded to one set of categories."""
+
+import io
+import os
+import math
+import shutil
+import logging
+import zipfile
+import tempfile
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from typing import BinaryIO, Callable, Dict, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from pandas.api.types import union_categoricals
+
+
+log = logging.getLogger(__name__)
+
+
+# a chunked member is never split into ranges smaller than this.
+MIN_CHUNK_SIZE = 8 * 1024 * 1024
+
+# a loader parses a table from the open zip file, a chunk parser parses
+# part of a member from a file object, including the CSV header line.
+Loader = Callable[[zipfile.ZipFile], pd.DataFrame]
+ChunkParser = Callable[[BinaryIO], pd.DataFrame]
+
+
+def parallel_load(path: str, loaders: Dict[str, Loader],
+                  chunked: Dict[str, Tuple[str, ChunkParser]],
+                  workers: int) -> Dict[str, pd.DataFrame]:
+    """Parse the tables of the zip file at `path` in `workers` processes.
+    `loaders` maps table names to loaders run on the whole zip file, and
+    `chunked` maps table names to the zip member and the parser used for
+    each of its chunks. The loaders and parsers must be module level
+    functions, so they can be sent to the workers."""
+
+    # spawn rather than fork, the download agent threads are already running.
+    ctx = multiprocessing.get_context('spawn')
+    extract_dir = os.path.dirname(os.path.abspath(path))
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        futures = {name: pool.submit(_load_table, path, loader)
+                   for name, loader in loaders.items()}
+
+        # the small tables are parsed while the chunked members are extracted
+        chunk_futures, extracted = {}, []
+        try:
+            with zipfile.ZipFile(path) as zf:
+                for name, (member, parser) in chunked.items():
+                    file_path = _extract(zf, member, extract_dir)
+                    extracted.append(file_path)
+
+                    chunk_futures[name] = [pool.submit(_parse_range, file_path, header, start, end, parser)
+                                           for header, start, end in line_ranges(file_path, workers)]
+
+            tables = {name: future.result() for name, future in futures.items()}
+            for name, chunk_list in chunk_futures.items():
+                tables[name] = concat_chunks([future.result() for future in chunk_list])
+        finally:
+            for file_path in extracted:
+                os.remove(file_path)
+
+    return tables
+
+
+def line_ranges(path: str, n_ranges: int) -> List[Tuple[bytes, int, int]]:
+    """Split the file after its header line into at most `n_ranges` ranges of
+    about the same size, each starting at the beginning of a line. Returns
+    the header, and the start and end offset of each range."""
+
+    with open(path, 'rb') as f:
+        header = f.readline()
+        first, size = f.tell(), os.fstat(f.fileno()).st_size
+
+        step = max(MIN_CHUNK_SIZE, math.ceil((size - first) / n_ranges))
+        offsets = [first]
+
+        while offsets[-1] + step < size:
+            f.seek(offsets[-1] + step)
+            f.readline()     # move to the start of the next line
+            if f.tell() >= size:
+                break
+            offsets.append(f.tell())
+
+    offsets.append(size)
+    return [(header, start, end) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def concat_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate the chunks of a table. Each chunk has its own categories,
+    so the codes are recoded to the sorted union of them, which is the same
+    as parsing the table in one piece."""
+
+    columns = {}
+    for name in chunks[0].columns:
+        parts = [chunk[name] for chunk in chunks]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            columns[name] = union_categoricals(parts, sort_categories=True)
+        else:
+            columns[name] = np.concatenate([part.to_numpy() for part in parts])
+
+    return pd.DataFrame(columns)
+
+
+def _load_table(path: str, loader: Loader) -> pd.DataFrame:
+    with zipfile.ZipFile(path) as zf:
+        return loader(zf)
+
+
+def _extract(zf: zipfile.ZipFile, member: str, directory: str) -> str:
+    """Decompress the member to a temporary file, so it can be read from at
+    any offset, returning its path."""
+
+    fd, file_path = tempfile.mkstemp(dir=directory, prefix='.extract-')
+    try:
+        with os.fdopen(fd, 'wb') as out, zf.open(member, 'r') as f:
+            shutil.copyfileobj(f, out, length=1024 * 1024)
+    except Exception:
+        os.remove(file_path)
+        raise
+
+    return file_path
+
+
+def _parse_range(path: str, header: bytes, start: int, end: int,
+                 parser: ChunkParser) -> pd.DataFrame:
+    """Parse the byte range of a file, with the header line prepended."""
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return parser(io.BytesIO(header + f.read(end - start)))
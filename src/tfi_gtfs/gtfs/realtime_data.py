@@ -1,18 +1,21 @@
 
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from typing import List, Optional, Set, Tuple
 from google.transit import gtfs_realtime_pb2 as gtfsr
 
 from tfi_gtfs.gtfs.utils import timed_function
+from tfi_gtfs.gtfs.constants import Trip
 
 
 class RealtimeData:
     """A container to store all live data from the TFI API"""
 
-    def __init__(self, feed_bytes: bytes):
+    def __init__(self, feed_bytes: bytes,
+                 trip_filter: Optional[Tuple[Set[str], Set[str]]] = None):
         self._feed = gtfsr.FeedMessage()
         self._feed.ParseFromString(feed_bytes)
-        self._df = pd.DataFrame(self._iter_trip_updates())
+        self._df, self._cancelled_trip_ids = _decode_trip_updates(self._feed, trip_filter)
 
     @property
     def timestamp(self) -> int:
@@ -30,40 +33,145 @@ class RealtimeData:
     def _entities(self):
         return iter(self._feed.entity)
 
-    def _iter_trip_updates(self):
-        for entity in self._entities():
-            yield from _trip_update_series_generator(entity)
-
     @property
     def dataframe(self) -> pd.DataFrame:
         return self._df
 
+    @property
+    def cancelled_trip_ids(self) -> List[str]:
+        """The IDs of all trips the feed marks as cancelled. Cancelled trips
+        have no stop time updates, so they don't appear in the dataframe."""
 
-def _to_timestamp(start_date, start_time):
-    """Convert the start date and time strings to a timestamp object."""
-
-    return datetime.strptime(f'{start_date} {start_time}',
-                             '%Y%m%d %H:%M:%S')
-
-
-def _trip_update_series_generator(entity):
-    """Flatten an entity with trip_updates to pandas series,
-    yielding them as they come."""
+        return self._cancelled_trip_ids
 
-    # one trip update can contain multiple updates for all the stops along that route
 
-    for update in entity.trip_update.stop_time_update:
-        yield pd.Series({'id': entity.id,
-                         'trip_id': entity.trip_update.trip.trip_id,
-                         'route_id': entity.trip_update.trip.route_id,
-                         'vehicle_id': entity.trip_update.vehicle.id,
-                         'start': _to_timestamp(entity.trip_update.trip.start_date,
-                                                entity.trip_update.trip.start_time),
-                         'trip_sched_type': entity.trip_update.trip.schedule_relationship,
+class _Interner(dict):
+    """Assign each distinct string an integer code, in order of first use."""
 
-                         # stop specific items
-                         'stop_id': update.stop_id,
-                         'stop_sched_type': update.schedule_relationship,
-                         'arrival_delay': update.arrival.delay,
-                         'departure_delay': update.departure.delay
-                         })
+    def code(self, value: str) -> int:
+        code = self.get(value)
+        if code is None:
+            code = self[value] = len(self)
+        return code
+
+    def categorical(self, codes: np.ndarray) -> pd.Categorical:
+        return pd.Categorical.from_codes(codes, categories=list(self.keys()))
+
+
+def _start_timestamp(start_date: str, start_time: str) -> int:
+    """Convert the trip start date and time strings to a unix timestamp in
+    seconds, or the NaT value if there's no start date. The start time is
+    an offset from the start of the service day, so it can be past 24:00:00."""
+
+    if not start_date:
+        return np.iinfo(np.int64).min
+
+    day = np.datetime64(f'{start_date[:4]}-{start_date[4:6]}-{start_date[6:8]}', 's')
+    hours, minutes, seconds = start_time.split(':') if start_time else (0, 0, 0)
+
+    return int(day.astype(np.int64)) + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def _keep_entity(entity, trip_ids: Set[str], stop_ids: Set[str]) -> bool:
+    """Whether the entity is for one of the trips, or calls at one of the
+    stops. Added trips aren't in the schedule, so they only match by stop."""
+
+    trip_update = entity.trip_update
+    return trip_update.trip.trip_id in trip_ids or \
+        any(update.stop_id in stop_ids for update in trip_update.stop_time_update)
+
+
+def _decode_trip_updates(feed: gtfsr.FeedMessage,
+                         trip_filter: Optional[Tuple[Set[str], Set[str]]] = None
+                         ) -> Tuple[pd.DataFrame, List[str]]:
+    """Flatten the trip updates in the feed to a dataframe, one row per stop
+    time update. The feed is walked once, filling preallocated column buffers.
+    Trip level values are decoded once per entity, then repeated for each of
+    that trip's stop time updates. Also returns the IDs of cancelled trips.
+
+    If a (trip IDs, stop IDs) filter is given, only the entities for those
+    trips, or calling at those stops, are decoded."""
+
+    entities = feed.entity
+    if trip_filter is not None:
+        entities = [entity for entity in entities if _keep_entity(entity, *trip_filter)]
+
+    n_entities = len(entities)
+    n_updates = sum(len(entity.trip_update.stop_time_update) for entity in entities)
+
+    trip_ids, route_ids, stop_ids = _Interner(), _Interner(), _Interner()
+    cancelled = []
+
+    # trip level columns, one value per entity
+    entity_id = np.empty(n_entities, dtype=object)
+    vehicle_id = np.empty(n_entities, dtype=object)
+    trip_code = np.empty(n_entities, dtype=np.int32)
+    route_code = np.empty(n_entities, dtype=np.int32)
+    start = np.empty(n_entities, dtype=np.int64)
+    trip_sched_type = np.empty(n_entities, dtype=np.int8)
+
+    # stop level columns, one value per stop time update
+    entity_idx = np.empty(n_updates, dtype=np.int32)
+    stop_code = np.empty(n_updates, dtype=np.int32)
+    stop_sequence = np.empty(n_updates, dtype=np.int32)
+    stop_sched_type = np.empty(n_updates, dtype=np.int8)
+    has_arrival = np.empty(n_updates, dtype=bool)
+    has_departure = np.empty(n_updates, dtype=bool)
+    arrival_delay = np.empty(n_updates, dtype=np.int32)
+    departure_delay = np.empty(n_updates, dtype=np.int32)
+    arrival_time = np.empty(n_updates, dtype=np.int64)
+    departure_time = np.empty(n_updates, dtype=np.int64)
+
+    pos = 0
+    for i, entity in enumerate(entities):
+        trip_update = entity.trip_update
+        trip = trip_update.trip
+
+        entity_id[i] = entity.id
+        vehicle_id[i] = trip_update.vehicle.id
+        trip_code[i] = trip_ids.code(trip.trip_id)
+        route_code[i] = route_ids.code(trip.route_id)
+        start[i] = _start_timestamp(trip.start_date, trip.start_time)
+        trip_sched_type[i] = trip.schedule_relationship
+
+        if trip.schedule_relationship == Trip.Cancelled:
+            cancelled.append(trip.trip_id)
+
+        updates = trip_update.stop_time_update
+        entity_idx[pos:pos + len(updates)] = i
+
+        for update in updates:
+            arrival, departure = update.arrival, update.departure
+
+            stop_code[pos] = stop_ids.code(update.stop_id)
+            stop_sequence[pos] = update.stop_sequence
+            stop_sched_type[pos] = update.schedule_relationship
+            has_arrival[pos] = update.HasField('arrival')
+            has_departure[pos] = update.HasField('departure')
+            arrival_delay[pos] = arrival.delay
+            departure_delay[pos] = departure.delay
+            arrival_time[pos] = arrival.time
+            departure_time[pos] = departure.time
+            pos += 1
+
+    df = pd.DataFrame({
+        'id': entity_id[entity_idx],
+        'trip_id': trip_ids.categorical(trip_code[entity_idx]),
+        'route_id': route_ids.categorical(route_code[entity_idx]),
+        'vehicle_id': vehicle_id[entity_idx],
+        'start': start[entity_idx].astype('datetime64[s]'),
+        'trip_sched_type': trip_sched_type[entity_idx],
+
+        # stop specific items
+        'stop_id': stop_ids.categorical(stop_code),
+        'stop_sequence': stop_sequence,
+        'stop_sched_type': stop_sched_type,
+        'has_arrival': has_arrival,
+        'has_departure': has_departure,
+        'arrival_delay': arrival_delay,
+        'departure_delay': departure_delay,
+        'arrival_time': arrival_time,
+        'departure_time': departure_time
+    })
+
+    return df, cancelled
@@ -0,0 +1,356 @@
+"""The realtime store persists the realtime updates between polls of the
+TFI API. The API only sends updates for some of the trips each time, so
+a trip without an update in the latest feed keeps the delays from its
+last update, until that update is too old to be trusted."""
+
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .constants import Trip, Stop
+from .realtime_data import RealtimeData
+
+
+log = logging.getLogger(__name__)
+
+
+# the number of seconds the delays for a trip are kept after the last
+# feed that contained an update for that trip.
+DELAY_MAX_AGE = 2 * 3600
+
+# cancellations are kept for a day, added trips for an hour, the
+# same as the original implementation.
+CANCELLATION_MAX_AGE = 24 * 3600
+ADDITION_MAX_AGE = 3600
+
+# some updates contain delays that are approximately equal to the timestamp,
+# but negative, which is presumed to be a bug in the NTA code. Delays
+# greater than a week early are ignored.
+MIN_DELAY = -7 * 86400
+
+
+class TripDelays(NamedTuple):
+    """The stop time updates for one scheduled trip, sorted by stop sequence."""
+
+    timestamp: int
+    stop_sequence: np.ndarray
+    delay: np.ndarray   # seconds, NaN where only an absolute time was given
+    time: np.ndarray    # unix timestamp of the departure, 0 where not given
+
+
+class AddedTrip(NamedTuple):
+    """The stops of a trip added to the schedule by the realtime feed."""
+
+    timestamp: int
+    route_id: str
+    stop_id: np.ndarray
+    time: np.ndarray    # unix timestamp of the departure
+
+
+class RealtimeSnapshot:
+    """A read-only, flattened view of the realtime store for vectorized lookups.
+    The delays of all trips are in contiguous arrays sorted by a composite
+    key of (trip rank, stop sequence)."""
+
+    def __init__(self, generation: int, timestamp: int, trip_ids: pd.Index,
+                 keys: np.ndarray, delays: np.ndarray, times: np.ndarray,
+                 cancelled: pd.Index, added: pd.DataFrame):
+
+        self._generation = generation
+        self._timestamp = timestamp
+        self._trip_ids = trip_ids
+        self._keys = keys
+        self._delays = delays
+        self._times = times
+        self._cancelled = cancelled
+        self._added = added
+
+        # a query only looks up a few trips and stops, which is much cheaper
+        # with dicts than with the indexes, so they're built once here.
+        self._trip_ranks = dict(zip(trip_ids.tolist(), range(len(trip_ids))))
+        self._cancelled_ids = frozenset(cancelled.tolist())
+        self._added_columns = {name: added[name].to_numpy() for name in added.columns}
+        self._added_rows: Dict[str, List[int]] = {}
+        for row, stop_id in enumerate(self._added_columns['stop_id'].tolist()):
+            self._added_rows.setdefault(stop_id, []).append(row)
+
+    @classmethod
+    def empty(cls):
+        return cls(0, 0, pd.Index([], dtype=str), np.zeros(0, np.int64),
+                   np.zeros(0, np.float64), np.zeros(0, np.int64),
+                   pd.Index([], dtype=str), _empty_additions())
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]):
+        """Rebuild a snapshot from the arrays returned by `to_arrays()`."""
+
+        return cls(int(arrays['generation']), int(arrays['timestamp']),
+                   pd.Index(arrays['trip_ids'], dtype=str), arrays['keys'],
+                   arrays['delays'], arrays['times'],
+                   pd.Index(arrays['cancelled'], dtype=str),
+                   pd.DataFrame({'trip_id': pd.Series(arrays['added_trip_id'], dtype=str),
+                                 'route_id': pd.Series(arrays['added_route_id'], dtype=str),
+                                 'stop_id': pd.Series(arrays['added_stop_id'], dtype=str),
+                                 'time': arrays['added_time']}))
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """Flatten the snapshot into plain numpy arrays, with strings as
+        fixed width unicode arrays, so it can be shared without pickling."""
+
+        return {'generation': np.int64(self._generation),
+                'timestamp': np.int64(self._timestamp),
+                'trip_ids': np.asarray(self._trip_ids, dtype=str),
+                'keys': self._keys, 'delays': self._delays, 'times': self._times,
+                'cancelled': np.asarray(self._cancelled, dtype=str),
+                'added_trip_id': np.asarray(self._added.trip_id, dtype=str),
+                'added_route_id': np.asarray(self._added.route_id, dtype=str),
+                'added_stop_id': np.asarray(self._added.stop_id, dtype=str),
+                'added_time': self._added.time.to_numpy(np.int64)}
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def timestamp(self) -> int:
+        return self._timestamp
+
+    @property
+    def added(self) -> pd.DataFrame:
+        return self._added
+
+    def departure_delays(self, trip_ids: np.ndarray,
+                         stop_sequences: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the delay and the absolute departure time for each trip at
+        the given stop sequence. Where the stop has no update of its own, the
+        delay from the nearest earlier stop on that trip is used. Missing
+        delays are NaN, missing absolute times are 0."""
+
+        if len(self._keys) == 0:
+            return np.full(len(trip_ids), np.nan), np.zeros(len(trip_ids), np.int64)
+
+        ranks = self._trip_ranks
+        rank = np.fromiter((ranks.get(trip_id, -1) for trip_id in trip_ids.tolist()),
+                           dtype=np.int64, count=len(trip_ids))
+        query = _composite_key(rank, stop_sequences)
+
+        pos = np.clip(np.searchsorted(self._keys, query, side='right') - 1, 0, None)
+        found = (rank >= 0) & ((self._keys[pos] >> 32) == rank) & (self._keys[pos] <= query)
+
+        delays = np.where(found, self._delays[pos], np.nan)
+
+        # an absolute time is only valid for the stop it was given for
+        exact = found & (self._keys[pos] == query)
+        times = np.where(exact, self._times[pos], 0)
+
+        return delays, times
+
+    def is_cancelled(self, trip_ids: np.ndarray) -> np.ndarray:
+        cancelled = self._cancelled_ids
+        return np.fromiter((trip_id in cancelled for trip_id in trip_ids.tolist()),
+                           dtype=bool, count=len(trip_ids))
+
+    def added_at_stop(self, stop_id: str) -> pd.DataFrame:
+        return self._added[self._added.stop_id.eq(stop_id)]
+
+    def added_at_stops(self, stop_ids: Iterable[str]) -> Dict[str, np.ndarray]:
+        """The columns of the added trips calling at any of the stops,
+        in the same order as `added`."""
+
+        rows = sorted(row for stop_id in set(stop_ids)
+                          for row in self._added_rows.get(stop_id, ()))
+        return {name: column[rows] for name, column in self._added_columns.items()}
+
+
+class RealtimeStore:
+    """Persistent realtime state, upserted with each new realtime feed.
+
+    The stop time updates are stored per trip, so merging a feed only touches
+    the trips in that feed. Each dict is kept in order of the last update, so
+    expiring old entries only looks at the entries being removed."""
+
+    def __init__(self):
+        self._delays: Dict[str, TripDelays] = {}
+        self._cancelled: Dict[str, int] = {}
+        self._added: Dict[str, AddedTrip] = {}
+
+        self._timestamp = 0
+        self._generation = 0
+
+        self._snapshot: Optional[RealtimeSnapshot] = None
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        """Incremented each time a feed is merged into the store."""
+        return self._generation
+
+    @property
+    def timestamp(self) -> int:
+        """The timestamp of the latest feed merged into the store."""
+        return self._timestamp
+
+    def __len__(self):
+        return len(self._delays)
+
+    def merge(self, realtime_data: RealtimeData):
+        """Upsert the trip updates from a new realtime feed into the store,
+        then expire anything that has become too old."""
+
+        timestamp = realtime_data.timestamp
+        df = realtime_data.dataframe
+
+        with self._lock:
+            if not df.empty:
+                self._merge_scheduled(df[df.trip_sched_type.eq(Trip.Scheduled) &
+                                         df.stop_sched_type.eq(Stop.Scheduled)], timestamp)
+                self._merge_added(df[df.trip_sched_type.eq(Trip.Added) &
+                                     df.stop_sched_type.eq(Stop.Scheduled)], timestamp)
+
+            for trip_id in realtime_data.cancelled_trip_ids:
+                self._cancelled.pop(trip_id, None)
+                self._cancelled[trip_id] = timestamp
+
+            self._timestamp = max(self._timestamp, timestamp)
+            self._expire()
+
+            self._generation += 1
+            self._snapshot = None
+
+        log.debug(f'Realtime store has {len(self._delays)} trips, {len(self._cancelled)} '
+                  f'cancellations and {len(self._added)} added trips')
+
+    def _merge_scheduled(self, df: pd.DataFrame, timestamp: int):
+        """Replace the stop time updates for every scheduled trip in the feed."""
+
+        time = np.where(df.departure_time.to_numpy() > 0,
+                        df.departure_time.to_numpy(), df.arrival_time.to_numpy())
+        # updates for the last stop often only have an arrival, its delay is
+        # used when there's no departure, and no delay was given without either.
+        has_departure, has_arrival = df.has_departure.to_numpy(), df.has_arrival.to_numpy()
+        delay = np.where(has_departure, df.departure_delay.to_numpy(),
+                         df.arrival_delay.to_numpy()).astype(np.float64)
+        delay[~has_departure & ~has_arrival] = np.nan
+
+        # a delay of zero alongside an absolute time means no delay was given
+        delay[(time > 0) & (delay == 0)] = np.nan
+
+        keep = ~(delay < MIN_DELAY)
+        df, time, delay = df[keep], time[keep], delay[keep]
+
+        order = np.argsort(df.stop_sequence.to_numpy(), kind='stable')
+        order = order[np.argsort(df.trip_id.to_numpy()[order], kind='stable')]
+
+        trip_ids = df.trip_id.to_numpy()[order]
+        stop_sequence = df.stop_sequence.to_numpy().astype(np.int64)[order]
+        delay, time = delay[order], time[order].astype(np.int64)
+
+        splits = np.flatnonzero(trip_ids[1:] != trip_ids[:-1]) + 1
+        starts = np.concatenate([[0], splits]) if len(trip_ids) else []
+
+        updates = zip(np.split(stop_sequence, splits), np.split(delay, splits),
+                      np.split(time, splits))
+        _upsert(self._delays, trip_ids[starts],
+                (TripDelays(timestamp, *u) for u in updates))
+
+    def _merge_added(self, df: pd.DataFrame, timestamp: int):
+        """Replace the stops for every added trip in the feed. Added trips are
+        only usable if they come with the expected departure time."""
+
+        time = np.where(df.departure_time.to_numpy() > 0,
+                        df.departure_time.to_numpy(), df.arrival_time.to_numpy())
+        df = df[time > 0].assign(time=time[time > 0])
+
+        trips = {trip_id: AddedTrip(timestamp, group.route_id.iloc[0],
+                                    group.stop_id.to_numpy(), group.time.to_numpy())
+                 for trip_id, group in df.groupby('trip_id', sort=False, observed=True)}
+        _upsert(self._added, list(trips), trips.values())
+
+    def _expire(self):
+        """Drop any entries older than their maximum age."""
+
+        _expire_oldest(self._delays, self._timestamp - DELAY_MAX_AGE)
+        _expire_oldest(self._added, self._timestamp - ADDITION_MAX_AGE)
+        _expire_oldest(self._cancelled, self._timestamp - CANCELLATION_MAX_AGE,
+                       timestamp_of=lambda ts: ts)
+
+    def snapshot(self) -> RealtimeSnapshot:
+        """Return a flattened view of the store for the current generation,
+        building it if the store has changed since the last snapshot."""
+
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._build_snapshot()
+            return self._snapshot
+
+    def _build_snapshot(self) -> RealtimeSnapshot:
+        if not self._delays and not self._cancelled and not self._added:
+            return RealtimeSnapshot.empty()
+
+        trip_ids = pd.Index(list(self._delays.keys()), dtype=str)
+        trip_delays = list(self._delays.values())
+        lengths = [len(t.stop_sequence) for t in trip_delays]
+
+        rank = np.repeat(np.arange(len(trip_delays)), lengths)
+        stop_sequence = _concat([t.stop_sequence for t in trip_delays], np.int64)
+
+        added = pd.DataFrame({
+            'trip_id': np.repeat(list(self._added.keys()),
+                                 [len(a.stop_id) for a in self._added.values()]),
+            'route_id': np.repeat([a.route_id for a in self._added.values()],
+                                  [len(a.stop_id) for a in self._added.values()]),
+            'stop_id': _concat([a.stop_id for a in self._added.values()], object),
+            'time': _concat([a.time for a in self._added.values()], np.int64)
+        }) if self._added else _empty_additions()
+
+        return RealtimeSnapshot(self._generation, self._timestamp, trip_ids,
+                                _composite_key(rank, stop_sequence),
+                                _concat([t.delay for t in trip_delays], np.float64),
+                                _concat([t.time for t in trip_delays], np.int64),
+                                pd.Index(list(self._cancelled.keys()), dtype=str),
+                                added)
+
+
+def _composite_key(rank: np.ndarray, stop_sequence: np.ndarray) -> np.ndarray:
+    """Combine the trip rank and stop sequence into one sortable key."""
+    return (rank.astype(np.int64) << 32) | stop_sequence.astype(np.int64)
+
+
+def _concat(arrays, dtype) -> np.ndarray:
+    return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype)
+
+
+def _upsert(d: dict, keys, values):
+    """Insert or replace the values, moving replaced keys to the end of the
+    dict so that the dict stays in order of the last update."""
+
+    keys = list(keys)
+    for key in keys:
+        d.pop(key, None)
+    d.update(zip(keys, values))
+
+
+def _expire_oldest(d: dict, cutoff: int, timestamp_of=lambda v: v.timestamp):
+    """Remove entries from the front of the dict, which holds the oldest
+    entries, until an entry newer than the cutoff is found."""
+
+    while d:
+        key = next(iter(d))
+        if timestamp_of(d[key]) >= cutoff:
+            break
+        del d[key]
+
+
+def _empty_additions() -> pd.DataFrame:
+    return pd.DataFrame({'trip_id': pd.Series(dtype=str),
+                         'route_id': pd.Series(dtype=str),
+                         'stop_id': pd.Series(dtype=str),
+                         'time': pd.Series(dtype=np.int64)})
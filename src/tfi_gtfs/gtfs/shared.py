@@ -0,0 +1,339 @@
+"""Sharing the GTFS data between the processes of a multi-process server.
+
+One process owns the download agents and publishes each update, the
+worker processes attach to it read-only. The static assets are shared
+through the memory mapped snapshot files, so every worker maps the same
+pages instead of holding its own copy. A small block of shared memory
+tells the workers which snapshot is current, and the merged realtime
+data is copied into a pair of shared memory buffers."""
+
+import os
+import logging
+import threading
+
+import numpy as np
+
+from typing import Dict, List, Optional, Tuple
+from multiprocessing import shared_memory
+
+from .gtfs import GTFS
+from .snapshot import find_snapshot
+from .static_assets import StaticAssets
+from .realtime_store import RealtimeSnapshot
+
+from .. import settings
+
+
+log = logging.getLogger(__name__)
+
+
+# the published values, each is guarded by its own generation counter.
+# The static generation is odd while the key is being written, and is
+# incremented again to an even number once the key is complete.
+STATIC_GENERATION = 0
+REALTIME_GENERATION = 1
+GENERATION_SLOTS = 2
+
+# the snapshot key of the static assets is stored after the generations.
+KEY_SIZE = 64
+
+# the realtime snapshot is double buffered, generation `n` is written to
+# buffer `n % 2` while the readers use the other buffer. Each buffer starts
+# with a table of (offset, ndim, length, itemsize) for each array.
+REALTIME_ARRAYS = [('generation', '<i8'), ('timestamp', '<i8'),
+                   ('trip_ids', '<U'), ('keys', '<i8'), ('delays', '<f8'),
+                   ('times', '<i8'), ('cancelled', '<U'),
+                   ('added_trip_id', '<U'), ('added_route_id', '<U'),
+                   ('added_stop_id', '<U'), ('added_time', '<i8')]
+TABLE_SIZE = len(REALTIME_ARRAYS) * 4 * 8
+
+# a realtime buffer that changes while it's read is read again, up to this
+# many times, before falling back to the last snapshot read.
+READ_ATTEMPTS = 3
+
+
+class SharedState:
+    """The shared memory between the publishing process and the workers.
+    Readers never take a lock, they retry if a generation changed while
+    they were reading the value it guards. The publishing process calls
+    `publish()` from the threads of both download agents and from the main
+    thread, so the writers are serialized by a lock."""
+
+    def __init__(self, shm: shared_memory.SharedMemory,
+                 buffers: List[shared_memory.SharedMemory], owner: bool):
+        self._shm = shm
+        self._buffers = buffers
+        self._owner = owner
+
+        self._generations = np.ndarray(GENERATION_SLOTS, dtype=np.int64, buffer=shm.buf)
+        self._key = np.ndarray(KEY_SIZE, dtype=np.uint8, buffer=shm.buf,
+                               offset=self._generations.nbytes)
+
+        self._published_key: Optional[str] = None
+        self._unpublished_key: Optional[str] = None
+        self._published_realtime = -1
+        self._last_realtime: Tuple[int, Optional[RealtimeSnapshot]] = (0, None)
+
+        # re-entrant, as `publish()` holds it while calling the other publishers
+        self._publish_lock = threading.RLock()
+
+    @classmethod
+    def create(cls, buffer_size: int = settings.REALTIME_BUFFER_SIZE):
+        """Create new shared memory, owned by this process. Each realtime
+        buffer is `buffer_size` bytes, pages that are never written to
+        don't use any memory."""
+
+        shm = shared_memory.SharedMemory(create=True, size=GENERATION_SLOTS * 8 + KEY_SIZE)
+        shm.buf[:] = bytes(shm.size)
+
+        buffers = [shared_memory.SharedMemory(name=f'{shm.name}_{n}', create=True,
+                                              size=buffer_size) for n in range(2)]
+        return cls(shm, buffers, owner=True)
+
+    @classmethod
+    def attach(cls, name: str):
+        """Attach to the shared memory created by another process."""
+
+        return cls(shared_memory.SharedMemory(name=name),
+                   [shared_memory.SharedMemory(name=f'{name}_{n}') for n in range(2)],
+                   owner=False)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def close(self):
+        """Detach from the shared memory, the owner also destroys it."""
+
+        del self._generations, self._key
+        for shm in [self._shm, *self._buffers]:
+            shm.close()
+            if self._owner:
+                shm.unlink()
+
+    def generation(self, slot: int) -> int:
+        return int(self._generations[slot])
+
+    def publish(self, gtfs: GTFS):
+        """Publish any changes to the static assets or realtime data. This
+        is registered as an update callback on the publishing GTFS instance."""
+
+        with self._publish_lock:
+            self._publish(gtfs)
+
+    def _publish(self, gtfs: GTFS):
+        static_assets = gtfs.static_assets
+        if static_assets is not None and static_assets.key != self._published_key:
+            # the workers can only load static assets with a snapshot, if it
+            # couldn't be written they keep using the previous snapshot.
+            if static_assets.snapshot_path is not None:
+                self.publish_static_assets(static_assets.key)
+            elif static_assets.key != self._unpublished_key:
+                log.error(f'The static assets {static_assets.key} have no snapshot, so they '
+                          f'can\'t be published, the workers keep using the previous ones')
+                self._unpublished_key = static_assets.key
+
+        snapshot = gtfs.realtime_snapshot
+        if snapshot.generation != self._published_realtime:
+            self.publish_realtime(snapshot)
+
+    def publish_static_assets(self, key: str):
+        """Publish the key of the static asset snapshot the workers should use."""
+
+        encoded = key.encode('ascii')
+        if len(encoded) > KEY_SIZE:
+            raise ValueError(f'snapshot key is longer than {KEY_SIZE} bytes')
+
+        with self._publish_lock:
+            self._generations[STATIC_GENERATION] += 1
+            self._key[:] = 0
+            self._key[:len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+            self._generations[STATIC_GENERATION] += 1
+
+            self._published_key = key
+        log.info(f'Published static asset snapshot {key}')
+
+    def read_static_assets(self) -> Tuple[int, Optional[str]]:
+        """Return the generation and key of the published static asset
+        snapshot. The key is None if nothing has been published yet."""
+
+        while True:
+            generation = self.generation(STATIC_GENERATION)
+            if generation % 2:
+                continue
+
+            key = self._key.tobytes().rstrip(b'\x00').decode('ascii')
+            if generation == self.generation(STATIC_GENERATION):
+                return generation, key or None
+
+    def publish_realtime(self, snapshot: RealtimeSnapshot):
+        """Write the merged realtime snapshot to the buffer the readers aren't
+        using, then publish it by incrementing the generation."""
+
+        with self._publish_lock:
+            generation = self.generation(REALTIME_GENERATION) + 1
+            buffer = self._buffers[generation % 2]
+
+            arrays = snapshot.to_arrays()
+            size = TABLE_SIZE + sum(_aligned(arrays[name].nbytes)
+                                    for name, _ in REALTIME_ARRAYS)
+            if size > buffer.size:
+                log.error(f'The realtime snapshot needs {size} bytes, but the shared buffer '
+                          f'is {buffer.size} bytes, increase REALTIME_BUFFER_SIZE')
+                return
+
+            _write_arrays(buffer.buf, arrays)
+            self._generations[REALTIME_GENERATION] = generation
+
+            self._published_realtime = snapshot.generation
+
+    def read_realtime(self) -> Tuple[int, Optional[RealtimeSnapshot]]:
+        """Return the generation and a copy of the published realtime snapshot,
+        which is None if nothing has been published yet. If the buffer keeps
+        changing while it's read, the last snapshot read is returned instead."""
+
+        for _ in range(READ_ATTEMPTS):
+            generation = self.generation(REALTIME_GENERATION)
+            if generation == 0:
+                return generation, None
+
+            # a buffer overwritten while it's read can have torn offsets and
+            # lengths, so failing to decode it is the same as a new generation.
+            try:
+                arrays = _read_arrays(self._buffers[generation % 2].buf)
+                snapshot = RealtimeSnapshot.from_arrays(arrays)
+            except Exception:
+                log.debug(f'Unable to decode realtime generation {generation}, retrying', exc_info=True)
+                continue
+
+            # the buffer is only written to again after the next generation
+            # has been published, so an unchanged generation means the copy is good.
+            if generation == self.generation(REALTIME_GENERATION):
+                self._last_realtime = (generation, snapshot)
+                return generation, snapshot
+
+        log.warning(f'Unable to read the realtime data after {READ_ATTEMPTS} attempts, '
+                    f'using generation {self._last_realtime[0]}')
+        return self._last_realtime
+
+
+def _aligned(nbytes: int) -> int:
+    return (nbytes + 7) // 8 * 8
+
+
+def _write_arrays(buf, arrays: Dict[str, np.ndarray]):
+    """Write the arrays after a table of their offsets and shapes."""
+
+    table = np.ndarray((len(REALTIME_ARRAYS), 4), dtype=np.int64, buffer=buf)
+    offset = TABLE_SIZE
+
+    for n, (name, _) in enumerate(REALTIME_ARRAYS):
+        array = np.asarray(arrays[name])
+        table[n] = offset, array.ndim, array.size, array.itemsize
+
+        np.ndarray(array.shape, dtype=array.dtype, buffer=buf, offset=offset)[...] = array
+        offset += _aligned(array.nbytes)
+
+
+def _read_arrays(buf) -> Dict[str, np.ndarray]:
+    """Copy the arrays written by `_write_arrays()` out of the buffer."""
+
+    table = np.ndarray((len(REALTIME_ARRAYS), 4), dtype=np.int64, buffer=buf).copy()
+    arrays = {}
+
+    for (name, dtype), (offset, ndim, size, itemsize) in zip(REALTIME_ARRAYS, table):
+        # numpy doesn't check the offset, a torn table could point the
+        # array anywhere in memory, so the table is checked first.
+        if not (TABLE_SIZE <= offset and 0 <= size and ndim in (0, 1) and itemsize > 0
+                and offset + size * itemsize <= len(buf)):
+            raise ValueError(f'invalid realtime buffer table entry for {name}')
+
+        dtype = np.dtype(f'{dtype}{itemsize // 4}' if dtype == '<U' else dtype)
+        if dtype.itemsize != itemsize:
+            raise ValueError(f'invalid realtime buffer item size for {name}')
+
+        shape = (int(size),) if ndim else ()
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=buf, offset=int(offset)).copy()
+
+    return arrays
+
+
+class WorkerGTFS(GTFS):
+    """A version of the GTFS class for the worker processes of a multi-process
+    server. It has no download agents, it uses the static asset snapshot and
+    the realtime data published by the process that owns the agents."""
+
+    def __init__(self, shared_state: SharedState, snapshot_dir: str):
+
+        GTFS.__init__(self, '', '', api_key_check=False, snapshot_dir=snapshot_dir)
+
+        self._shared = shared_state
+        self._published_static = 0
+
+        # the generation and snapshot are swapped together as one tuple.
+        self._realtime = (0, RealtimeSnapshot.empty())
+
+        self._refresh_static_assets()
+
+        if self._static_assets is not None:
+            self._data_available.set()
+
+    def _create_download_agents(self, *args):
+        pass
+
+    @property
+    def static_assets(self) -> StaticAssets:
+        if self._shared.generation(STATIC_GENERATION) != self._published_static:
+            self._refresh_static_assets()
+        return self._static_assets
+
+    @property
+    def static_asset_generation(self) -> int:
+        return self._shared.generation(STATIC_GENERATION)
+
+    @property
+    def realtime_generation(self) -> int:
+        return self._shared.generation(REALTIME_GENERATION)
+
+    @property
+    def realtime_snapshot(self) -> RealtimeSnapshot:
+        """The latest published realtime snapshot. This takes no locks, when a
+        new generation is published, the first request to see it copies it
+        out of the shared buffer and swaps it in."""
+
+        generation, snapshot = self._realtime
+        if self._shared.generation(REALTIME_GENERATION) == generation:
+            return snapshot
+
+        generation, published = self._shared.read_realtime()
+        if published is None:
+            return snapshot
+
+        self._realtime = (generation, published)
+        return published
+
+    def _refresh_static_assets(self):
+        """Attach to the published static asset snapshot, if it has changed."""
+
+        with self._static_lock:
+            generation, key = self._shared.read_static_assets()
+            if generation == self._published_static or key is None:
+                return
+
+            # a snapshot that can't be loaded isn't retried until the next
+            # one is published, the worker keeps using the previous one.
+            self._published_static = generation
+
+            path = find_snapshot(self._snapshot_dir, key)
+            if path is None:
+                log.error(f'The published static asset snapshot {key} does not exist')
+                return
+
+            try:
+                static_assets = StaticAssets.from_snapshot(path)
+            except Exception:
+                log.error(f'Unable to load the static asset snapshot {path}\n', exc_info=True)
+                return
+
+            log.info(f'Worker {os.getpid()} is using static asset snapshot {key}')
+            self._swap_static_assets(static_assets)
@@ -0,0 +1,192 @@
+"""A snapshot is a columnar copy of the parsed static assets on disk, so a
+restart doesn't need to parse the GTFS zip again. Each column is saved as
+a .npy file and memory mapped when the snapshot is read back. String
+columns are stored as integer codes, with the unique values alongside."""
+
+import os
+import json
+import mmap
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from typing import Dict, Iterable, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+
+
+# increment this whenever the tables or arrays in a snapshot change,
+# so snapshots written by an older version are ignored.
+SNAPSHOT_VERSION = 4
+
+MANIFEST = 'manifest.json'
+
+# the name used to store the index of a table alongside its columns.
+INDEX_COLUMN = '__index__'
+
+
+def snapshot_key(zip_file, filter_stops: Optional[Iterable[int]] = None) -> str:
+    """The key of the snapshot for a GTFS zip file, based on its contents and
+    the stops it's filtered to, if any. The zip file can be bytes, a path,
+    or a binary file object such as an mmap."""
+
+    if isinstance(zip_file, (str, os.PathLike)):
+        with open(zip_file, 'rb') as f:
+            digest = hashlib.file_digest(f, 'sha256')
+    elif isinstance(zip_file, (bytes, bytearray, memoryview, mmap.mmap)):
+        digest = hashlib.sha256(zip_file)
+    else:
+        zip_file.seek(0)
+        digest = hashlib.file_digest(zip_file, 'sha256')
+        zip_file.seek(0)
+
+    if filter_stops:
+        digest.update(','.join(map(str, sorted(filter_stops))).encode())
+
+    return digest.hexdigest()[:32]
+
+
+def snapshot_path(directory: str, key: str) -> str:
+    return os.path.join(directory, f'v{SNAPSHOT_VERSION}-{key}')
+
+
+def find_snapshot(directory: str, key: Optional[str] = None) -> Optional[str]:
+    """Return the path of the snapshot with the given key, or of the latest
+    snapshot if no key is given. None is returned if there's no snapshot."""
+
+    if key is not None:
+        path = snapshot_path(directory, key)
+        return path if os.path.isfile(os.path.join(path, MANIFEST)) else None
+
+    if not os.path.isdir(directory):
+        return None
+
+    candidates = [os.path.join(directory, d) for d in os.listdir(directory)
+                  if d.startswith(f'v{SNAPSHOT_VERSION}-')]
+    candidates = [d for d in candidates if os.path.isfile(os.path.join(d, MANIFEST))]
+
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+
+def write_snapshot(directory: str, key: str, tables: Dict[str, pd.DataFrame],
+                   arrays: Dict[str, np.ndarray], meta: dict) -> str:
+    """Write the tables and arrays to a new snapshot directory. The snapshot is
+    written to a temporary directory first and renamed, so a reader never sees
+    a half written snapshot. Any older snapshots are removed."""
+
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(directory, key)
+    tmp_path = tempfile.mkdtemp(dir=directory, prefix='.tmp-')
+
+    try:
+        manifest = {'version': SNAPSHOT_VERSION, 'key': key, 'meta': meta,
+                    'tables': {name: _write_table(tmp_path, name, df)
+                               for name, df in tables.items()},
+                    'arrays': list(arrays)}
+
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+
+        with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    _remove_old_snapshots(directory, keep=path)
+    log.info(f'Wrote static asset snapshot to {path}')
+
+    return path
+
+
+def read_snapshot(path: str) -> Tuple[Dict[str, pd.DataFrame], Dict[str, np.ndarray], dict]:
+    """Read the tables, arrays and metadata from a snapshot directory, with
+    the numeric columns memory mapped."""
+
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    if manifest['version'] != SNAPSHOT_VERSION:
+        raise ValueError(f'snapshot version {manifest["version"]} is not supported')
+
+    tables = {name: _read_table(path, name, table)
+              for name, table in manifest['tables'].items()}
+    arrays = {name: _load_array(os.path.join(path, f'{name}.npy'))
+              for name in manifest['arrays']}
+
+    return tables, arrays, manifest['meta']
+
+
+def _write_table(path: str, table_name: str, df: pd.DataFrame) -> dict:
+    """Save each column of the table, returning the description of the
+    columns for the manifest."""
+
+    columns = {INDEX_COLUMN: df.index.to_series(), **dict(df.items())}
+    description = {'index_name': df.index.name, 'columns': []}
+
+    for n, (name, column) in enumerate(columns.items()):
+        file_stem = os.path.join(path, f'{table_name}.{n}')
+        kind = _write_column(file_stem, column)
+        description['columns'].append({'name': name, 'kind': kind,
+                                       'dtype': str(column.dtype)})
+
+    return description
+
+
+def _write_column(file_stem: str, column: pd.Series) -> str:
+    """Save one column, strings are saved as codes and their unique values."""
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes, uniques = column.cat.codes.to_numpy(), column.cat.categories
+    elif column.dtype.kind in 'biufmM':
+        np.save(f'{file_stem}.npy', column.to_numpy())
+        return 'array'
+    else:
+        codes, uniques = pd.factorize(column, use_na_sentinel=True)
+
+    np.save(f'{file_stem}.npy', codes)
+    np.save(f'{file_stem}.uniques.npy', np.asarray(uniques, dtype=str))
+    return 'categorical' if isinstance(column.dtype, pd.CategoricalDtype) else 'factorized'
+
+
+def _read_table(path: str, table_name: str, table: dict) -> pd.DataFrame:
+
+    columns = {}
+    for n, column in enumerate(table['columns']):
+        columns[column['name']] = _read_column(os.path.join(path, f'{table_name}.{n}'),
+                                               column['kind'], column['dtype'])
+
+    index = pd.Index(columns.pop(INDEX_COLUMN), name=table['index_name'])
+    return pd.DataFrame(columns, index=index, copy=False)
+
+
+def _read_column(file_stem: str, kind: str, dtype: str):
+
+    values = _load_array(f'{file_stem}.npy')
+    if kind == 'array':
+        return values
+
+    categorical = pd.Categorical.from_codes(values, np.load(f'{file_stem}.uniques.npy'))
+    return categorical if kind == 'categorical' else pd.Series(categorical).astype(dtype).array
+
+
+def _load_array(path: str) -> np.ndarray:
+    """Memory map the array read-only, as a plain ndarray view of the file."""
+    return np.load(path, mmap_mode='r').view(np.ndarray)
+
+
+def _remove_old_snapshots(directory: str, keep: str):
+    """Remove all snapshots except the one being kept."""
+
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path != keep and name.startswith('v') and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
@@ -1,13 +1,27 @@
 
 import io
+import os
+import mmap
+import logging
 import zipfile
+import datetime
 
+import pytz
 import numpy as np
 import pandas as pd
-from typing import Optional
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union, BinaryIO
 
-from .utils import timed_function, OnSchedule
-from .calendar_tools import build_service_calendar, now
+from .utils import timed_function, OnSchedule, peak_memory_usage, format_bytes
+from .departure_index import DepartureIndex, NO_DEPARTURE_TIME, SECONDS_PER_DAY, ranges_to_rows
+from .trip_metadata import build_trip_metadata
+from .calendar_tools import build_service_calendar, build_service_bitmask, ServiceCalendar, now
+from .snapshot import snapshot_key, find_snapshot, read_snapshot, write_snapshot
+from .parallel_loader import parallel_load
+
+from .. import settings
+
+
+log = logging.getLogger(__name__)
 
 # these are day offsets from today, the static schedule will only be
 # calculated for this period of time.
@@ -15,6 +29,27 @@ SCHEDULE_START = -2
 SCHEDULE_END = 7
 SCHEDULE_REFRESH = 1   # refresh the schedule every day
 
+# the tables and index arrays saved in a snapshot of the static assets.
+SNAPSHOT_TABLES = ['agencies', 'routes', 'calendar', 'calendar_exceptions',
+                   'stops', 'stop_times', 'trips']
+SNAPSHOT_ARRAYS = ['offsets', 'keys', 'trip_codes', 'stop_sequence']
+
+# the trip metadata is saved too, so the worker processes map it rather than
+# each building their own. Its trip IDs are the categories of the stop times,
+# so they're left out, and they're also saved as a fixed width array, which
+# is mapped too, where an object array would be a copy in each process.
+# The service calendar isn't saved, it's built from today's date and rebuilt
+# every day, and it's only a few bytes per service. Nor are the lookups of
+# the route, headsign and agency names, which are Python strings, and small.
+TRIP_METADATA_SNAPSHOT = 'trip_metadata'
+
+# the tables that must have rows for the static assets to be usable.
+REQUIRED_TABLES = ['agencies', 'routes', 'stops', 'stop_times', 'trips']
+
+# the GTFS zip file can be loaded from bytes, a path, or a binary file
+# object such as an mmap.
+ZipSource = Union[bytes, str, os.PathLike, BinaryIO]
+
 class StaticAssets:
     """A container to open and parse the static assets from TFI."""
 
@@ -22,10 +57,28 @@ class StaticAssets:
     def from_file(cls, path):
         """Create an instance of StaticAssets from a file on disk."""
 
-        with open(path, 'rb') as f:
-            return cls(f.read())
+        return cls(path)
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """Create an instance of StaticAssets from a snapshot directory."""
+
+        sa = cls()
+        try:
+            sa.load_snapshot(path)
+        except Exception:
+            sa.close()
+            raise
+        return sa
+
+    def __init__(self, gtfs_zip_file: Optional[ZipSource] = None,
+                 workers: int = settings.PARSE_WORKERS,
+                 filter_stops: Optional[Iterable[int]] = None):
+        self._key: Optional[str] = None
+        self._snapshot_path: Optional[str] = None
+        self._filter_stops: Optional[List[int]] = None
+        self._realtime_filter: Optional[Tuple[Set[str], Set[str]]] = None
 
-    def __init__(self, gtfs_zip_file_bytes: bytes):
         self._agencies: Optional[pd.DataFrame] = None
         self._routes: Optional[pd.DataFrame] = None
         self._calendar: Optional[pd.DataFrame] = None
@@ -34,51 +87,229 @@ class StaticAssets:
         self._stop_times: Optional[pd.DataFrame] = None
         self._trips: Optional[pd.DataFrame] = None
 
-        self._stop_times_by_id: Optional[pd.DataFrame] = None
+        self._departure_index: Optional[DepartureIndex] = None
+        self._trips_by_id: Optional[pd.DataFrame] = None
+        self._trip_rows: Optional[np.ndarray] = None
+        self._trip_metadata: Optional[pd.DataFrame] = None
+        self._trip_ids: Optional[np.ndarray] = None
+        self._trip_values: Optional[Dict[str, np.ndarray]] = None
+        self._trip_columns: Optional[Dict[str, np.ndarray]] = None
+        self._stop_lookup: Optional[Dict[int, int]] = None
+        self._stop_columns: Optional[Dict[str, np.ndarray]] = None
+        self._route_lookup: Optional[Dict[str, Tuple[str, str]]] = None
 
         self._timezone: Optional[str] = None
 
-        self._expanded_calendar: Optional[pd.DataFrame] = None
+        self._service_calendar: Optional[ServiceCalendar] = None
         self._cal_refresh = OnSchedule(self._build_expanded_calendar,
                                        every=86400 * SCHEDULE_REFRESH)
 
-        self.load_content(gtfs_zip_file_bytes)
+        # the calendar refresh thread holds a reference to this instance,
+        # so it has to be stopped if loading fails, or neither is freed.
+        if gtfs_zip_file is not None:
+            try:
+                self.load_content(gtfs_zip_file, workers, filter_stops)
+            except Exception:
+                self.close()
+                raise
 
     def __del__(self):
         self._cal_refresh.stop()
 
+    def close(self):
+        """Stop the calendar refresh thread and release the tables and indexes,
+        unmapping them if they were loaded from a snapshot. The instance can't
+        be used afterwards."""
+
+        self._cal_refresh.stop()
+
+        for name in SNAPSHOT_TABLES:
+            setattr(self, f'_{name}', None)
+
+        self._departure_index = None
+        self._trips_by_id = None
+        self._trip_rows = None
+        self._trip_metadata = None
+        self._trip_ids = None
+        self._trip_values = None
+        self._trip_columns = None
+        self._stop_lookup = None
+        self._stop_columns = None
+        self._route_lookup = None
+        self._service_calendar = None
+
+    @timed_function
+    def load_content(self, gtfs_zip_file: ZipSource, workers: int = settings.PARSE_WORKERS,
+                     filter_stops: Optional[Iterable[int]] = None):
+        """Parse all data from the zipped static asset file. A path or file
+        object is read from as needed, rather than read into memory. A zip
+        file given as a path is parsed by a pool of `workers` processes. If
+        `filter_stops` is given, only the data for those stop numbers is kept."""
+
+        self._filter_stops = sorted(filter_stops) if filter_stops else None
+        self._key = snapshot_key(gtfs_zip_file, self._filter_stops)
+
+        if workers > 1 and isinstance(gtfs_zip_file, (str, os.PathLike)):
+            tables = parallel_load(os.fspath(gtfs_zip_file), TABLE_LOADERS,
+                                   {'stop_times': ('stop_times.txt', parse_stop_times)},
+                                   workers)
+        else:
+            if isinstance(gtfs_zip_file, (bytes, bytearray)):
+                gtfs_zip_file = io.BytesIO(gtfs_zip_file)
+            elif isinstance(gtfs_zip_file, mmap.mmap):
+                gtfs_zip_file = _MmapFile(gtfs_zip_file)
+            with zipfile.ZipFile(gtfs_zip_file) as zf:
+                tables = {name: loader(zf) for name, loader in TABLE_LOADERS.items()}
+                tables['stop_times'] = load_stop_times(zf)
+
+        if self._filter_stops:
+            tables = filter_tables(tables, self._filter_stops)
+
+        for name in SNAPSHOT_TABLES:
+            setattr(self, f'_{name}', tables[name])
+
+        self._departure_index = DepartureIndex.from_stop_times(self._stop_times)
+        self._index_trips()
+
+        # the row in the trips table for each trip code in the departure index
+        self._trip_rows = self._trips_by_id.index.get_indexer(
+                                    self._stop_times.trip_id.cat.categories)
+
+        self._load_complete()
+
     @timed_function
-    def load_content(self, gtfs_zip_file_bytes: bytes):
-        """Parse all data from the zipped static asset file."""
+    def load_snapshot(self, path: str):
+        """Load all data from a snapshot written by `save_snapshot()`,
+        the columns are memory mapped rather than read into memory."""
+
+        tables, arrays, meta = read_snapshot(path)
+        self._key = meta['key']
+        self._snapshot_path = path
+        self._filter_stops = meta.get('filter_stops')
+
+        for name in SNAPSHOT_TABLES:
+            setattr(self, f'_{name}', tables[name])
+
+        self._departure_index = DepartureIndex(*(arrays[name] for name in SNAPSHOT_ARRAYS))
+        self._trip_rows = arrays['trip_rows']
+        self._trip_ids = arrays['trip_ids']
+        self._index_trips()
+
+        trip_ids = self._stop_times.trip_id.cat.categories
+        self._trip_metadata = tables[TRIP_METADATA_SNAPSHOT]
+        self._trip_metadata.insert(0, 'trip_id', pd.Categorical.from_codes(
+                                                    np.arange(len(trip_ids)), trip_ids))
+
+        self._load_complete()
+
+    def save_snapshot(self, directory: str) -> str:
+        """Write the parsed tables and indexes to a snapshot in the directory,
+        returning the path of the snapshot."""
+
+        idx = self._departure_index
+        arrays = {name: getattr(idx, name) for name in SNAPSHOT_ARRAYS}
+        arrays['trip_rows'] = self._trip_rows
+        arrays['trip_ids'] = self._trip_ids
 
-        zip_buffer = io.BytesIO(gtfs_zip_file_bytes)
-        zf = zipfile.ZipFile(zip_buffer)
+        tables = {name: getattr(self, f'_{name}') for name in SNAPSHOT_TABLES}
+        tables[TRIP_METADATA_SNAPSHOT] = self._trip_metadata.drop(columns='trip_id')
 
-        self._agencies = load_agencies(zf)
-        self._routes = load_routes(zf)
-        self._calendar = load_calendar(zf)
-        self._calendar_exceptions = load_calendar_exceptions(zf)
-        self._stops = load_stops(zf)
-        self._stop_times = load_stop_times(zf)
-        self._trips = load_trips(zf)
+        return write_snapshot(directory, self._key, tables, arrays,
+                              meta={'key': self._key, 'filter_stops': self._filter_stops})
 
-        self._stop_times_by_id = self._stop_times.groupby('stop_id', observed=True)
+    def _index_trips(self):
+        self._trips_by_id = self._trips.set_index('trip_id')
+
+    def _load_complete(self):
+        """Finish loading, once the tables and indexes are available."""
 
         # to filter the dataset correctly, we need to know the local time,
         # for which we need to be timezone aware. Take the first timezone.
         self._timezone = self._agencies.agency_timezone.iloc[0]
 
-    def _build_expanded_calendar(self):
-        """This function rebuilds the expanded calendar."""
-
-        self._expanded_calendar = build_service_calendar(
-            self._calendar, self._calendar_exceptions,
-            start_offset=SCHEDULE_START, stop_offset=SCHEDULE_END)
+        # with a stop filter, realtime updates are only kept for the trips
+        # that remain, or for added trips calling at the filtered stops.
+        if self._filter_stops:
+            self._realtime_filter = (set(self._trips.trip_id.astype(str)),
+                                     set(self._stops.stop_id.astype(str)))
+
+        # the calendar refresh thread only runs after a day has passed,
+        # so the first version of the service calendar is built here.
+        self._build_expanded_calendar()
+
+        # the rows of the services don't change when the calendar is
+        # refreshed, they only depend on the calendar tables. A snapshot
+        # already has the trip metadata.
+        if self._trip_metadata is None:
+            trip_ids = self._stop_times.trip_id.cat.categories
+            self._trip_metadata = build_trip_metadata(
+                trip_ids, self._trip_rows, self._trips,
+                self._routes, self._agencies, self._service_calendar.service_ids)
+            self._trip_ids = np.asarray(trip_ids, dtype=str)
+
+        self._trip_values = {name: _category_values(self._trip_metadata[name])
+                             for name in ['route', 'headsign', 'agency']}
+
+        # a query only needs plain arrays, building DataFrames for a few rows
+        # costs far more than the lookups themselves.
+        self._trip_columns = {'service_row': self._trip_metadata.service_row.to_numpy()}
+        self._trip_columns.update({name: self._trip_metadata[name].cat.codes.to_numpy()
+                                   for name in self._trip_values})
+
+        # stops without a stop number share the NaN index, so only the first
+        # row of each stop number is used.
+        index = self._stops.index
+        first = np.flatnonzero(~index.duplicated() & index.notna())
+        self._stop_lookup = dict(zip(index[first].astype(np.int64).tolist(), first.tolist()))
+        self._stop_columns = {
+            'stop_number': np.where(index.notna(), index, -1).astype(np.int64),
+            'stop_id': self._stops.stop_id.to_numpy(dtype=object),
+            'stop_name': self._stops.stop_name.to_numpy(dtype=object),
+            'stop_code': self._stop_codes(self._stops.stop_id.to_numpy()),
+        }
+
+        agency_rows = self._agencies.index.get_indexer(self._routes.agency_id.to_numpy())
+        agency_names = np.append(self._agencies.agency_name.to_numpy(dtype=object), None)
+        self._route_lookup = dict(zip(self._routes.index.tolist(),
+                                      zip(self._routes.route_short_name.tolist(),
+                                          agency_names[agency_rows].tolist())))
+
+        # pandas builds the hash table of an index the first time it's used,
+        # so build the ones used by queries now, rather than have the threads
+        # serving the first requests build them at the same time.
+        for index in [self._stops.index, self._stop_times.stop_id.cat.categories,
+                      self._routes.index, self._agencies.index]:
+            index.is_unique
+
+    def validate(self):
+        """Check the parsed data is usable before it replaces the data being
+        served, raising a ValueError describing the first problem found."""
+
+        for name in REQUIRED_TABLES:
+            table = getattr(self, f'_{name}')
+            if table is None or table.empty:
+                raise ValueError(f'the {name} table is empty')
+
+        try:
+            pytz.timezone(self._timezone)
+        except pytz.UnknownTimeZoneError:
+            raise ValueError(f'unknown agency timezone: {self._timezone}') from None
+
+        idx = self._departure_index
+        timed = np.count_nonzero(self._stop_times.departure_time.to_numpy() != NO_DEPARTURE_TIME)
+        if len(idx) != timed or idx.offsets[-1] != len(idx):
+            raise ValueError('the departure index does not match the stop times')
+
+        if len(self._trip_rows) != len(self._stop_times.trip_id.cat.categories):
+            raise ValueError('the trip rows do not match the stop times')
+
+        if (self._trip_rows >= 0).sum() == 0:
+            raise ValueError('none of the stop times reference a known trip')
 
-    def _update_expanded_calendar(self):
-        """This function rebuilds the expanded calendar."""
+    def _build_expanded_calendar(self):
+        """This function rebuilds the service calendar bitmask."""
 
-        self._expanded_calendar = build_service_calendar(
+        self._service_calendar = build_service_bitmask(
             self._calendar, self._calendar_exceptions,
             start_offset=SCHEDULE_START, stop_offset=SCHEDULE_END)
 
@@ -91,8 +322,159 @@ class StaticAssets:
     def stop_number_to_id(self, stop_number: int):
         return self._stops.loc[stop_number].stop_id
 
-    def _stop_times_for_stop_number(self, stop_number: int) -> pd.DataFrame:
-        return self._stop_times_by_id.get_group(self.stop_number_to_id(stop_number))
+    def stop_details(self, stop_numbers: Iterable[int]) -> pd.DataFrame:
+        """The rows of the stops table for the stop numbers, in the order
+        given, leaving out any unknown or repeated stop numbers."""
+
+        return self._stops.iloc[self._stop_rows(stop_numbers)]
+
+    def stop_names(self, stop_numbers: Iterable[int]) -> Dict[int, str]:
+        """The names of the stops, in the order given, leaving out unknown stops."""
+
+        rows = self._stop_rows(stop_numbers)
+        return dict(zip(self._stop_columns['stop_number'][rows].tolist(),
+                        self._stop_columns['stop_name'][rows].tolist()))
+
+    def stop_ids(self, stop_numbers: Iterable[int]) -> Dict[int, str]:
+        """The stop IDs of the stops, in the order given, leaving out unknown stops."""
+
+        rows = self._stop_rows(stop_numbers)
+        return dict(zip(self._stop_columns['stop_number'][rows].tolist(),
+                        self._stop_columns['stop_id'][rows].tolist()))
+
+    def _stop_rows(self, stop_numbers: Iterable[int]) -> np.ndarray:
+        """The rows in the stops table of the stop numbers, in the order
+        given, leaving out any unknown or repeated stop numbers."""
+
+        lookup = self._stop_lookup
+        rows = (lookup.get(stop_number) for stop_number in dict.fromkeys(stop_numbers))
+        return np.array([row for row in rows if row is not None], dtype=np.int64)
+
+    def _stop_code(self, stop_number: int) -> int:
+        """The stop code in the departure index for the stop number,
+        or -1 if there are no stop times for that stop."""
+        return self._stop_codes(self.stop_details([stop_number]).stop_id.to_numpy())[0] \
+                   if self.stop_number_is_valid(stop_number) else -1
+
+    def _stop_codes(self, stop_ids: np.ndarray) -> np.ndarray:
+        """The stop code in the departure index of each stop ID, or -1 if
+        there are no stop times for that stop."""
+        return self._stop_times.stop_id.cat.categories.get_indexer(stop_ids)
+
+    def scheduled_departures(self, stop_number: int, start: datetime.datetime,
+                             end: datetime.datetime) -> pd.DataFrame:
+        """Return the departures from the given stop scheduled in the period
+        [start, end), sorted by departure time. `start` and `end` are naive
+        datetimes in local time."""
+
+        return self.scheduled_departures_for_stops([stop_number], start, end) \
+                   .drop(columns='stop_number')
+
+    def scheduled_departures_for_stops(self, stop_numbers: Iterable[int], start: datetime.datetime,
+                                       end: datetime.datetime) -> pd.DataFrame:
+        """Return the departures from all of the given stops scheduled in the
+        period [start, end), with a `stop_number` column. The departures are
+        sorted by stop, in the order given, and then by departure time. The
+        stops are looked up together, so the cost of many stops is close to
+        the cost of one."""
+
+        departures = self.departure_arrays(stop_numbers, start, end)
+        return pd.DataFrame(departures) if len(departures['stop_number']) \
+                   else _empty_departures()
+
+    def departure_arrays(self, stop_numbers: Iterable[int], start: datetime.datetime,
+                         end: datetime.datetime) -> Dict[str, np.ndarray]:
+        """The same as `scheduled_departures_for_stops()`, with the columns as
+        a dict of numpy arrays, which is much cheaper for a few departures."""
+
+        rows = self._stop_rows(stop_numbers)
+        stop_codes = self._stop_columns['stop_code'][rows]
+        has_times = stop_codes >= 0
+        stop_numbers = self._stop_columns['stop_number'][rows][has_times]
+        stop_ids = self._stop_columns['stop_id'][rows][has_times]
+        stop_codes = stop_codes[has_times]
+
+        # GTFS departure times are offsets from the start of the service day
+        # and can go past 24:00:00, so a trip departing just after midnight
+        # might belong to yesterday's service. Each service day that could
+        # overlap the window is a contiguous slice of the departure index,
+        # so each stop has one slice per day offset.
+        midnight = datetime.datetime.combine(start.date(), datetime.time())
+        start_secs = int((start - midnight).total_seconds())
+        end_secs = int((end - midnight).total_seconds())
+
+        idx = self._departure_index
+        day_offsets = np.tile([-1, 0, 1], len(stop_codes))
+        stop_positions = np.repeat(np.arange(len(stop_codes)), 3)
+
+        first, last = idx.windows(stop_codes[stop_positions],
+                                  start_secs - day_offsets * SECONDS_PER_DAY,
+                                  end_secs - day_offsets * SECONDS_PER_DAY)
+
+        rows = ranges_to_rows(first, last)
+        day_offset = np.repeat(day_offsets, last - first)
+        stop_position = np.repeat(stop_positions, last - first)
+
+        trip_codes = idx.trip_codes[rows]
+        service_dates = np.datetime64(start.date(), 'ns') + day_offset.astype('timedelta64[D]')
+
+        # only keep the trips whose service is running on that service day,
+        # this also drops any stop times that reference trips not in trips.txt
+        running = self._service_calendar.rows_running(
+                      self._trip_columns['service_row'][trip_codes], service_dates)
+        rows, trip_codes = rows[running], trip_codes[running]
+        service_dates, stop_position = service_dates[running], stop_position[running]
+
+        scheduled_departure = service_dates + idx.departure_secs[rows].astype('timedelta64[s]')
+        order = np.lexsort((scheduled_departure, stop_position))
+        rows, trip_codes, stop_position = rows[order], trip_codes[order], stop_position[order]
+
+        departures = {
+            'stop_number': stop_numbers[stop_position],
+            'trip_id': self._trip_ids[trip_codes],
+            'stop_id': stop_ids[stop_position],
+            'stop_sequence': idx.stop_sequence[rows],
+            'service_date': service_dates[order],
+            'scheduled_departure': scheduled_departure[order],
+        }
+        departures.update({name: lookup[self._trip_columns[name][trip_codes]]
+                           for name, lookup in self._trip_values.items()})
+        return departures
+
+    def route_details(self, route_ids: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the route short name and agency name for each route ID,
+        with None for unknown routes."""
+
+        details = [self._route_lookup.get(route_id, (None, None)) for route_id in route_ids]
+        route = np.array([route for route, _ in details], dtype=object)
+        agency = np.array([agency for _, agency in details], dtype=object)
+        return route, agency
+
+    @property
+    def key(self) -> Optional[str]:
+        """The key of the GTFS zip file these assets were loaded from."""
+        return self._key
+
+    @property
+    def snapshot_path(self) -> Optional[str]:
+        """The snapshot these assets were loaded from, or None if they were
+        parsed from the zip file."""
+        return self._snapshot_path
+
+    @property
+    def filter_stops(self) -> Optional[List[int]]:
+        """The stop numbers the assets are filtered to, or None."""
+        return self._filter_stops
+
+    @property
+    def realtime_filter(self) -> Optional[Tuple[Set[str], Set[str]]]:
+        """The trip IDs and stop IDs realtime updates should be filtered
+        to, or None if the assets aren't filtered."""
+        return self._realtime_filter
+
+    @property
+    def timezone(self) -> str:
+        return self._timezone
 
     @property
     def agencies(self) -> pd.DataFrame:
@@ -112,7 +494,16 @@ class StaticAssets:
 
     @property
     def expanded_calendar(self) -> pd.DataFrame:
-        return self._expanded_calendar
+        return self._service_calendar.to_frame()
+
+    @property
+    def trip_metadata(self) -> pd.DataFrame:
+        """The route, headsign, agency and service of each trip code."""
+        return self._trip_metadata
+
+    @property
+    def service_calendar(self) -> ServiceCalendar:
+        return self._service_calendar
 
     @property
     def stops(self) -> pd.DataFrame:
@@ -127,6 +518,133 @@ class StaticAssets:
         return self._trips
 
 
+def load_static_assets(gtfs_zip_file: ZipSource, snapshot_dir: Optional[str] = None,
+                       filter_stops: Optional[Iterable[int]] = None) -> StaticAssets:
+    """Load the static assets from the snapshot of this zip file if one exists,
+    otherwise parse and validate the zip file and write a snapshot for the
+    next time. A ValueError is raised if the zip file isn't usable.
+
+    Once the snapshot is written, the parsed tables are released and the
+    snapshot is loaded instead. Its columns are memory mapped, so they can be
+    shared with other processes and the memory used parsing is given back."""
+
+    if snapshot_dir is None:
+        return _load_validated(gtfs_zip_file, filter_stops)
+
+    path = find_snapshot(snapshot_dir, snapshot_key(gtfs_zip_file, filter_stops))
+    if path is not None:
+        try:
+            return StaticAssets.from_snapshot(path)
+        except Exception:
+            log.error(f'Unable to load the snapshot {path}, parsing the zip file\n', exc_info=True)
+
+    sa = _load_validated(gtfs_zip_file, filter_stops)
+    log.info(f'Parsed the static assets, peak memory usage: {format_bytes(peak_memory_usage())}')
+
+    # the parsed assets are still served, but without a snapshot they can't
+    # be published to worker processes, see `SharedState.publish()`.
+    try:
+        path = sa.save_snapshot(snapshot_dir)
+    except Exception:
+        log.error(f'Unable to write a snapshot to {snapshot_dir}\n', exc_info=True)
+        return sa
+
+    sa.close()
+    return StaticAssets.from_snapshot(path)
+
+
+def _load_validated(gtfs_zip_file: ZipSource,
+                    filter_stops: Optional[Iterable[int]]) -> StaticAssets:
+    """Parse and validate the zip file, closing the assets if they aren't
+    usable, so a failed refresh doesn't leave its calendar thread running."""
+
+    sa = StaticAssets(gtfs_zip_file, filter_stops=filter_stops)
+    try:
+        sa.validate()
+    except Exception:
+        sa.close()
+        raise
+    return sa
+
+
+class _MmapFile(io.RawIOBase):
+    """A read-only file object over an mmap, as zipfile needs `seekable()`,
+    which mmap objects only have from python 3.13."""
+
+    def __init__(self, mm: mmap.mmap):
+        super().__init__()
+        self._mm = mm
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._mm.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._mm.seek(offset, whence)
+        return self._mm.tell()
+
+    def tell(self):
+        return self._mm.tell()
+
+
+def filter_tables(tables: Dict[str, pd.DataFrame],
+                  stop_numbers: Iterable[int]) -> Dict[str, pd.DataFrame]:
+    """Keep only the given stops, the stop times at those stops, and the
+    trips, routes and calendar entries those stop times reference."""
+
+    stops = tables['stops']
+    stops = stops[stops.index.isin(list(stop_numbers))]
+
+    stop_times = tables['stop_times']
+    stop_times = stop_times[stop_times.stop_id.isin(stops.stop_id)]
+    stop_times = stop_times.assign(trip_id=stop_times.trip_id.cat.remove_unused_categories(),
+                                   stop_id=stop_times.stop_id.cat.remove_unused_categories())
+
+    trips = tables['trips']
+    trips = trips[trips.trip_id.isin(stop_times.trip_id.cat.categories)]
+    trips = trips.assign(trip_id=trips.trip_id.cat.remove_unused_categories(),
+                         route_id=trips.route_id.cat.remove_unused_categories())
+
+    routes = tables['routes']
+    calendar = tables['calendar']
+    exceptions = tables['calendar_exceptions']
+
+    return {**tables,
+            'stops': stops,
+            'stop_times': stop_times.reset_index(drop=True),
+            'trips': trips.reset_index(drop=True),
+            'routes': routes[routes.index.isin(trips.route_id.cat.categories)],
+            'calendar': calendar[calendar.index.isin(trips.service_id)],
+            'calendar_exceptions': exceptions[exceptions.service_id.isin(trips.service_id)]
+                                        .reset_index(drop=True)}
+
+
+def _category_values(column: pd.Series) -> np.ndarray:
+    """The categories of a column as objects, with a None appended, so the
+    missing value code of -1 picks the None when indexed by the codes."""
+    return np.append(column.cat.categories.to_numpy(dtype=object), None)
+
+
+def _empty_departures() -> pd.DataFrame:
+    """A departures dataframe with no rows."""
+
+    return pd.DataFrame({'stop_number': pd.Series(dtype=np.int64),
+                         'trip_id': pd.Series(dtype=str),
+                         'stop_id': pd.Series(dtype=str),
+                         'stop_sequence': pd.Series(dtype=np.int32),
+                         'service_date': pd.Series(dtype='datetime64[ns]'),
+                         'scheduled_departure': pd.Series(dtype='datetime64[ns]'),
+                         'route': pd.Series(dtype=str),
+                         'headsign': pd.Series(dtype=str),
+                         'agency': pd.Series(dtype=str)})
+
 
 def load_agencies(zf: zipfile.ZipFile):
     """Load the "agencies.txt" file."""
@@ -179,14 +697,55 @@ def load_stop_times(zf: zipfile.ZipFile):
     """Load the stop times from the zip."""
 
     with zf.open('stop_times.txt', 'r') as f:
-        df = pd.read_csv(f, usecols=['trip_id', 'departure_time' ,'stop_id'],
-                            dtype={'trip_id': 'category', 'departure_time': str,
-                                   'stop_id': 'category'})
-    df['departure_time'] = pd.to_timedelta(df['departure_time'])
+        return parse_stop_times(f)
+
+
+def parse_stop_times(f: BinaryIO):
+    """Parse the stop times CSV, or a chunk of it starting with the header."""
+
+    df = pd.read_csv(f, usecols=['trip_id', 'departure_time' ,'stop_id', 'stop_sequence'],
+                        dtype={'trip_id': 'category', 'departure_time': str,
+                               'stop_id': 'category', 'stop_sequence': np.int32})
+    df['departure_time'] = parse_gtfs_times(df['departure_time'])
 
     return df
 
 
+def parse_gtfs_times(times: pd.Series) -> np.ndarray:
+    """Parse GTFS times, H:MM:SS or HH:MM:SS, to int32 seconds since the
+    start of the service day. Times can go past 24:00:00 for trips that
+    run after midnight. The fields are read from the right of the raw bytes,
+    so one or two digit hours are handled without any per-value Python code.
+    Empty times, allowed for stops that aren't timepoints, are NO_DEPARTURE_TIME."""
+
+    raw = np.asarray(times.to_numpy(dtype=object, na_value=''), dtype='S8')
+    chars = raw.view(np.uint8).reshape(len(raw), 8).astype(np.int32)
+    length = np.count_nonzero(chars, axis=1)
+
+    # the characters from the right, i.e. SS, MM and HH in reverse
+    from_right = np.take_along_axis(chars, np.clip(length[:, None] - np.arange(1, 9), 0, 7), axis=1)
+    digits = from_right - ord('0')
+
+    # the tens of the hour are only present in 8 character times
+    digits[:, 7] = np.where(length == 8, digits[:, 7], 0)
+
+    empty = length == 0
+    valid = ((length == 7) | (length == 8)) \
+        & (from_right[:, 2] == ord(':')) & (from_right[:, 5] == ord(':')) \
+        & ((digits[:, [0, 1, 3, 4, 6, 7]] >= 0) & (digits[:, [0, 1, 3, 4, 6, 7]] <= 9)).all(axis=1)
+    valid |= empty
+
+    if not valid.all():
+        first = np.flatnonzero(~valid)[0]
+        raise ValueError(f'invalid GTFS time {times.iloc[first]!r} in row {first}')
+
+    secs = (digits[:, 7] * 10 + digits[:, 6]) * 3600 \
+        + (digits[:, 4] * 10 + digits[:, 3]) * 60 \
+        + digits[:, 1] * 10 + digits[:, 0]
+
+    return np.where(empty, NO_DEPARTURE_TIME, secs).astype(np.int32)
+
+
 def load_trips(zf: zipfile.ZipFile):
     """Load the trips.txt from the zip."""
 
@@ -194,3 +753,10 @@ def load_trips(zf: zipfile.ZipFile):
         return pd.read_csv(f, usecols=['route_id','service_id','trip_id','trip_headsign'],
                               dtype={'route_id': 'category', 'trip_id': 'category',
                                      'service_id': int})
+
+
+# the loaders of the tables that are parsed in one piece, the stop
+# times are loaded separately, as they can be parsed in chunks.
+TABLE_LOADERS = {'agencies': load_agencies, 'routes': load_routes,
+                 'calendar': load_calendar, 'calendar_exceptions': load_calendar_exceptions,
+                 'stops': load_stops, 'trips': load_trips}
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+
+# the columns of the trip metadata table, which has one row per trip code.
+TRIP_METADATA_COLUMNS = ['trip_id', 'route', 'headsign', 'agency', 'service_row']
+
+
+def build_trip_metadata(trip_ids: pd.Index, trip_rows: np.ndarray, trips: pd.DataFrame,
+                        routes: pd.DataFrame, agencies: pd.DataFrame,
+                        service_ids: pd.Index) -> pd.DataFrame:
+    """Join the trips, routes and agencies once, into a table indexed by the
+    trip codes of the departure index. `trip_rows` is the row in `trips` of
+    each trip code, or -1 if the trip isn't in trips.txt. The route short
+    name, headsign and agency name are categorical, and `service_row` is the
+    row of the trip's service in the service calendar. Trips that aren't in
+    trips.txt, or whose service isn't in the calendar, have a `service_row`
+    of -1, so they never run."""
+
+    known = trip_rows >= 0
+    trips = trips.iloc[np.where(known, trip_rows, 0)]
+
+    route_rows = np.where(known, routes.index.get_indexer(trips.route_id.to_numpy()), -1)
+    agency_rows = agencies.index.get_indexer(routes.agency_id.to_numpy())
+
+    service_rows = np.where(known, service_ids.get_indexer(trips.service_id.to_numpy()), -1)
+
+    return pd.DataFrame({
+        'trip_id': pd.Categorical.from_codes(np.arange(len(trip_ids)), trip_ids),
+        'route': _lookup(routes.route_short_name, route_rows),
+        'headsign': _lookup(trips.trip_headsign, np.where(known, np.arange(len(trips)), -1)),
+        'agency': _lookup(agencies.agency_name, _take(agency_rows, route_rows)),
+        'service_row': service_rows.astype(np.int32),
+    }, columns=TRIP_METADATA_COLUMNS).rename_axis('trip_code')
+
+
+def _take(values: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Take the values at the rows, with -1 for any row that is -1."""
+    return np.where(rows >= 0, values[np.clip(rows, 0, None)], -1) if len(values) else np.full(len(rows), -1)
+
+
+def _lookup(column: pd.Series, rows: np.ndarray) -> pd.Categorical:
+    """The categorical values of the column at the rows, missing where the
+    row is -1 or the value is missing."""
+
+    codes, uniques = pd.factorize(column)
+    return pd.Categorical.from_codes(_take(codes, rows), uniques)
@@ -1,17 +1,23 @@
 
+import sys
 import time
 import math
 import logging
 import threading
 
-from typing import Callable
+from typing import Callable, Optional
 from datetime import datetime, timedelta
 
+try:
+    import resource
+except ImportError:     # not available on windows
+    resource = None
+
 log = logging.getLogger(__name__)
 
 
 def timed_function(func):
-    """A timing decorator to print the runtime of a long runnings function."""
+    """A timing decorator to log the runtime of a long runnings function."""
 
     def _wrapper(*args, **kwargs):
         start = time.time()
@@ -19,7 +25,7 @@ def timed_function(func):
             return func(*args, **kwargs)
         finally:
             duration = time.time() - start
-            print(f'function "{func.__name__}()" took {duration:.3f} secs.')
+            log.info(f'function "{func.__name__}()" took {duration:.3f} secs.')
 
     return _wrapper
 
@@ -43,6 +49,22 @@ def seconds_until_timestamp(timestamp: str, offset=0):
         return max([(offsetted - datetime.now()).total_seconds(), 0])
 
 
+def peak_memory_usage() -> Optional[int]:
+    """The high-water mark of the resident memory of this process in bytes,
+    or None if the platform doesn't report it."""
+
+    if resource is None:
+        return None
+
+    # linux reports the peak in kilobytes, macOS in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def format_bytes(size: Optional[int]) -> str:
+    return 'unknown' if size is None else f'{size / 2**20:.1f} MB'
+
+
 def clip_at_zero(my_number):
     """Never allow the given number to go below zero."""
     return max([my_number, 0])
@@ -81,6 +103,12 @@ class OnSchedule(threading.Thread):
             raise KeyboardInterrupt('exit signalled')
 
     def run(self):
+        try:
+            self._run()
+        except KeyboardInterrupt:
+            pass    # raised by wait() once stopped
+
+    def _run(self):
         if not self._run_at_launch:
             log.debug(f'OnSchedule({self._func.__name__}()) going to sleep before first execution')
             self.wait()
@@ -0,0 +1,330 @@
+"""A load generator for the departures API. For each combination of worker
+processes and threads, the server is started in cached mode, then driven
+by client threads requesting stops with a Zipf popularity distribution,
+and a mix of Accept headers, for a fixed time:
+
+    python -m tfi_gtfs.loadtest --workers 1,2 --threads 1,4 --concurrency 8
+
+The latency histogram, throughput and error rate of each setting are
+printed, and can be written to JSON.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import zipfile
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import http.client
+
+import numpy as np
+
+from typing import Dict, List, NamedTuple, Optional
+
+from .gtfs import load_stops
+from .__main__ import CACHED_STATIC_ASSETS
+
+
+log = logging.getLogger(__name__)
+
+# the upper bounds of the latency histogram buckets, in milliseconds.
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# the default mix of Accept headers, by weight.
+DEFAULT_ACCEPT_MIX = {'application/json': 0.9, 'text/html': 0.05, 'text/csv': 0.05}
+
+# how long to wait for the server to start answering requests.
+STARTUP_TIMEOUT = 120
+
+# the number of requests each client makes before the timed run.
+WARMUP_REQUESTS = 5
+
+
+class LoadSetting(NamedTuple):
+    workers: int
+    threads: int
+    concurrency: int
+
+
+class RequestMix:
+    """The stops and Accept headers to request. Stops are ranked in a random
+    order, and the n-th most popular stop is requested with a probability
+    proportional to 1 / n^zipf_exponent."""
+
+    def __init__(self, stop_numbers: List[int], accept_mix: Dict[str, float],
+                 zipf_exponent: float = 1.0, seed: int = 0):
+
+        rng = np.random.default_rng(seed)
+        self._stops = rng.permutation(np.asarray(stop_numbers))
+
+        popularity = 1 / np.arange(1, len(self._stops) + 1) ** zipf_exponent
+        self._stop_p = popularity / popularity.sum()
+
+        self._accept = list(accept_mix)
+        weights = np.array(list(accept_mix.values()), dtype=float)
+        self._accept_p = weights / weights.sum()
+
+        self._seed = seed
+
+    def requests(self, client: int, n: int):
+        """`n` (path, accept header) pairs for the client, the same on every run."""
+
+        rng = np.random.default_rng([self._seed, client])
+        stops = rng.choice(self._stops, size=n, p=self._stop_p)
+        accepts = rng.choice(len(self._accept), size=n, p=self._accept_p)
+
+        return [(f'/api/v2/departures?stop={stop}', self._accept[a])
+                for stop, a in zip(stops.tolist(), accepts.tolist())]
+
+
+def run_load_test(setting: LoadSetting, mix: RequestMix, duration: float,
+                  response_cache: bool = True) -> dict:
+    """Start a server with the setting, drive it for `duration` seconds and
+    return the results."""
+
+    with _Server(setting.workers, setting.threads, response_cache) as server:
+        latencies, errors = _drive(server.port, mix, setting.concurrency, duration)
+
+    return {**setting._asdict(), **summarise(latencies, errors, duration)}
+
+
+def summarise(latencies: np.ndarray, errors: int, duration: float) -> dict:
+    """The throughput, error rate and latency distribution of a run, from
+    the latency in seconds of each successful request."""
+
+    total = len(latencies) + errors
+    latency_ms = latencies * 1e3
+
+    # the bucket of each latency is the first bound it's less than or equal to
+    bounds = HISTOGRAM_BUCKETS_MS + [np.inf]
+    counts = np.bincount(np.searchsorted(bounds, latency_ms, side='left'), minlength=len(bounds))
+
+    def percentile(q):
+        return float(np.percentile(latency_ms, q)) if len(latency_ms) else None
+
+    return {
+        'requests': total,
+        'errors': errors,
+        'error_rate': errors / total if total else 0.0,
+        'throughput': len(latencies) / duration,
+        'latency_ms': {'mean': float(latency_ms.mean()) if len(latency_ms) else None,
+                       'p50': percentile(50), 'p90': percentile(90),
+                       'p99': percentile(99), 'max': percentile(100)},
+        'histogram': {f'<={b}ms' if np.isfinite(b) else 'more': int(c)
+                      for b, c in zip(bounds, counts)},
+    }
+
+
+def _drive(port: int, mix: RequestMix, concurrency: int, duration: float):
+    """Make requests from `concurrency` threads until the time is up, each
+    over its own keep-alive connection. Returns the latencies of the
+    successful requests, and the number that failed."""
+
+    start = threading.Barrier(concurrency)
+    results = [None] * concurrency
+
+    def client(n):
+        latencies, errors = [], 0
+        requests = itertools.cycle(mix.requests(n, 10_000))
+        conn = http.client.HTTPConnection('localhost', port, timeout=30)
+
+        for _ in range(WARMUP_REQUESTS):
+            _request(conn, *next(requests))
+
+        start.wait()
+        deadline = time.perf_counter() + duration
+        while (now := time.perf_counter()) < deadline:
+            if _request(conn, *next(requests)):
+                latencies.append(time.perf_counter() - now)
+            else:
+                errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection('localhost', port, timeout=30)
+
+        conn.close()
+        results[n] = (latencies, errors)
+
+    threads = [threading.Thread(target=client, args=(n,), daemon=True) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return (np.array([l for latencies, _ in results for l in latencies]),
+            sum(errors for _, errors in results))
+
+
+def _request(conn: http.client.HTTPConnection, path: str, accept: str) -> bool:
+    """Make the request, reading the whole response. True if it succeeded."""
+
+    try:
+        conn.request('GET', path, headers={'Accept': accept})
+        response = conn.getresponse()
+        response.read()
+        return response.status == 200
+    except (OSError, http.client.HTTPException):
+        return False
+
+
+class _Server:
+    """The server in cached mode in a subprocess, on a free port."""
+
+    def __init__(self, workers: int, threads: int, response_cache: bool):
+        self._workers = workers
+        self._threads = threads
+        self._response_cache = response_cache
+
+        self._process: Optional[subprocess.Popen] = None
+        self._log = None
+        self._tmp_dir: Optional[tempfile.TemporaryDirectory] = None
+        self.port: Optional[int] = None
+
+    def __enter__(self):
+        self.port = _free_port()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, HOST='localhost', PORT=str(self.port),
+                   SNAPSHOT_DIR=self._tmp_dir.name, LOG_LEVEL='WARNING',
+                   PYTHONPATH=os.pathsep.join([package_dir, os.environ.get('PYTHONPATH', '')]))
+        if not self._response_cache:
+            env['RESPONSE_CACHE_SIZE'] = '0'
+
+        self._log = open(os.path.join(self._tmp_dir.name, 'server.log'), 'w+')
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'tfi_gtfs', '--cached',
+             '--workers', str(self._workers), '--threads', str(self._threads)],
+            env=env, stdout=self._log, stderr=subprocess.STDOUT)
+
+        try:
+            self._wait_until_serving()
+        except Exception:
+            self.__exit__()
+            raise
+
+        return self
+
+    def __exit__(self, *exc):
+        self._process.terminate()
+        try:
+            self._process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+        self._log.close()
+        self._tmp_dir.cleanup()
+
+    def _wait_until_serving(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                self._log.seek(0)
+                raise RuntimeError(f'the server exited with code {self._process.returncode}:\n'
+                                   f'{self._log.read()}')
+
+            conn = http.client.HTTPConnection('localhost', self.port, timeout=5)
+            if _request(conn, '/', 'text/html'):
+                conn.close()
+                return
+
+            conn.close()
+            time.sleep(0.2)
+
+        raise TimeoutError(f'the server did not start within {STARTUP_TIMEOUT} secs')
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def cached_stop_numbers() -> List[int]:
+    """The stop numbers of the cached static assets."""
+
+    with zipfile.ZipFile(CACHED_STATIC_ASSETS) as zf:
+        return load_stops(zf).index.dropna().astype(int).tolist()
+
+
+def summary(results: List[dict]) -> str:
+    """A table of the results, for printing."""
+
+    lines = [f'{"workers":>8}{"threads":>8}{"clients":>8}{"req/s":>10}{"errors":>8}'
+             f'{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}']
+    for r in results:
+        latency = {k: v if v is not None else float('nan') for k, v in r['latency_ms'].items()}
+        lines.append(f'{r["workers"]:>8}{r["threads"]:>8}{r["concurrency"]:>8}'
+                     f'{r["throughput"]:>10.1f}{r["error_rate"]:>8.1%}'
+                     f'{latency["p50"]:>10.2f}{latency["p90"]:>10.2f}'
+                     f'{latency["p99"]:>10.2f}{latency["max"]:>10.2f}')
+
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = get_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    mix = RequestMix(cached_stop_numbers(), args.accept, args.zipf, args.seed)
+    settings = [LoadSetting(*s) for s in itertools.product(args.workers, args.threads,
+                                                          args.concurrency)]
+
+    results = []
+    for setting in settings:
+        log.info(f'running {setting}')
+        results.append(run_load_test(setting, mix, args.duration, not args.no_cache))
+
+    print(summary(results))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'duration': args.duration, 'accept': args.accept, 'zipf': args.zipf,
+                       'response_cache': not args.no_cache, 'results': results}, f, indent=2)
+
+
+def get_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Load test the departures API in cached mode")
+
+    parser.add_argument('--workers', type=_int_list, default=[1],
+                        help='comma separated numbers of worker processes to test.')
+    parser.add_argument('--threads', type=_int_list, default=[1],
+                        help='comma separated numbers of threads per process to test.')
+    parser.add_argument('--concurrency', type=_int_list, default=[4],
+                        help='comma separated numbers of concurrent clients to test.')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='the number of seconds each setting is tested for.')
+    parser.add_argument('--accept', type=_accept_mix, default=DEFAULT_ACCEPT_MIX,
+                        help='the mix of Accept headers, e.g. "application/json=0.9,text/html=0.1".')
+    parser.add_argument('--zipf', type=float, default=1.0,
+                        help='the exponent of the Zipf distribution of stop popularity.')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the request mix.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='turn off the response cache of the server.')
+    parser.add_argument('--output', help='write the results to this JSON file.')
+    parser.add_argument('--verbose', action='store_true', help='log each setting as it runs.')
+
+    return parser.parse_args(argv)
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(n) for n in value.split(',') if n.strip()]
+
+
+def _accept_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(','):
+        mime_type, _, weight = item.partition('=')
+        mix[mime_type.strip()] = float(weight) if weight else 1.0
+
+    return mix
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
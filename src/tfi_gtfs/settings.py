@@ -9,12 +9,48 @@ API_KEY = os.environ.get('API_KEY')
 # Redis URL, probably something like redis://localhost:6379
 REDIS_URL = os.environ.get('REDIS_URL', None)
 POLLING_PERIOD = os.environ.get('POLLING_PERIOD', 60)
+
+# seconds to wait to connect to the TFI servers, and between bytes received.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))
 MAX_MINUTES = os.environ.get('MAX_MINUTES', 60)
 HOST = os.environ.get('HOST', 'localhost')
-PORT = os.environ.get('PORT', 7341)
-WORKERS = os.environ.get('WORKERS', 1)
+PORT = int(os.environ.get('PORT', 7341))
+WORKERS = int(os.environ.get('WORKERS', 1))
+
+# the number of threads serving requests in each process.
+THREADS = int(os.environ.get('THREADS', 4))
+
+# the number of open connections to each process, beyond which new
+# connections wait to be accepted, and the length of that queue.
+CONNECTION_LIMIT = int(os.environ.get('CONNECTION_LIMIT', 100))
+BACKLOG = int(os.environ.get('BACKLOG', 1024))
+
+# idle connections are closed after this many seconds.
+CHANNEL_TIMEOUT = int(os.environ.get('CHANNEL_TIMEOUT', 120))
+
+# the web server, 'waitress' handles each connection in a thread, 'async'
+# holds the connections in an event loop, for many mostly idle clients.
+SERVER = os.environ.get('SERVER', 'waitress')
+
+# the maximum size in bytes of the cached departures responses, 0 disables the cache.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 16 * 1024 * 1024))
+
+# the size in bytes of each of the two shared memory buffers used to
+# publish the realtime data to the workers.
+REALTIME_BUFFER_SIZE = int(os.environ.get('REALTIME_BUFFER_SIZE', 32 * 1024 * 1024))
 DATA_DIR = './data'
 
+# the number of processes used to parse the static assets.
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', os.cpu_count() or 1))
+
+# parsed static assets are saved here, to skip parsing the zip on a restart.
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(DATA_DIR, 'snapshots'))
+
+# a comma separated list of stop numbers, only the data for these stops is kept.
+FILTER_STOPS = os.environ.get('FILTER_STOPS')
+FILTER_STOPS = [int(n) for n in FILTER_STOPS.split(',') if n.strip()] if FILTER_STOPS else None
+
 # set default logging level to INFO
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
 if LOG_LEVEL not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
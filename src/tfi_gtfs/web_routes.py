@@ -1,33 +1,152 @@
+import math
+import time
+import hashlib
+import threading
 
+from typing import Optional
 from datetime import datetime, timedelta
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from .gtfs import GTFS
-from .web_server import format_response, show_page
+from .web_server import format_response, show_page, ResponseCache, UpdateNotifier
+from .web_server import updates
+from .web_server.serializer import dumps
+from . import settings
 
 
+# a long-poll waits this many seconds for the departures to change by
+# default, clients can ask for less, or for more up to the maximum.
+POLL_TIMEOUT = 30
+MAX_POLL_TIMEOUT = 60
 
-def register_routes(app: Flask, gtfs: GTFS):
-    """Register all routes needed for the web server."""
+# the token of the departures returned by a long-poll, which the client
+# sends back in the `token` argument of its next poll.
+TOKEN_HEADER = 'X-Departures-Token'
+
+# at most this fraction of the threads of a threaded server wait on
+# long-polls at once, so the rest are free for other requests, but one
+# always can, so polling works with a single thread. Polls beyond
+# that are answered with a 503, and asked to retry after this many seconds.
+POLL_THREAD_FRACTION = 0.5
+POLL_RETRY_AFTER = 5
+
+# the maximum size in bytes of the cached departures tokens.
+TOKEN_CACHE_SIZE = 1024 * 1024
+
+
+def register_routes(app: Flask, gtfs: GTFS, threads: Optional[int] = None):
+    """Register all routes needed for the web server. `threads` is the number
+    of threads serving requests, if each waiting long-poll holds one of them,
+    None if the waits don't hold a thread."""
+
+    # departures only change when new data arrives, or as time passes, so the
+    # responses are cached for each generation of the data and each minute.
+    cache = ResponseCache(settings.RESPONSE_CACHE_SIZE) \
+                if settings.RESPONSE_CACHE_SIZE > 0 else None
+    if cache is not None and gtfs is not None:
+        gtfs.register_update_callback(cache.clear)
+
+    # the tokens of the departures are cached the same way, so the clients
+    # woken by new data only compute the departures once per stop set.
+    tokens = ResponseCache(TOKEN_CACHE_SIZE)
+    if gtfs is not None:
+        notifier = UpdateNotifier(lambda: (gtfs.static_asset_generation, gtfs.realtime_generation))
+        gtfs.register_update_callback(tokens.clear)
+        gtfs.register_update_callback(notifier.notify)
+        app.extensions[updates.EXTENSION_NAME] = notifier
+
+    poll_threads = threading.BoundedSemaphore(max(1, int(threads * POLL_THREAD_FRACTION))) \
+                        if threads is not None else None
+
+    def requested_stops():
+        return sorted({int(n) for n in request.args.getlist('stop') if n.isnumeric()})
+
+    def departures_cache_key():
+        return (tuple(requested_stops()), gtfs.static_asset_generation,
+                gtfs.realtime_generation, datetime.now().replace(second=0, microsecond=0))
 
     # basic homepage
     @app.route('/')
     def index():
         return show_page('homepage.html')
 
+    def departures_token():
+        """A digest of the departures from the requested stops."""
+
+        key = departures_cache_key()
+        token = tokens.get(key)
+        if token is None:
+            token = hashlib.blake2b(dumps(dict(departures_data())), digest_size=8) \
+                        .hexdigest().encode()
+            tokens.put(key, token)
+
+        return token.decode()
 
     # set up the API endpoint
     @app.route('/api/v2/departures')
-    @format_response
+    @format_response(cache=cache, cache_key=departures_cache_key)
     def departures():
+        return departures_data()
+
+    # a long-poll of the departures, answered as soon as the departures differ
+    # from those the client has, or with a 304 once the timeout passes.
+    @app.route('/api/v2/departures/poll')
+    def poll_departures():
+        notifier = app.extensions[updates.EXTENSION_NAME]
+        token = request.args.get('token')
+        timeout = poll_timeout()
+        deadline = time.monotonic() + timeout
+
+        while True:
+            # read before the departures, so an update in between isn't missed
+            generation = notifier.generation
+
+            current = departures_token()
+            if current != token:
+                response = departures()
+                response.headers[TOKEN_HEADER] = current
+                return response
+
+            # the ASGI adapter waits in its event loop, rather than in this thread
+            if request.environ.get(updates.ASYNC_WAIT):
+                return Response(status=304, headers={TOKEN_HEADER: current,
+                                                     updates.WAIT_HEADER: str(timeout)})
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return Response(status=304, headers={TOKEN_HEADER: current})
+
+            if poll_threads is not None and not poll_threads.acquire(blocking=False):
+                return Response(status=503, headers={TOKEN_HEADER: current,
+                                                     'Retry-After': str(POLL_RETRY_AFTER)})
+            try:
+                changed = notifier.wait(generation, remaining)
+            finally:
+                if poll_threads is not None:
+                    poll_threads.release()
+
+            if not changed:
+                return Response(status=304, headers={TOKEN_HEADER: current})
+
+    def poll_timeout():
+        # nan or inf would never time out, so they're treated like any
+        # other timeout that isn't a number.
+        timeout = request.args.get('timeout', POLL_TIMEOUT, type=float)
+        if not math.isfinite(timeout):
+            timeout = POLL_TIMEOUT
+
+        return min(max(timeout, 0), MAX_POLL_TIMEOUT)
+
+    def departures_data():
         now = datetime.now()
-        stop_numbers = [int(n) for n in request.args.getlist('stop') if n.isnumeric()]
-        arr = {}
-        for stop_number in stop_numbers:
-            if gtfs.stop_number_is_valid(stop_number):
-                arr[stop_number] = {
-                    'stop_name':  gtfs.stop_name(stop_number),
-                    'departures': gtfs.get_scheduled_departures(stop_number, now,
-                                                                timedelta(minutes=90))
-                }
-        return arr
+        stop_names = gtfs.stop_names(requested_stops())
+
+        # all the stops are queried together, the cost of a query is mostly
+        # per query rather than per stop.
+        departures = gtfs.get_departures_for_stops(stop_names, now, timedelta(minutes=90))
+
+        return ((stop_number, {
+                    'stop_name':  stop_name,
+                    'departures': departures.get(stop_number, [])
+                })
+                for stop_number, stop_name in stop_names.items())
@@ -1,5 +1,8 @@
 
 from .format import show_page
 from .format import format_response
+from .cache import ResponseCache
+from .updates import UpdateNotifier
 
-from .utils import build_flask_app, serve_forever
+from .utils import build_flask_app, serve_forever, serve_socket, ServerOptions
+from .asgi import AsgiApp, serve_async, serve_async_socket
@@ -0,0 +1,216 @@
+"""Serving the flask app from an asyncio event loop, for many mostly idle
+keep-alive connections, such as display boards polling every few seconds.
+The flask app is wrapped as an ASGI application: the event loop holds the
+connections, and each request is handled by calling the flask app in a
+bounded pool of threads, so the loop never blocks on a departures query.
+The routes and content negotiation are the flask app's own, and long-polls
+wait for new data in the event loop, without holding a thread.
+
+The server is uvicorn, which is an optional dependency, installed with
+`pip install tfi-gtfs[async]`."""
+
+import io
+import sys
+import math
+import socket
+import asyncio
+import logging
+
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+
+from .utils import ServerOptions
+from . import updates
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+
+log = logging.getLogger(__name__)
+
+
+class AsgiApp:
+    """An ASGI application calling the flask app in a pool of `threads`."""
+
+    def __init__(self, app: Flask, threads: int = 4):
+        self._app = app
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f'unsupported ASGI scope type: {scope["type"]}')
+
+    async def _http(self, scope, receive, send):
+        body = await _read_body(receive)
+        loop = asyncio.get_running_loop()
+
+        # a long-poll waiting for new data is answered straight away by the
+        # app, with the time left to wait, the wait happens in the event loop
+        # and the app is called again once the data changes.
+        notifier = self._app.extensions.get(updates.EXTENSION_NAME)
+        deadline = None
+
+        while True:
+            seen = notifier.generation if notifier is not None else None
+
+            # the flask app and the streamed response bodies run in the pool
+            status, headers, content = await loop.run_in_executor(
+                                                self._executor, self._call_app, scope, body)
+
+            wait = _wait_time(_pop_header(headers, updates.WAIT_HEADER))
+            if wait is None or notifier is None:
+                break
+
+            if deadline is None:
+                deadline = loop.time() + wait
+            if deadline <= loop.time():
+                break
+
+            await notifier.wait_async(seen, deadline - loop.time())
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    def _call_app(self, scope, body: bytes) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+        """Call the flask app as a WSGI application, returning the status,
+        the headers and the whole response body."""
+
+        response = {}
+
+        def start_response(status: str, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        environ = wsgi_environ(scope, body)
+        environ[updates.ASYNC_WAIT] = True
+
+        result = self._app(environ, start_response)
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        return response['status'], response['headers'], content
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def wsgi_environ(scope, body: bytes) -> dict:
+    """The WSGI environ of an ASGI HTTP request."""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+
+        # repeated headers are combined, as they are by WSGI servers
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+
+    return environ
+
+
+def _pop_header(headers: List[Tuple[bytes, bytes]], name: str) -> Optional[str]:
+    """Remove the header from the list, returning its value if it was there."""
+
+    name = name.lower().encode('latin-1')
+    for i, (header, value) in enumerate(headers):
+        if header == name:
+            del headers[i]
+            return value.decode('latin-1')
+
+    return None
+
+
+def _wait_time(value: Optional[str]) -> Optional[float]:
+    """The seconds to wait from the wait header, None if there is no wait,
+    or it isn't a finite number."""
+
+    try:
+        wait = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    return wait if math.isfinite(wait) else None
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+
+    return b''.join(chunks)
+
+
+def serve_async(app: Flask, host, port, options: ServerOptions = ServerOptions()):
+    """Launch the webserver in async mode."""
+
+    _serve(app, options, host=host, port=port)
+
+
+def serve_async_socket(app: Flask, sock: socket.socket, options: ServerOptions = ServerOptions()):
+    """Launch the webserver in async mode on a socket that is already
+    listening, which can be shared by several processes."""
+
+    _serve(app, options, sockets=[sock])
+
+
+def _serve(app: Flask, options: ServerOptions, sockets: Optional[List[socket.socket]] = None,
+           **address):
+
+    if uvicorn is None:
+        raise RuntimeError('the async server needs uvicorn, install it with '
+                           '"pip install tfi-gtfs[async]"')
+
+    # idle connections are kept open for the channel timeout, so clients
+    # polling less often than uvicorn's default of 5 seconds reuse them. The
+    # connection limit isn't applied, holding many connections is the point.
+    config = uvicorn.Config(AsgiApp(app, options.threads), backlog=options.backlog,
+                            timeout_keep_alive=options.channel_timeout,
+                            log_level='warning', access_log=False, **address)
+    uvicorn.Server(config).run(sockets=sockets)
@@ -0,0 +1,74 @@
+import threading
+
+from typing import Hashable, Optional
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """A thread safe LRU cache of serialized response bodies, limited by the
+    total size of the bodies rather than the number of them."""
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._entries: 'OrderedDict[Hashable, bytes]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """Return the cached body for the key, or None if it isn't cached."""
+
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return body
+
+    def put(self, key: Hashable, body: bytes):
+        """Cache the body, evicting the least recently used bodies to stay
+        under the size limit. A body bigger than the limit isn't cached."""
+
+        if len(body) > self._max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+
+            self._entries[key] = body
+            self._size += len(body)
+
+            while self._size > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self, *args):
+        """Remove everything from the cache. Any arguments are ignored, so this
+        can be registered as a GTFS update callback."""
+
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @property
+    def size(self) -> int:
+        """The total size of the cached bodies in bytes."""
+        return self._size
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'bytes': self._size,
+                'hits': self._hits, 'misses': self._misses}
@@ -2,7 +2,6 @@
 import os
 import io
 import csv
-import sys
 
 import yaml
 import datetime
@@ -10,13 +9,14 @@ import datetime
 from functools import wraps
 from functools import lru_cache
 
-from flask import jsonify
 from flask import request
 from flask import Response
 from flask import render_template
 
-from typing import Optional, List
+from typing import Callable, Hashable, Iterable, Iterator, Optional, List, Tuple
 
+from .cache import ResponseCache
+from .serializer import dumps
 from .utils import to_iso_date
 
 
@@ -24,33 +24,35 @@ HEADERS = ["stop_id", "stop_name", "route", "headsign",
            "agency", "scheduled_arrival", "estimated_arrival"]
 
 
-def format_response(func):
-    """Format the response based on the user's accept header."""
+def format_response(func=None, *, cache: Optional[ResponseCache] = None,
+                    cache_key: Optional[Callable[[], Hashable]] = None):
+    """Format the response based on the user's accept header. If a cache is
+    given, the serialized response is cached under the value of `cache_key()`
+    and the mime type, and on a hit the decorated function isn't called."""
+
+    if func is None:
+        return lambda f: format_response(f, cache=cache, cache_key=cache_key)
 
     @wraps(func)
     def _wrapper(*args, **kwargs):
-        response_data = func(*args, **kwargs)
         accept_header = request.headers.get('Accept')
         mime_type = _mime_type_from_accept_header(accept_header)
 
-        if mime_type == 'application/json':
-            return jsonify(response_data)
-        elif mime_type == 'application/yaml':
-            return Response(yaml.dump(response_data, default_flow_style=False), mimetype=mime_type)
-
-        table_data = _flatten_response_data(response_data)
-        if mime_type in ('text/csv', 'text/plain'):
-            return Response(csv_table(table_data, HEADERS), mimetype=mime_type)
-        else:
-            try:
-                return Response(render_template('main.html',
-                                                table=html_table(table_data, HEADERS),
-                                                css=render_template('main.css'),
-                                                script=render_template('main.js')),
-                                mimetype=mime_type)
-            except:
-                print(sys.exc_info())
-                raise
+        if cache is not None:
+            key = (cache_key(), mime_type)
+            body = cache.get(key)
+            if body is not None:
+                return Response(body, mimetype=mime_type)
+
+        response = _format(func(*args, **kwargs), mime_type)
+
+        if cache is not None:
+            if response.is_streamed:
+                response.response = _cache_when_complete(response.response, cache, key)
+            else:
+                cache.put(key, response.get_data())
+
+        return response
 
     # flask doesn't like it when the same function is used for multiple endpoints.
     # By using a decorator, we're effectively returning the same function to flask.
@@ -60,6 +62,48 @@ def format_response(func):
     return _wrapper
 
 
+def _format(response_data, mime_type: str) -> Response:
+    """Serialize the response data to the mime type. The data is a dict, or
+    an iterable of (key, value) pairs. The CSV and HTML tables are streamed,
+    a row at a time, while the pairs are being generated."""
+
+    if mime_type in ('application/json', 'application/yaml'):
+        response_data = dict(_items(response_data))
+
+        if mime_type == 'application/json':
+            return Response(dumps(response_data), mimetype=mime_type)
+        return Response(yaml.dump(response_data, default_flow_style=False), mimetype=mime_type)
+
+    rows = _table_rows(response_data)
+    if mime_type in ('text/csv', 'text/plain'):
+        return Response(csv_chunks(rows, HEADERS), mimetype=mime_type)
+    else:
+        # the page around the table is rendered now, while there's an app context
+        head, tail = render_template('main.html', table=TABLE_MARKER,
+                                     css=render_template('main.css'),
+                                     script=render_template('main.js')).split(TABLE_MARKER)
+
+        return Response(_html_page(head, html_chunks(rows, HEADERS), tail), mimetype=mime_type)
+
+
+def _cache_when_complete(chunks: Iterable, cache: ResponseCache, key: Hashable) -> Iterator[bytes]:
+    """Pass the chunks of a streamed response through, caching the whole
+    body once it's complete, unless it grows too big to be cached."""
+
+    body, size = [], 0
+    for chunk in chunks:
+        chunk = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        if body is not None:
+            body.append(chunk)
+            size += len(chunk)
+            if size > cache.max_bytes:
+                body = None
+        yield chunk
+
+    if body is not None:
+        cache.put(key, b''.join(body))
+
+
 def show_page(page_name, **kwargs):
     """Show the named page from the templates folder, filling
     in any page variables with the given keyword args."""
@@ -104,23 +148,47 @@ def load_template(template_file, **kwargs):
     return template_content.format(**kwargs)
 
 
+def _items(response_data) -> Iterable[Tuple]:
+    return response_data.items() if isinstance(response_data, dict) else response_data
+
+
+def _table_rows(response_data) -> Iterator[dict]:
+    """Reformat the data to table rows, one dict per departure."""
+
+    for stop_number, stop_data in _items(response_data):
+        for stop in stop_data['departures']:
+            yield {'stop_id': stop_number,
+                   'stop_name': stop_data['stop_name'],
+                   'route': stop['route'],
+                   'headsign':stop['headsign'],
+                   'agency': stop['agency'],
+                   'scheduled_arrival': to_iso_date(stop['scheduled_arrival']),
+                   'estimated_arrival': to_iso_date(stop['real_time_arrival'])}
+
+
 def _flatten_response_data(response_data) -> List[dict]:
     """Reformat the data to a table-ready format"""
+    return list(_table_rows(response_data))
+
+
+# the number of rows written to each chunk of a streamed CSV response.
+CSV_CHUNK_ROWS = 100
+
+def csv_chunks(rows: Iterable[dict], headers: List[str]) -> Iterator[str]:
+    """Generate the text of a CSV file in chunks, starting with the header."""
+
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=headers, quoting=csv.QUOTE_MINIMAL)
+    writer.writeheader()
+
+    for n, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if n % CSV_CHUNK_ROWS == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
 
-    # reformat the data provided into a list of dictionaries
-    # one line of the table per dict.
-    return [
-        { 'stop_id': stop_number,
-          'stop_name': stop_data['stop_name'],
-          'route': stop['route'],
-          'headsign':stop['headsign'],
-          'agency': stop['agency'],
-          'scheduled_arrival': to_iso_date(stop['scheduled_arrival']),
-          'estimated_arrival': to_iso_date(stop['real_time_arrival'])
-        }
-        for stop_number, stop_data in response_data.items()
-        for stop in stop_data['arrivals']
-    ]
+    yield output.getvalue()
 
 
 def csv_table(table: List[dict], headers: Optional[List[str]] = None) -> str:
@@ -130,12 +198,7 @@ def csv_table(table: List[dict], headers: Optional[List[str]] = None) -> str:
     # if there's at least one element in the `table`
     headers = headers or (list(table[0].keys()) if table else [])
 
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=headers, quoting=csv.QUOTE_MINIMAL)
-    writer.writeheader()
-    writer.writerows(table)
-
-    return output.getvalue()
+    return ''.join(csv_chunks(table, headers))
 
 
 
@@ -146,16 +209,32 @@ TABLE_TEMPLATE = """
 </table>
 """
 
+# marks where the table goes in a page, which is rendered before the table is.
+TABLE_MARKER = '<!-- departures table -->'
+
 def _table_row(row: dict, headers: List[str], tag='td'):
     """Format a HTML row in the same order as the headers."""
     return '<tr>' + ('\n'.join([f'<{tag}>{row.get(h)}</{tag}>' for h in headers])) + '</tr>'
 
+def html_chunks(rows: Iterable[dict], headers: List[str]) -> Iterator[str]:
+    """Generate the text of a HTML table, a row at a time."""
+
+    header_str = _table_row({h:h for h in headers}, headers, tag='th')
+    start, end = TABLE_TEMPLATE.split('{rows}')
+
+    yield start.format(headers=header_str)
+    for n, row in enumerate(rows):
+        yield ('\n' if n else '') + _table_row(row, headers)
+    yield end
+
 def html_table(table: List[dict], headers: Optional[List[str]] = None) -> str:
     """convert a list of dictionaries to the text of a HTML table."""
 
     headers = headers or (list(table[0].keys()) if table else [])
+    return ''.join(html_chunks(table, headers))
 
-    header_str = _table_row({h:h for h in headers}, headers, tag='th')
-    rows_str = '\n'.join([_table_row(r, headers) for r in table])
 
-    return TABLE_TEMPLATE.format(headers=header_str, rows=rows_str)
+def _html_page(head: str, table: Iterable[str], tail: str) -> Iterator[str]:
+    yield head
+    yield from table
+    yield tail
@@ -0,0 +1,52 @@
+"""JSON serialization of the API responses. orjson is used if it's installed,
+it writes datetimes natively and is several times faster than the json
+module, which is used otherwise. Both write compact JSON with sorted keys
+and datetimes as ISO 8601 strings, the same as the flask JSON provider."""
+
+import json
+import datetime
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data) -> bytes:
+    """Serialize the data to JSON, encoded as UTF-8."""
+
+    if orjson is not None:
+        return _orjson_dumps(data)
+
+    return json.dumps(data, default=_default, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _orjson_dumps(data) -> bytes:
+    # orjson sorts keys that aren't strings as the strings they're written
+    # as, "1358" before "271", where the json module sorts them as numbers.
+    # So dicts with such keys at the top of the data, like the departures by
+    # stop number, are written here in the order the json module uses.
+    if isinstance(data, dict) and not all(isinstance(key, str) for key in data):
+        items = (orjson.dumps(key if isinstance(key, str) else json.dumps(key))
+                 + b':' + _orjson_dumps(value) for key, value in sorted(data.items()))
+        return b'{' + b','.join(items) + b'}'
+
+    return orjson.dumps(data, default=_default,
+                        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS)
+
+
+def _default(obj):
+    """Serialize the types neither serializer handles by itself."""
+
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    elif isinstance(obj, np.datetime64):
+        # nanosecond datetimes convert to an int, not a datetime
+        return obj.astype('datetime64[us]').item().isoformat()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
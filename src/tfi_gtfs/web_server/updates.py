@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+from typing import Callable, Hashable, Optional, Set, Tuple
+
+
+# the notifier is kept in the flask app extensions under this name, so the
+# ASGI adapter can wait for new data in the event loop rather than a thread.
+EXTENSION_NAME = 'tfi_gtfs.updates'
+
+# set in the WSGI environ by the ASGI adapter, a long-poll request is then
+# answered straight away, with the number of seconds left to wait in the
+# WAIT_HEADER, and the adapter calls the app again when the data changes.
+ASYNC_WAIT = 'tfi_gtfs.async_wait'
+WAIT_HEADER = 'X-Wait-Timeout'
+
+# how often the generation of the data is checked, as well as each time
+# notify() is called. Worker processes have no update callbacks, the new
+# data is published to them, so this is how soon they notice it.
+CHECK_INTERVAL = 0.5
+
+
+class UpdateNotifier:
+    """Wakes the requests waiting for new data. `generation()` returns a
+    value that changes whenever the data changes, it's checked by a
+    watcher thread every CHECK_INTERVAL seconds, and whenever `notify()`
+    is called, e.g. by a GTFS update callback. Requests can wait from a
+    thread, or from an event loop."""
+
+    def __init__(self, generation: Callable[[], Hashable], interval: float = CHECK_INTERVAL):
+        self._generation = generation
+        self._interval = interval
+
+        self._seen = None
+        self._changed = threading.Condition()
+        self._futures: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = set()
+
+        self._check_now = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+
+    @property
+    def generation(self) -> Hashable:
+        return self._generation()
+
+    def notify(self, *args):
+        """Check the generation now, any arguments are ignored, so this can be
+        registered as a GTFS update callback."""
+        self._check_now.set()
+
+    def wait(self, seen: Hashable, timeout: float) -> bool:
+        """Wait until the generation is no longer `seen`, or the timeout
+        passes, returning True if it changed."""
+
+        self._start()
+        with self._changed:
+            return self._changed.wait_for(lambda: self.generation != seen, timeout)
+
+    async def wait_async(self, seen: Hashable, timeout: float) -> bool:
+        """The same as `wait()`, from an event loop."""
+
+        self._start()
+
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._changed:
+            self._futures.add(waiter)
+
+        try:
+            if self.generation == seen:
+                await asyncio.wait([waiter[1]], timeout=timeout)
+        finally:
+            with self._changed:
+                self._futures.discard(waiter)
+
+        return self.generation != seen
+
+    def _start(self):
+        with self._changed:
+            if self._watcher is None:
+                self._seen = self.generation
+                self._watcher = threading.Thread(target=self._watch, name='update-notifier',
+                                                 daemon=True)
+                self._watcher.start()
+
+    def _watch(self):
+        while True:
+            self._check_now.wait(self._interval)
+            self._check_now.clear()
+
+            generation = self.generation
+            if generation == self._seen:
+                continue
+
+            self._seen = generation
+            with self._changed:
+                self._changed.notify_all()
+                for loop, future in self._futures:
+                    try:
+                        loop.call_soon_threadsafe(_set_done, future)
+                    except RuntimeError:
+                        pass    # the loop has been closed
+
+
+def _set_done(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
@@ -1,7 +1,10 @@
 
+import socket
 import datetime
 import waitress
 
+from typing import NamedTuple
+
 from flask import Flask
 from flask_cors import CORS
 from flask.json.provider import DefaultJSONProvider
@@ -34,7 +37,31 @@ def to_iso_date(d):
     return ""
 
 
-def serve_forever(app: Flask, host, port, threads=1):
+class ServerOptions(NamedTuple):
+    """The waitress settings of each serving process, the defaults are the
+    waitress defaults."""
+
+    # the number of threads handling requests
+    threads: int = 4
+
+    # the number of open connections, beyond which new connections wait
+    connection_limit: int = 100
+
+    # the length of the queue of connections waiting to be accepted
+    backlog: int = 1024
+
+    # idle connections are closed after this many seconds
+    channel_timeout: int = 120
+
+
+def serve_forever(app: Flask, host, port, options: ServerOptions = ServerOptions()):
     """Launch the webserver."""
 
-    waitress.serve(app, host=host, port=port, threads=threads)
+    waitress.serve(app, host=host, port=port, **options._asdict())
+
+
+def serve_socket(app: Flask, sock: socket.socket, options: ServerOptions = ServerOptions()):
+    """Launch the webserver on a socket that is already listening, which can be
+    shared by several processes."""
+
+    waitress.serve(app, sockets=[sock], **options._asdict())
@@ -0,0 +1,84 @@
+"""Serve the API from several worker processes. The main process owns the
+download agents and publishes every update to the workers, which share
+the static assets through the memory mapped snapshot and accept
+connections on the same listening socket."""
+
+import sys
+import signal
+import socket
+import logging
+import multiprocessing
+import multiprocessing.connection
+
+from .gtfs import GTFS
+from .gtfs.shared import SharedState, WorkerGTFS
+from .logger import log_to_stderr
+from .web_routes import register_routes
+from .web_server import build_flask_app, serve_socket, serve_async_socket, ServerOptions
+from . import settings
+
+
+log = logging.getLogger(__name__)
+
+
+def serve_with_workers(gtfs: GTFS, host, port, workers: int,
+                       options: ServerOptions = ServerOptions(), server='waitress',
+                       debug=False, verbose=False):
+    """Publish the data from `gtfs` and serve it from `workers` processes,
+    restarting any worker that exits. This function never returns."""
+
+    sock = socket.create_server((host, port), backlog=options.backlog)
+
+    shared = SharedState.create(settings.REALTIME_BUFFER_SIZE)
+    gtfs.register_update_callback(shared.publish)
+    shared.publish(gtfs)
+
+    # spawn rather than fork, the download agent threads are already running.
+    ctx = multiprocessing.get_context('spawn')
+    worker_args = (shared.name, settings.SNAPSHOT_DIR, sock, options, server, debug, verbose)
+
+    def start_worker(n):
+        process = ctx.Process(target=run_worker, name=f'worker-{n}',
+                              args=worker_args, daemon=True)
+        process.start()
+        return process
+
+    processes = [start_worker(n) for n in range(workers)]
+    log.info(f'Serving on http://{host}:{port} with {workers} worker processes, '
+             f'{options.threads} threads each')
+
+    # exit normally on SIGTERM, e.g. from `docker stop`, so the shared memory is released.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    try:
+        while True:
+            multiprocessing.connection.wait([p.sentinel for p in processes])
+
+            for n, process in enumerate(processes):
+                if not process.is_alive():
+                    log.error(f'{process.name} exited with code {process.exitcode}, restarting...')
+                    processes[n] = start_worker(n)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for process in processes:
+            process.terminate()
+            process.join()
+        sock.close()
+        shared.close()
+
+
+def run_worker(shared_state_name: str, snapshot_dir: str,
+               sock: socket.socket, options: ServerOptions = ServerOptions(),
+               server='waitress', debug=False, verbose=False):
+    """The entrypoint of a worker process."""
+
+    log_to_stderr(debug, verbose)
+
+    shared = SharedState.attach(shared_state_name)
+    gtfs = WorkerGTFS(shared, snapshot_dir)
+
+    app = build_flask_app()
+    register_routes(app, gtfs, None if server == 'async' else options.threads)
+
+    serve = serve_async_socket if server == 'async' else serve_socket
+    serve(app, sock, options)
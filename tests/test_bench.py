@@ -0,0 +1,47 @@
+import json
+import tempfile
+
+from tfi_gtfs import bench
+
+from test_static_asset_parser import STATIC_ASSETS
+from test_realtime_data_parser import REALTIME_DATA
+
+
+RESULT_KEYS = {'repeat', 'mean_ms', 'p50_ms', 'p99_ms', 'min_ms', 'max_ms',
+               'throughput', 'peak_rss'}
+
+
+def test_measure():
+    calls = []
+    result = bench.measure(lambda: calls.append(1), repeat=5, items=10, warmup=2)
+
+    assert len(calls) == 7
+    assert set(result) == RESULT_KEYS
+    assert result['min_ms'] <= result['p50_ms'] <= result['p99_ms'] <= result['max_ms']
+
+
+def test_run_benchmarks():
+    results = bench.run_benchmarks(STATIC_ASSETS, REALTIME_DATA, repeat=2,
+                                   only=['static.load.stops', 'realtime', 'departures', 'format'])
+
+    assert {'static.load.stops', 'realtime.decode', 'departures.single', 'departures.multi',
+            'format.application/json', 'format.text/html'} <= set(results)
+    assert 'static.load.stop_times' not in results
+    assert all(set(r) == RESULT_KEYS for r in results.values())
+
+
+def test_results_file_and_compare():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        old, new = f'{tmp_dir}/old.json', f'{tmp_dir}/new.json'
+        args = ['--static-assets', STATIC_ASSETS, '--realtime-data', REALTIME_DATA,
+                '--repeat', '2', '--only', 'realtime']
+
+        bench.main(args + ['--output', old])
+        bench.main(args + ['--output', new, '--compare', old])
+
+        with open(old) as f_old, open(new) as f_new:
+            old, new = json.load(f_old), json.load(f_new)
+
+    assert old['version'] == bench.RESULTS_VERSION
+    assert list(new['results']) == ['realtime.decode']
+    assert set(bench.compare(old, new)) == {'realtime.decode'}
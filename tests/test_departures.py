@@ -0,0 +1,151 @@
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+from tfi_gtfs.gtfs import CachedGTFS
+from tfi_gtfs.gtfs import gtfs as gtfs_module
+
+from test_static_asset_parser import STATIC_ASSETS
+from test_realtime_data_parser import REALTIME_DATA
+
+
+DEPARTURE_KEYS = {'route', 'headsign', 'agency', 'scheduled_arrival', 'real_time_arrival'}
+
+
+class DeparturesTestCase(unittest.TestCase):
+    """Test the departures query engine."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.gtfs = CachedGTFS(static_assets_path=STATIC_ASSETS,
+                              realtime_data_path=REALTIME_DATA)
+
+    def test_departures_in_window(self):
+        now = datetime.now().replace(hour=10, minute=0)
+        departures = self.gtfs.get_scheduled_departures(271, now, timedelta(minutes=90))
+
+        self.assertGreater(len(departures), 0)
+        for d in departures:
+            self.assertEqual(DEPARTURE_KEYS, set(d.keys()))
+            self.assertLess(d['scheduled_arrival'], now + timedelta(minutes=90))
+            self.assertTrue(d['scheduled_arrival'] >= now or d['real_time_arrival'] >= now)
+
+    def test_departures_sorted(self):
+        now = datetime.now().replace(hour=10, minute=0)
+        departures = self.gtfs.get_scheduled_departures(271, now, timedelta(minutes=90))
+
+        expected = [d['real_time_arrival'] or d['scheduled_arrival'] for d in departures]
+        self.assertEqual(expected, sorted(expected))
+
+    def test_departures_after_midnight(self):
+        now = datetime.now().replace(hour=23, minute=50)
+        departures = self.gtfs.get_scheduled_departures(271, now, timedelta(minutes=90))
+
+        self.assertTrue(any(d['scheduled_arrival'].date() > now.date() for d in departures))
+
+    def test_added_trips(self):
+        added = self.gtfs.realtime_snapshot.added
+        if added.empty:
+            self.skipTest('no added trips in the realtime data')
+
+        # look for departures from just before the first added trip
+        first = datetime.fromtimestamp(added.time.min(), tz=timezone.utc) - timedelta(minutes=1)
+        departures = self.gtfs.get_scheduled_departures(271, first,
+                                                 timedelta(minutes=90))
+        self.assertTrue(any(d['headsign'] == '' for d in departures))
+
+    def test_unknown_stop(self):
+        departures = self.gtfs.get_scheduled_departures(999999, datetime.now(),
+                                                        timedelta(minutes=90))
+        self.assertEqual(departures, [])
+
+    def test_departures_for_stops(self):
+        now = datetime.now().replace(hour=10, minute=0)
+        stops = [5, 271, 999999, 5, 12]
+        departures = self.gtfs.get_departures_for_stops(stops, now, timedelta(minutes=90))
+
+        # unknown and repeated stops are left out, the rest are in order
+        self.assertEqual(list(departures), [5, 271, 12])
+        for stop_number, stop_departures in departures.items():
+            self.assertEqual(stop_departures, self.gtfs.get_scheduled_departures(
+                                                  stop_number, now, timedelta(minutes=90)))
+
+        self.assertEqual(self.gtfs.get_departures_for_stops([], now, timedelta(minutes=90)), {})
+
+
+class StaticAssetRefreshTestCase(unittest.TestCase):
+    """Test replacing the static assets with a new generation."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.gtfs = CachedGTFS(static_assets_path=STATIC_ASSETS,
+                               realtime_data_path=REALTIME_DATA,
+                               snapshot_dir=self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_unchanged_zip_is_not_swapped(self):
+        self.assertEqual(1, self.gtfs.static_asset_generation)
+
+        self.gtfs.new_static_assets(STATIC_ASSETS)
+        self.assertEqual(1, self.gtfs.static_asset_generation)
+
+    def test_old_generation_is_torn_down(self):
+        old = self.gtfs.static_assets
+
+        with mock.patch.object(gtfs_module, 'RETIRE_DELAY', 0):
+            self.gtfs.load_latest_snapshot()
+
+        self.assertEqual(2, self.gtfs.static_asset_generation)
+        self.assertIsNot(old, self.gtfs.static_assets)
+
+        old._cal_refresh.join(timeout=5)
+        self.assertFalse(old._cal_refresh.is_alive())
+
+        now = datetime.now().replace(hour=10, minute=0)
+        self.assertGreater(len(self.gtfs.get_scheduled_departures(271, now, timedelta(minutes=90))), 0)
+
+    def test_queries_during_swaps(self):
+        """Departures are the same while the static assets and realtime data
+        are being replaced by another thread."""
+
+        now = datetime.now().replace(hour=10, minute=0)
+        stops = [5, 271, 12]
+        expected = self.gtfs.get_departures_for_stops(stops, now, timedelta(minutes=90))
+
+        with open(REALTIME_DATA, 'rb') as f:
+            realtime_data = f.read()
+
+        done, errors = threading.Event(), []
+        swaps = self.gtfs.static_asset_generation + 3
+
+        def swap():
+            while not done.is_set():
+                self.gtfs.load_latest_snapshot()
+                self.gtfs.new_realtime_data(realtime_data)
+
+        def query():
+            try:
+                # keep querying until the assets have been swapped a few times
+                while self.gtfs.static_asset_generation < swaps and swapper.is_alive():
+                    departures = self.gtfs.get_departures_for_stops(stops, now,
+                                                                    timedelta(minutes=90))
+                    self.assertEqual(expected, departures)
+            except Exception as e:
+                errors.append(e)
+
+        swapper = threading.Thread(target=swap)
+        readers = [threading.Thread(target=query) for _ in range(4)]
+        swapper.start()
+        for t in readers:
+            t.start()
+        for t in readers:
+            t.join()
+        done.set()
+        swapper.join()
+
+        self.assertEqual([], errors)
+        self.assertGreater(self.gtfs.static_asset_generation, 2)
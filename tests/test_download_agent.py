@@ -1,11 +1,16 @@
 
+import os
+import time
+import tempfile
+import threading
 import unittest
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from tfi_gtfs.gtfs import seconds_until_timestamp
 from tfi_gtfs.gtfs import next_scheduled_exec_time
 
-from tfi_gtfs.gtfs.downloader import DownloadAgent
+from tfi_gtfs.gtfs.downloader import DownloadAgent, ResponseType
 from tfi_gtfs.gtfs.downloader import cache_control_sleep, expires_sleep
 
 
@@ -83,3 +88,120 @@ class StaticAssetsTestCase(unittest.TestCase):
         etag = da.etag_header
         self.assertIsInstance(etag, str)
         self.assertEqual(len(etag), 23)
+
+
+class ConditionalResourceHandler(BaseHTTPRequestHandler):
+    """Serves a resource with an Etag, replying 304 when it's unchanged."""
+
+    protocol_version = 'HTTP/1.1'   # keep connections alive
+
+    etag = '"v1"'
+    delay = 0
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        time.sleep(self.delay)
+
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = self.etag.encode()
+        self.send_response(200)
+        self.send_header('Etag', self.etag)
+        self.send_header('Last-Modified', 'Wed, 18 Jun 2025 21:57:36 GMT')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ConditionalGetTestCase(unittest.TestCase):
+    """Test the revalidation of resources with conditional requests."""
+
+    def setUp(self):
+        ConditionalResourceHandler.etag = '"v1"'
+        ConditionalResourceHandler.delay = 0
+        ConditionalResourceHandler.requests = []
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ConditionalResourceHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.received = []
+        self.agent = DownloadAgent('test', f'http://127.0.0.1:{self.server.server_port}/',
+                                   None, None)
+        self.agent.register_callback(self.received.append, ResponseType.Bytes)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_unchanged_resource(self):
+        self.assertTrue(self.agent._update())
+        self.assertTrue(self.agent._update())
+
+        # the second request is revalidated and the callback isn't executed again
+        self.assertEqual([b'"v1"'], self.received)
+        self.assertEqual('"v1"', ConditionalResourceHandler.requests[1]['If-None-Match'])
+        self.assertEqual('Wed, 18 Jun 2025 21:57:36 GMT',
+                         ConditionalResourceHandler.requests[1]['If-Modified-Since'])
+        self.assertEqual(2, len(ConditionalResourceHandler.requests))
+
+    def test_changed_resource(self):
+        self.agent._update()
+        ConditionalResourceHandler.etag = '"v2"'
+        self.agent._update()
+
+        self.assertEqual([b'"v1"', b'"v2"'], self.received)
+
+    def test_failed_callback_is_retried(self):
+        def failing_callback(data):
+            raise ValueError('invalid data')
+
+        self.agent.register_callback(failing_callback, ResponseType.Bytes)
+
+        self.assertFalse(self.agent._update())
+        self.assertFalse(self.agent._update())
+
+        # without validators, the resource is downloaded again
+        self.assertNotIn('If-None-Match', ConditionalResourceHandler.requests[1])
+
+    def test_connection_is_reused(self):
+        ConditionalResourceHandler.etag = '"v2"'
+        for _ in range(3):
+            self.agent._update()
+
+        self.assertEqual(3, self.agent.metrics.requests)
+        self.assertEqual(1, self.agent.metrics.connections)
+        self.assertIn('gzip', ConditionalResourceHandler.requests[0]['Accept-Encoding'])
+
+    def test_read_timeout(self):
+        ConditionalResourceHandler.delay = 0.5
+        self.agent.set_timeouts(connect=1, read=0.1)
+
+        self.assertFalse(self.agent._update())
+        self.assertEqual([], self.received)
+
+    def test_file_callback(self):
+        files = []
+
+        def file_callback(path):
+            with open(path, 'rb') as f:
+                files.append((path, f.read()))
+
+        with tempfile.TemporaryDirectory() as download_dir:
+            self.agent.register_callback(file_callback, ResponseType.File)
+            self.agent.set_download_dir(download_dir)
+
+            self.assertTrue(self.agent._update())
+
+            # both callback types get the content, and the file is removed afterwards
+            self.assertEqual([b'"v1"'], self.received)
+            self.assertEqual(b'"v1"', files[0][1])
+            self.assertEqual(download_dir, os.path.dirname(files[0][0]))
+            self.assertEqual([], os.listdir(download_dir))
+
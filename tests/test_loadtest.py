@@ -0,0 +1,46 @@
+import numpy as np
+
+from tfi_gtfs import loadtest
+
+
+def test_request_mix():
+    mix = loadtest.RequestMix(list(range(100)), {'application/json': 3, 'text/csv': 1})
+
+    requests = mix.requests(0, 2000)
+    assert requests == mix.requests(0, 2000)
+    assert requests != mix.requests(1, 2000)
+
+    # the most popular stop is requested far more often than the median one
+    stops = [int(path.rsplit('=', 1)[1]) for path, _ in requests]
+    counts = np.sort(np.bincount(stops, minlength=100))[::-1]
+    assert counts[0] > 10 * counts[50]
+
+    accepts = [accept for _, accept in requests]
+    assert 0.65 < accepts.count('application/json') / len(accepts) < 0.85
+
+
+def test_summarise():
+    result = loadtest.summarise(np.array([0.0005, 0.003, 0.003, 0.2]), errors=1, duration=2)
+
+    assert result['requests'] == 5
+    assert result['error_rate'] == 0.2
+    assert result['throughput'] == 2
+    assert result['histogram']['<=1ms'] == 1
+    assert result['histogram']['<=5ms'] == 2
+    assert result['histogram']['<=200ms'] == 1
+    assert sum(result['histogram'].values()) == 4
+
+    assert loadtest.summarise(np.array([]), errors=0, duration=1)['latency_ms']['p50'] is None
+
+
+def test_load_test(monkeypatch):
+    # the cached mode server reads the test data relative to the project root
+    monkeypatch.chdir('..')
+
+    mix = loadtest.RequestMix(loadtest.cached_stop_numbers(), loadtest.DEFAULT_ACCEPT_MIX)
+    result = loadtest.run_load_test(loadtest.LoadSetting(workers=1, threads=2, concurrency=2),
+                                    mix, duration=1)
+
+    assert result['requests'] > 0
+    assert result['errors'] == 0
+    assert result['threads'] == 2
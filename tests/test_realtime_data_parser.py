@@ -17,5 +17,36 @@ class RealtimeDataTestCase(unittest.TestCase):
     def test_header(self):
         self.assertIsInstance(self.realtime_data.timestamp, int)
 
+    def test_one_row_per_stop_time_update(self):
+        feed = self.realtime_data._feed
+        n_updates = sum(len(e.trip_update.stop_time_update) for e in feed.entity)
+        self.assertEqual(n_updates, len(self.realtime_data.dataframe))
+
+    def test_trip_columns_match_feed(self):
+        df = self.realtime_data.dataframe
+        entity = next(e for e in self.realtime_data._feed.entity
+                      if len(e.trip_update.stop_time_update) > 0)
+
+        rows = df[df.id.eq(entity.id)]
+        self.assertEqual(len(entity.trip_update.stop_time_update), len(rows))
+        self.assertTrue(rows.trip_id.eq(entity.trip_update.trip.trip_id).all())
+        self.assertEqual(entity.trip_update.trip.start_date,
+                         rows.start.iloc[0].strftime('%Y%m%d'))
+        self.assertEqual([u.stop_id for u in entity.trip_update.stop_time_update],
+                         list(rows.stop_id))
+
+    def test_trip_filter(self):
+        df = self.realtime_data.dataframe
+        trip_id, stop_id = df.trip_id.iloc[0], df.stop_id.iloc[-1]
+
+        with open(REALTIME_DATA, 'rb') as f:
+            filtered = RealtimeData(f.read(), trip_filter=({trip_id}, {stop_id}))
+
+        kept = filtered.dataframe
+        self.assertLess(len(kept), len(df))
+        self.assertTrue(kept.trip_id.eq(trip_id).any())
+        for _, rows in kept.groupby('id', observed=True):
+            self.assertTrue(rows.trip_id.eq(trip_id).all() or rows.stop_id.eq(stop_id).any())
+
     def test_dataframe_export(self):
         self.realtime_data.dataframe.to_csv('realtime_data.csv', index=False)
@@ -0,0 +1,88 @@
+import unittest
+
+import numpy as np
+from google.transit import gtfs_realtime_pb2 as gtfsr
+
+from tfi_gtfs.gtfs import RealtimeData
+from tfi_gtfs.gtfs.constants import Trip
+from tfi_gtfs.gtfs.realtime_store import RealtimeStore, DELAY_MAX_AGE
+
+
+def build_feed(timestamp, trips):
+    """Build a realtime feed from a dict of trip_id -> (relationship, [(stop_sequence, delay)])."""
+
+    feed = gtfsr.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = timestamp
+
+    for trip_id, (relationship, updates) in trips.items():
+        entity = feed.entity.add()
+        entity.id = trip_id
+        entity.trip_update.trip.trip_id = trip_id
+        entity.trip_update.trip.route_id = 'R1'
+        entity.trip_update.trip.start_date = '20250615'
+        entity.trip_update.trip.start_time = '10:00:00'
+        entity.trip_update.trip.schedule_relationship = relationship
+
+        for stop_sequence, delay in updates:
+            update = entity.trip_update.stop_time_update.add()
+            update.stop_sequence = stop_sequence
+            update.stop_id = f'STOP{stop_sequence}'
+            update.departure.delay = delay
+
+    return RealtimeData(feed.SerializeToString())
+
+
+class RealtimeStoreTestCase(unittest.TestCase):
+    """Test the merging of realtime feeds into the realtime store."""
+
+    def setUp(self):
+        self.store = RealtimeStore()
+        self.store.merge(build_feed(1000, {'A': (Trip.Scheduled, [(1, 60), (5, 120)]),
+                                           'B': (Trip.Scheduled, [(2, 30)])}))
+
+    def delays(self, trip_ids, stop_sequences):
+        delays, _ = self.store.snapshot().departure_delays(np.array(trip_ids),
+                                                           np.array(stop_sequences))
+        return delays
+
+    def test_delays(self):
+        np.testing.assert_array_equal(self.delays(['A', 'A', 'B', 'C'], [1, 5, 2, 1]),
+                                      [60, 120, 30, np.nan])
+
+    def test_delay_propagates_to_later_stops(self):
+        np.testing.assert_array_equal(self.delays(['A', 'A', 'B'], [3, 9, 1]),
+                                      [60, 120, np.nan])
+
+    def test_arrival_only_updates(self):
+        feed = gtfsr.FeedMessage()
+        feed.header.gtfs_realtime_version = '2.0'
+        feed.header.timestamp = 1060
+
+        entity = feed.entity.add()
+        entity.id = entity.trip_update.trip.trip_id = 'A'
+        first, last = entity.trip_update.stop_time_update.add(), entity.trip_update.stop_time_update.add()
+        first.stop_sequence, first.departure.delay = 1, 60
+        last.stop_sequence, last.arrival.delay = 5, 300
+
+        self.store.merge(RealtimeData(feed.SerializeToString()))
+        np.testing.assert_array_equal(self.delays(['A', 'A'], [1, 5]), [60, 300])
+
+    def test_trips_missing_from_feed_are_kept(self):
+        self.store.merge(build_feed(1060, {'B': (Trip.Scheduled, [(2, 90)])}))
+
+        np.testing.assert_array_equal(self.delays(['A', 'B'], [1, 2]), [60, 90])
+        self.assertEqual(2, self.store.generation)
+
+    def test_old_updates_expire(self):
+        self.store.merge(build_feed(1000 + DELAY_MAX_AGE + 60,
+                                    {'B': (Trip.Scheduled, [(2, 90)])}))
+
+        np.testing.assert_array_equal(self.delays(['A', 'B'], [1, 2]), [np.nan, 90])
+        self.assertEqual(1, len(self.store))
+
+    def test_cancelled_trips(self):
+        self.store.merge(build_feed(1060, {'A': (Trip.Cancelled, [])}))
+
+        np.testing.assert_array_equal(self.store.snapshot().is_cancelled(np.array(['A', 'B'])),
+                                      [True, False])
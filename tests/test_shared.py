@@ -0,0 +1,198 @@
+import time
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+
+from tfi_gtfs.gtfs import CachedGTFS, StaticAssets
+from tfi_gtfs.gtfs import shared
+from tfi_gtfs.gtfs.shared import SharedState, WorkerGTFS
+from tfi_gtfs.gtfs.realtime_store import RealtimeSnapshot
+
+from test_static_asset_parser import STATIC_ASSETS
+from test_realtime_data_parser import REALTIME_DATA
+
+
+class SharedStateTestCase(unittest.TestCase):
+    """Test publishing the GTFS data to worker processes."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.gtfs = CachedGTFS(static_assets_path=STATIC_ASSETS,
+                               realtime_data_path=REALTIME_DATA,
+                               snapshot_dir=self.tmp_dir.name)
+
+        self.shared = SharedState.create(buffer_size=8 * 1024 * 1024)
+        self.worker_state = SharedState.attach(self.shared.name)
+
+    def tearDown(self):
+        self.worker_state.close()
+        self.shared.close()
+        self.tmp_dir.cleanup()
+
+    def test_nothing_published(self):
+        self.assertEqual((0, None), self.worker_state.read_static_assets())
+        self.assertEqual((0, None), self.worker_state.read_realtime())
+
+    def test_publish(self):
+        self.shared.publish(self.gtfs)
+
+        _, key = self.worker_state.read_static_assets()
+        self.assertEqual(self.gtfs.static_assets.key, key)
+
+        _, snapshot = self.worker_state.read_realtime()
+        self.assertEqual(self.gtfs.realtime_snapshot.generation, snapshot.generation)
+        self.assertEqual(len(self.gtfs.realtime_snapshot.added), len(snapshot.added))
+
+    def test_snapshot_not_written(self):
+        # static assets without a snapshot can't be loaded by the workers
+        with tempfile.TemporaryDirectory() as snapshot_dir, \
+                mock.patch.object(StaticAssets, 'save_snapshot', side_effect=OSError('disk full')):
+            gtfs = CachedGTFS(static_assets_path=STATIC_ASSETS, realtime_data_path=REALTIME_DATA,
+                              snapshot_dir=snapshot_dir)
+
+        self.assertIsNone(gtfs.static_assets.snapshot_path)
+        self.shared.publish(gtfs)
+
+        self.assertEqual((0, None), self.worker_state.read_static_assets())
+        self.assertEqual(gtfs.realtime_snapshot.generation,
+                         self.worker_state.read_realtime()[1].generation)
+
+    def test_publish_from_threads(self):
+        """Both download agents and the main thread publish, every update
+        is published once and the buffers aren't written at the same time."""
+
+        arrays = self.gtfs.realtime_snapshot.to_arrays()
+        publishes = 20
+
+        def updates(first: int):
+            for generation in range(first, 2 * publishes, 2):
+                static_assets = mock.Mock(key=f'key-{generation}', snapshot_path='snapshot')
+                snapshot = RealtimeSnapshot.from_arrays({**arrays, 'generation': generation})
+                yield mock.Mock(static_assets=static_assets, realtime_snapshot=snapshot)
+
+        def publisher(first: int):
+            for gtfs in updates(first):
+                self.shared.publish(gtfs)
+
+        write_arrays = shared._write_arrays
+
+        def slow_write(buf, arrays):
+            time.sleep(0.001)
+            write_arrays(buf, arrays)
+
+        with mock.patch.object(shared, '_write_arrays', side_effect=slow_write):
+            threads = [threading.Thread(target=publisher, args=(first,)) for first in [0, 1]]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        generation, key = self.worker_state.read_static_assets()
+        self.assertEqual(4 * publishes, generation)
+        self.assertEqual(self.shared._published_key, key)
+
+        generation, snapshot = self.worker_state.read_realtime()
+        self.assertEqual(2 * publishes, generation)
+        self.assertEqual(self.shared._published_realtime, snapshot.generation)
+
+    def test_publish_static_assets_from_threads(self):
+        def publisher(name: str):
+            for n in range(100):
+                self.shared.publish_static_assets(f'{name}-{n}')
+
+        threads = [threading.Thread(target=publisher, args=(name,)) for name in 'ab']
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual((400, self.shared._published_key),
+                         self.worker_state.read_static_assets())
+
+    def test_worker_departures(self):
+        self.shared.publish(self.gtfs)
+        worker = WorkerGTFS(self.worker_state, self.tmp_dir.name)
+
+        now = datetime.now().replace(hour=10, minute=0)
+        self.assertEqual(self.gtfs.get_scheduled_departures(271, now, timedelta(minutes=90)),
+                         worker.get_scheduled_departures(271, now, timedelta(minutes=90)))
+
+    def test_worker_follows_updates(self):
+        self.shared.publish(self.gtfs)
+        worker = WorkerGTFS(self.worker_state, self.tmp_dir.name)
+        generation = worker.realtime_snapshot.generation
+
+        with open(REALTIME_DATA, 'rb') as f:
+            self.gtfs.new_realtime_data(f.read())
+        self.shared.publish(self.gtfs)
+
+        self.assertEqual(generation + 1, worker.realtime_snapshot.generation)
+
+    def test_double_buffer(self):
+        # each publication alternates between the two buffers, and a reader
+        # always gets the latest complete snapshot.
+        for n in range(3):
+            with open(REALTIME_DATA, 'rb') as f:
+                self.gtfs.new_realtime_data(f.read())
+            self.shared.publish(self.gtfs)
+
+            generation, snapshot = self.worker_state.read_realtime()
+            self.assertEqual(self.gtfs.realtime_snapshot.generation, snapshot.generation)
+
+            trip_ids = self.gtfs.realtime_snapshot.to_arrays()['trip_ids']
+            np.testing.assert_array_equal(
+                self.gtfs.realtime_snapshot.departure_delays(trip_ids, np.ones(len(trip_ids)))[0],
+                snapshot.departure_delays(trip_ids, np.ones(len(trip_ids)))[0])
+
+    def test_buffer_overwritten_while_read(self):
+        self.shared.publish(self.gtfs)
+        last_read = self.worker_state.read_realtime()
+
+        with open(REALTIME_DATA, 'rb') as f:
+            self.gtfs.new_realtime_data(f.read())
+        self.shared.publish(self.gtfs)
+
+        read_arrays = shared._read_arrays
+
+        def torn_read(buf):
+            # the buffer is overwritten with garbage on every read
+            buf[:shared.TABLE_SIZE] = b'\xff' * shared.TABLE_SIZE
+            return read_arrays(buf)
+
+        with mock.patch.object(shared, '_read_arrays', side_effect=torn_read) as reads:
+            self.assertEqual(last_read, self.worker_state.read_realtime())
+            self.assertEqual(shared.READ_ATTEMPTS, reads.call_count)
+
+    def test_buffer_overwritten_once(self):
+        self.shared.publish(self.gtfs)
+        read_arrays = shared._read_arrays
+
+        def torn_read(buf):
+            # the first read is torn, while the next generation is published
+            if not torn_read.calls:
+                buf[:shared.TABLE_SIZE] = b'\xff' * shared.TABLE_SIZE
+                with open(REALTIME_DATA, 'rb') as f:
+                    self.gtfs.new_realtime_data(f.read())
+                self.shared.publish(self.gtfs)
+            torn_read.calls += 1
+            return read_arrays(buf)
+
+        torn_read.calls = 0
+        with mock.patch.object(shared, '_read_arrays', side_effect=torn_read):
+            generation, snapshot = self.worker_state.read_realtime()
+
+        self.assertEqual(2, torn_read.calls)
+        self.assertEqual(self.shared.generation(shared.REALTIME_GENERATION), generation)
+        self.assertEqual(self.gtfs.realtime_snapshot.generation, snapshot.generation)
+
+    def test_snapshot_too_large(self):
+        shared = SharedState.create(buffer_size=1024)
+        try:
+            shared.publish(self.gtfs)
+            self.assertEqual((0, None), shared.read_realtime())
+        finally:
+            shared.close()
@@ -1,7 +1,13 @@
 
+import os
+import mmap
 import zipfile
+import datetime
+import tempfile
 import unittest
+from unittest import mock
 
+import numpy as np
 import pandas as pd
 
 from tfi_gtfs.gtfs import StaticAssets
@@ -12,6 +18,12 @@ from tfi_gtfs.gtfs import load_agencies
 from tfi_gtfs.gtfs import load_trips, load_stops, load_stop_times
 from tfi_gtfs.gtfs import load_calendar, load_calendar_exceptions
 from tfi_gtfs.gtfs import build_service_calendar
+from tfi_gtfs.gtfs import build_service_bitmask
+from tfi_gtfs.gtfs.constants import CalendarException
+from tfi_gtfs.gtfs.static_assets import load_static_assets, parse_gtfs_times
+from tfi_gtfs.gtfs.snapshot import find_snapshot, snapshot_key
+from tfi_gtfs.gtfs.departure_index import DepartureIndex, NO_DEPARTURE_TIME, ranges_to_rows
+from tfi_gtfs.gtfs import parallel_loader
 
 
 STATIC_ASSETS = '../tests/GTFS.zip'
@@ -62,11 +74,25 @@ class StaticAssetsTestCase(unittest.TestCase):
 
     def test_stop_times(self):
         stop_times = load_stop_times(self.zf)
-        self.assertEqual(len(stop_times.columns), 3)
+        self.assertEqual(len(stop_times.columns), 4)
 
         self.assertEqual('trip_id', stop_times.columns[0])
         self.assertEqual('departure_time', stop_times.columns[1])
         self.assertEqual('stop_id', stop_times.columns[2])
+        self.assertEqual('stop_sequence', stop_times.columns[3])
+        self.assertEqual(np.int32, stop_times.departure_time.dtype)
+
+    def test_parse_gtfs_times(self):
+        times = pd.Series(['00:00:00', '5:01:02', '12:30:59', '25:10:00'])
+        np.testing.assert_array_equal([0, 18062, 45059, 90600], parse_gtfs_times(times))
+
+        # stops that aren't timepoints can have empty times
+        np.testing.assert_array_equal([28800, NO_DEPARTURE_TIME, NO_DEPARTURE_TIME],
+                                      parse_gtfs_times(pd.Series(['08:00:00', None, ''])))
+
+        for invalid in ['12:30', '12-30-00', '1a:00:00', ' ']:
+            with self.assertRaises(ValueError):
+                parse_gtfs_times(pd.Series(['08:00:00', invalid]))
 
     def test_trips(self):
         trips = load_trips(self.zf)
@@ -92,6 +118,222 @@ class StaticAssetsTestCase(unittest.TestCase):
         expanded_cal = build_service_calendar(cal, cal_exc)
         self.assertIsInstance(expanded_cal, pd.DataFrame)
 
+    def test_service_bitmask(self):
+        cal = load_calendar(self.zf)
+        cal_exc = load_calendar_exceptions(self.zf)
+
+        service_cal = build_service_bitmask(cal, cal_exc)
+        expanded_cal = service_cal.to_frame()
+
+        self.assertTrue(service_cal.is_running(expanded_cal.service_id.to_numpy(),
+                                               expanded_cal.date.to_numpy()).all())
+
+        # removed services are not running on the date of the exception
+        removed = cal_exc[cal_exc.exception_type.eq(CalendarException.ServiceRemoved)]
+        self.assertFalse(service_cal.is_running(removed.service_id.to_numpy(),
+                                                removed.date.to_numpy()).any())
+
+        # unknown services, and dates outside the calendar, are never running
+        self.assertFalse(service_cal.is_running(np.array([-1]),
+                                                expanded_cal.date.to_numpy()[:1]).any())
+        self.assertFalse(service_cal.is_running(expanded_cal.service_id.to_numpy()[:1],
+                                                np.array(['2000-01-01'], dtype='datetime64[ns]')).any())
+
+    def test_departure_index(self):
+        sa = StaticAssets.from_file(STATIC_ASSETS)
+        idx = sa._departure_index
+        self.assertEqual(len(idx), len(sa.stop_times))
+
+        stop_code = sa._stop_code(271)
+        stop_slice = idx.stop_slice(stop_code)
+        times = idx.departure_secs[stop_slice]
+        self.assertTrue((times[:-1] <= times[1:]).all())
+
+        window = idx.window(stop_code, 10 * 3600, 11 * 3600)
+        self.assertTrue((idx.departure_secs[window] >= 10 * 3600).all())
+        self.assertTrue((idx.departure_secs[window] < 11 * 3600).all())
+        self.assertEqual(((times >= 10 * 3600) & (times < 11 * 3600)).sum(),
+                         window.stop - window.start)
+
+        # the windows of several stops at once are within each stop's slice,
+        # and times before the service day don't reach the previous stop
+        stop_codes = np.array([stop_code, stop_code, 0, stop_code])
+        starts, ends = np.array([10, 0, 5, -30]) * 3600, np.array([11, 0, 30, 1]) * 3600
+        first, last = idx.windows(stop_codes, starts, ends)
+        for code, start, end, a, b in zip(stop_codes, starts, ends, first, last):
+            stop_slice = idx.stop_slice(code)
+            times = idx.departure_secs[stop_slice]
+            self.assertEqual(a, stop_slice.start + (times < start).sum())
+            self.assertEqual(b - a, ((times >= start) & (times < end)).sum())
+
+        self.assertEqual(ranges_to_rows(first, last).tolist(),
+                         [row for a, b in zip(first, last) for row in range(a, b)])
+
+    def test_untimed_stops_not_indexed(self):
+        stop_times = pd.DataFrame({
+            'trip_id': pd.Categorical(['T1', 'T1', 'T1', 'T2']),
+            'stop_id': pd.Categorical(['S1', 'S2', 'S3', 'S2']),
+            'stop_sequence': [1, 2, 3, 1],
+            'departure_time': parse_gtfs_times(pd.Series(['08:00:00', None, '08:10:00', '09:00:00'])),
+        })
+
+        idx = DepartureIndex.from_stop_times(stop_times)
+        self.assertEqual(3, len(idx))
+        self.assertEqual([0, 1, 2, 3], idx.offsets.tolist())
+        self.assertEqual([8 * 3600, 9 * 3600, 8 * 3600 + 600], idx.departure_secs.tolist())
+        self.assertEqual([1, 1, 3], idx.stop_sequence.tolist())
+
     def test_full_import(self):
         sa = StaticAssets(STATIC_ASSETS)
-        # success if no exceptions thrown.
\ No newline at end of file
+        # success if no exceptions thrown.
+
+    def test_snapshot(self):
+        sa = StaticAssets.from_file(STATIC_ASSETS)
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            path = sa.save_snapshot(snapshot_dir)
+            self.assertEqual(path, find_snapshot(snapshot_dir))
+            self.assertEqual(path, find_snapshot(snapshot_dir, sa.key))
+
+            loaded = StaticAssets.from_snapshot(path)
+            self.assertEqual(sa.key, loaded.key)
+            self.assertEqual(sa.timezone, loaded.timezone)
+
+            self.assertIsNone(sa.snapshot_path)
+            self.assertEqual(path, loaded.snapshot_path)
+
+            for table in ['agencies', 'routes', 'calendar', 'calendar_exceptions',
+                          'stops', 'stop_times', 'trips', 'trip_metadata']:
+                pd.testing.assert_frame_equal(getattr(sa, table), getattr(loaded, table))
+
+            # the trip metadata is mapped from the snapshot, not rebuilt
+            base = loaded.trip_metadata.service_row.to_numpy()
+            while base is not None and not isinstance(base, np.memmap):
+                base = base.base
+            self.assertIsInstance(base, np.memmap)
+
+            start = datetime.datetime.combine(datetime.date.today(), datetime.time(8))
+            end = start + datetime.timedelta(hours=2)
+            pd.testing.assert_frame_equal(sa.scheduled_departures(271, start, end),
+                                          loaded.scheduled_departures(271, start, end))
+
+    def test_line_ranges(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'stop_times.txt')
+            with open(path, 'wb') as f:
+                f.write(b'a,b\n' + b''.join(b'%d,x\n' % n for n in range(1000)))
+
+            with mock.patch.object(parallel_loader, 'MIN_CHUNK_SIZE', 100):
+                ranges = parallel_loader.line_ranges(path, 4)
+
+            self.assertEqual(4, len(ranges))
+            with open(path, 'rb') as f:
+                content = f.read()
+
+            self.assertEqual(b'a,b\n', ranges[0][0])
+            self.assertEqual(content[4:], b''.join(content[start:end] for _, start, end in ranges))
+            for _, start, _ in ranges:
+                self.assertEqual(ord('\n'), content[start - 1])
+
+    def test_parallel_load(self):
+        serial = StaticAssets(STATIC_ASSETS, workers=1)
+        with mock.patch.object(parallel_loader, 'MIN_CHUNK_SIZE', 1024 * 1024):
+            parallel = StaticAssets(STATIC_ASSETS, workers=2)
+
+        # the categories can be in a different order, the values are the same
+        for table in ['agencies', 'routes', 'calendar', 'calendar_exceptions',
+                      'stops', 'stop_times', 'trips']:
+            pd.testing.assert_frame_equal(getattr(serial, table), getattr(parallel, table),
+                                          check_categorical=False)
+
+        start = datetime.datetime.combine(datetime.date.today(), datetime.time(8))
+        end = start + datetime.timedelta(hours=2)
+        pd.testing.assert_frame_equal(serial.scheduled_departures(271, start, end),
+                                      parallel.scheduled_departures(271, start, end))
+
+    def test_filter_stops(self):
+        sa = StaticAssets(STATIC_ASSETS, filter_stops=[271])
+
+        self.assertEqual([271], sa.filter_stops)
+        self.assertEqual([271], list(sa.stops.index))
+        self.assertTrue(sa.stop_times.stop_id.eq(sa.stop_number_to_id(271)).all())
+        self.assertTrue(sa.trips.trip_id.isin(sa.stop_times.trip_id).all())
+        self.assertTrue(sa.routes.index.isin(sa.trips.route_id).all())
+        self.assertTrue(sa.calendar.index.isin(sa.trips.service_id).all())
+
+        full = StaticAssets(STATIC_ASSETS)
+        self.assertNotEqual(full.key, sa.key)
+
+        start = datetime.datetime.combine(datetime.date.today(), datetime.time(8))
+        end = start + datetime.timedelta(hours=2)
+        pd.testing.assert_frame_equal(full.scheduled_departures(271, start, end),
+                                      sa.scheduled_departures(271, start, end))
+
+    def test_trip_metadata(self):
+        sa = StaticAssets(STATIC_ASSETS)
+        meta = sa.trip_metadata
+        self.assertEqual(len(sa.stop_times.trip_id.cat.categories), len(meta))
+
+        trip = sa.trips.iloc[10]
+        row = meta[meta.trip_id.eq(trip.trip_id)].iloc[0]
+        route = sa.routes.loc[trip.route_id]
+
+        self.assertEqual(route.route_short_name, row.route)
+        self.assertEqual(trip.trip_headsign, row.headsign)
+        self.assertEqual(sa.agencies.loc[route.agency_id].agency_name, row.agency)
+        self.assertEqual(trip.service_id, sa.service_calendar.service_ids[row.service_row])
+
+    def test_validate(self):
+        sa = StaticAssets(STATIC_ASSETS)
+        sa.validate()
+
+        sa._trips = sa.trips.iloc[:0]
+        with self.assertRaises(ValueError):
+            sa.validate()
+
+    def test_close(self):
+        sa = StaticAssets(STATIC_ASSETS)
+        sa.close()
+
+        sa._cal_refresh.join(timeout=5)
+        self.assertFalse(sa._cal_refresh.is_alive())
+        self.assertIsNone(sa.stop_times)
+
+    def test_failed_load_is_closed(self):
+        """Assets that fail to load or validate stop their calendar thread."""
+
+        close = mock.patch.object(StaticAssets, 'close', autospec=True,
+                                  side_effect=StaticAssets.close)
+        failures = [mock.patch.object(StaticAssets, 'validate', side_effect=ValueError),
+                    mock.patch.object(StaticAssets, '_load_complete', side_effect=ValueError)]
+
+        for failure in failures:
+            with close as closed, failure, self.assertRaises(ValueError):
+                load_static_assets(STATIC_ASSETS)
+
+            sa = closed.call_args.args[0]
+            sa._cal_refresh.join(timeout=5)
+            self.assertFalse(sa._cal_refresh.is_alive())
+
+    def test_load_static_assets_uses_snapshot(self):
+        with open(STATIC_ASSETS, 'rb') as f:
+            zip_bytes = f.read()
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            self.assertIsNone(find_snapshot(snapshot_dir, snapshot_key(zip_bytes)))
+
+            sa = load_static_assets(zip_bytes, snapshot_dir)
+            self.assertIsNotNone(find_snapshot(snapshot_dir, sa.key))
+
+            loaded = load_static_assets(zip_bytes, snapshot_dir)
+            pd.testing.assert_frame_equal(sa.stop_times, loaded.stop_times)
+
+    def test_load_from_mmap(self):
+        sa = StaticAssets.from_file(STATIC_ASSETS)
+
+        with open(STATIC_ASSETS, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            from_mmap = StaticAssets(mm)
+
+        self.assertEqual(sa.key, from_mmap.key)
+        pd.testing.assert_frame_equal(sa.stop_times, from_mmap.stop_times)
+
@@ -2,7 +2,10 @@
 # and local backends are functionally equivalent.
 
 import io
+import json
+import asyncio
 import time
+import datetime
 import unittest
 import threading
 
@@ -11,16 +14,29 @@ import tempfile
 import webbrowser
 import pandas as pd
 
+from unittest import mock
+
 from tfi_gtfs import web_server
+from tfi_gtfs.web_server import asgi
+from tfi_gtfs.gtfs import CachedGTFS
+from tfi_gtfs.web_routes import register_routes
+
+from test_static_asset_parser import STATIC_ASSETS
+from test_realtime_data_parser import REALTIME_DATA
+
+
+app = web_server.build_flask_app()
 
+# the homepage doesn't need any GTFS data to be served.
+register_routes(app, gtfs=None)
 
 # makes flask dump exceptions to stdout.
-web_server.app.debug = True
+app.debug = True
 
 
 @pytest.fixture
 def client():
-    with web_server.app.test_client() as client:
+    with app.test_client() as client:
         yield client
 
 
@@ -31,14 +47,14 @@ def test_homepage(client):
     assert b"<title>GTFS API</title>" in response.data
 
 
-@web_server.app.route('/test')
+@app.route('/test')
 @web_server.format_response
 def dummy_request():
     """A flask callback for testing that always return the same data. """
 
     return {
         "271":{
-            "arrivals":[
+            "departures":[
                 {"agency":"Bus \u00c1tha Cliath \u2013 Dublin Bus","headsign":"Drimnagh Road",
                  "real_time_arrival": None,"route":"122","scheduled_arrival":"2025-06-15T10:00:08"},
                 {"agency":"Bus \u00c1tha Cliath \u2013 Dublin Bus","headsign":"Enniskerry",
@@ -85,6 +101,350 @@ def test_text_plain(client):
     _test_accept_header_is_csv(client, 'text/plain')
 
 
+def test_tables_are_streamed():
+    with app.test_request_context():
+        for mime_type in ['text/csv', 'text/html']:
+            assert web_server.format._format(dummy_request.__wrapped__(), mime_type).is_streamed
+
+        assert not web_server.format._format(dummy_request.__wrapped__(), 'application/json').is_streamed
+
+
+def test_csv_chunks():
+    rows = [{'a': n, 'b': 'x'} for n in range(250)]
+    chunks = list(web_server.format.csv_chunks(rows, ['a', 'b']))
+
+    assert len(chunks) == 3
+    assert ''.join(chunks) == web_server.format.csv_table(rows, ['a', 'b'])
+
+
+def test_serializers_match():
+    from tfi_gtfs.web_server import serializer
+
+    stop = {'stop_name': 'Stop', 'departures': [
+        {'route': '1', 'scheduled_arrival': datetime.datetime(2025, 6, 15, 10, 26, 15),
+         'real_time_arrival': None}]}
+    data = {1358: stop, 271: stop, 5: stop}
+
+    fast = serializer.dumps(data)
+    with mock.patch.object(serializer, 'orjson', None):
+        fallback = serializer.dumps(data)
+
+    # the stop numbers are in numerical order either way
+    assert fast == fallback
+    assert list(json.loads(fast)) == ['5', '271', '1358']
+    assert json.loads(fallback)['271']['departures'][0]['scheduled_arrival'] == '2025-06-15T10:26:15'
+
+
+def test_response_cache_lru():
+    cache = web_server.ResponseCache(max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234'
+
+    # 'b' is the least recently used, so it's evicted to make space
+    cache.put('c', b'1234')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.size == 8
+
+    # too big to ever be cached
+    cache.put('d', b'12345678901')
+    assert cache.get('d') is None
+
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_departures_are_cached():
+    gtfs = CachedGTFS(static_assets_path=STATIC_ASSETS, realtime_data_path=REALTIME_DATA)
+    departures_app = web_server.build_flask_app()
+    register_routes(departures_app, gtfs)
+
+    # the cache key includes the minute, so the time is fixed
+    with departures_app.test_client() as client, \
+            mock.patch('tfi_gtfs.web_routes.datetime') as dt, \
+            mock.patch.object(gtfs, 'get_departures_for_stops',
+                              wraps=gtfs.get_departures_for_stops) as get_departures:
+        dt.now.return_value = datetime.datetime.now().replace(hour=10, minute=0)
+
+        first = client.get('/api/v2/departures?stop=271&stop=5')
+        second = client.get('/api/v2/departures?stop=5&stop=271')
+        assert first.data == second.data
+        assert get_departures.call_count == 1
+
+        # a different format is cached separately, including streamed formats
+        # which are only cached once the whole body has been read
+        csv_first = client.get('/api/v2/departures?stop=271&stop=5', headers={'Accept': 'text/csv'}).data
+        csv_second = client.get('/api/v2/departures?stop=271&stop=5', headers={'Accept': 'text/csv'}).data
+        assert csv_first == csv_second
+        assert get_departures.call_count == 2
+
+        # new realtime data empties the cache
+        with open(REALTIME_DATA, 'rb') as f:
+            gtfs.new_realtime_data(f.read())
+        client.get('/api/v2/departures?stop=271&stop=5')
+        assert get_departures.call_count == 3
+
+
+@app.route('/slow')
+def slow_request():
+    time.sleep(0.3)
+    return 'done'
+
+
+def asgi_request(asgi_app, path, accept=None):
+    """Make a GET request to an ASGI app, returning the status, headers and body."""
+
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+             'http_version': '1.1', 'headers': [(b'accept', accept.encode())] if accept else []}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def request():
+        await asgi_app(scope, receive, send)
+
+    asyncio.run(request())
+    start, body = messages
+    return start['status'], dict(start['headers']), body['body']
+
+
+def test_asgi_matches_wsgi(client):
+    asgi_app = web_server.AsgiApp(app, threads=2)
+
+    status, _, body = asgi_request(asgi_app, '/')
+    assert status == 200 and body == client.get('/').data
+
+    for mime_type in ['application/json', 'application/yaml', 'text/csv', 'text/html']:
+        status, headers, body = asgi_request(asgi_app, '/test', mime_type)
+        assert status == 200
+        assert headers[b'content-type'].startswith(mime_type.encode())
+        assert body == client.get('/test', headers={'Accept': mime_type}).data
+
+    status, _, _ = asgi_request(asgi_app, '/not-a-page')
+    assert status == 404
+
+
+def test_asgi_does_not_block_the_event_loop():
+    asgi_app = web_server.AsgiApp(app, threads=2)
+    scope = {'type': 'http', 'method': 'GET', 'path': '/slow', 'query_string': b'', 'headers': []}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    async def requests():
+        # the loop keeps ticking while the slow requests run in the pool
+        ticks = 0
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        start = time.perf_counter()
+        await asyncio.gather(asgi_app(scope, receive, send), asgi_app(scope, receive, send))
+        duration = time.perf_counter() - start
+        ticker.cancel()
+        return duration, ticks
+
+    duration, ticks = asyncio.run(requests())
+    assert duration < 0.55
+    assert ticks > 10
+
+
+def test_wsgi_environ():
+    environ = web_server.asgi.wsgi_environ({
+        'type': 'http', 'method': 'GET', 'path': '/api/v2/departures',
+        'query_string': b'stop=1&stop=2', 'server': ('localhost', 7341),
+        'headers': [(b'accept', b'text/csv'), (b'content-type', b'text/plain'),
+                    (b'x-test', b'a'), (b'x-test', b'b')]}, b'')
+
+    assert environ['PATH_INFO'] == '/api/v2/departures'
+    assert environ['QUERY_STRING'] == 'stop=1&stop=2'
+    assert environ['SERVER_PORT'] == '7341'
+    assert environ['HTTP_ACCEPT'] == 'text/csv'
+    assert environ['CONTENT_TYPE'] == 'text/plain'
+    assert environ['HTTP_X_TEST'] == 'a,b'
+
+
+def test_update_notifier():
+    generation = [0]
+    notifier = web_server.UpdateNotifier(lambda: generation[0], interval=10)
+
+    assert not notifier.wait(0, timeout=0.1)
+
+    # a notify() is noticed straight away, not after the interval
+    def update():
+        time.sleep(0.1)
+        generation[0] += 1
+        notifier.notify()
+
+    threading.Thread(target=update).start()
+    start = time.perf_counter()
+    assert notifier.wait(0, timeout=5)
+    assert time.perf_counter() - start < 1
+
+    threading.Thread(target=update).start()
+    assert asyncio.run(notifier.wait_async(1, timeout=5))
+    assert not asyncio.run(notifier.wait_async(2, timeout=0.1))
+
+
+def polling_app(threads=None):
+    gtfs = CachedGTFS(static_assets_path=STATIC_ASSETS, realtime_data_path=REALTIME_DATA)
+    poll_app = web_server.build_flask_app()
+    register_routes(poll_app, gtfs, threads)
+
+    with open(REALTIME_DATA, 'rb') as f:
+        realtime_data = f.read()
+
+    return gtfs, poll_app, realtime_data
+
+
+def later_update(gtfs, dt, realtime_data):
+    """New data arriving after a short time, with the time moved on so the
+    departures change."""
+
+    def update():
+        time.sleep(0.3)
+        dt.now.return_value += datetime.timedelta(minutes=20)
+        gtfs.new_realtime_data(realtime_data)
+
+    threading.Thread(target=update).start()
+
+
+def test_long_poll():
+    gtfs, poll_app, realtime_data = polling_app()
+
+    with poll_app.test_client() as client, \
+            mock.patch('tfi_gtfs.web_routes.datetime') as dt:
+        dt.now.return_value = datetime.datetime.now().replace(hour=10, minute=0)
+
+        first = client.get('/api/v2/departures/poll?stop=271')
+        token = first.headers['X-Departures-Token']
+        assert first.status_code == 200
+        assert first.data == client.get('/api/v2/departures?stop=271').data
+
+        # nothing has changed, so the poll times out
+        unchanged = client.get(f'/api/v2/departures/poll?stop=271&token={token}&timeout=0.2')
+        assert unchanged.status_code == 304
+        assert unchanged.headers['X-Departures-Token'] == token
+
+        # new data that doesn't change the departures doesn't answer the poll
+        gtfs.new_realtime_data(realtime_data)
+        unchanged = client.get(f'/api/v2/departures/poll?stop=271&token={token}&timeout=0.2')
+        assert unchanged.status_code == 304
+
+        later_update(gtfs, dt, realtime_data)
+        start = time.perf_counter()
+        changed = client.get(f'/api/v2/departures/poll?stop=271&token={token}&timeout=10')
+        assert time.perf_counter() - start < 2
+        assert changed.status_code == 200
+        assert changed.headers['X-Departures-Token'] != token
+
+
+def test_long_poll_timeout_not_a_number():
+    _, poll_app, _ = polling_app()
+
+    with poll_app.test_client() as client, \
+            mock.patch('tfi_gtfs.web_routes.datetime') as dt, \
+            mock.patch('tfi_gtfs.web_routes.POLL_TIMEOUT', 0.2):
+        dt.now.return_value = datetime.datetime.now().replace(hour=10, minute=0)
+        token = client.get('/api/v2/departures/poll?stop=271').headers['X-Departures-Token']
+
+        # these wait for the default timeout, rather than forever
+        for timeout in ['nan', 'inf', '-inf', 'soon']:
+            start = time.perf_counter()
+            response = client.get(f'/api/v2/departures/poll?stop=271&token={token}&timeout={timeout}')
+            assert response.status_code == 304
+            assert time.perf_counter() - start < 2
+
+    assert asgi._wait_time('1.5') == 1.5
+    for wait in [None, 'nan', 'inf', 'soon']:
+        assert asgi._wait_time(wait) is None
+
+
+def test_long_poll_single_thread():
+    # a single threaded server can still wait on one long-poll
+    _, poll_app, _ = polling_app(threads=1)
+
+    with mock.patch('tfi_gtfs.web_routes.datetime') as dt:
+        dt.now.return_value = datetime.datetime.now().replace(hour=10, minute=0)
+        with poll_app.test_client() as client:
+            token = client.get('/api/v2/departures/poll?stop=271').headers['X-Departures-Token']
+            assert client.get(f'/api/v2/departures/poll?stop=271&token={token}&timeout=0.2') \
+                         .status_code == 304
+
+
+def test_long_poll_thread_limit():
+    # with 2 threads, only one can wait on a long-poll
+    _, poll_app, _ = polling_app(threads=2)
+
+    with mock.patch('tfi_gtfs.web_routes.datetime') as dt:
+        dt.now.return_value = datetime.datetime.now().replace(hour=10, minute=0)
+        with poll_app.test_client() as client:
+            token = client.get('/api/v2/departures/poll?stop=271').headers['X-Departures-Token']
+
+        poll = f'/api/v2/departures/poll?stop=271&token={token}&timeout=0.5'
+        waiting = []
+        thread = threading.Thread(target=lambda: waiting.append(poll_app.test_client().get(poll)))
+        thread.start()
+        time.sleep(0.2)
+
+        with poll_app.test_client() as client:
+            refused = client.get(poll)
+            assert refused.status_code == 503
+            assert refused.headers['Retry-After'] == '5'
+
+            # changed departures are still returned straight away
+            assert client.get('/api/v2/departures/poll?stop=271&token=old').status_code == 200
+
+            thread.join()
+            assert waiting[0].status_code == 304
+            assert client.get(poll).status_code == 304
+
+
+def test_long_poll_async():
+    gtfs, poll_app, realtime_data = polling_app()
+    asgi_app = web_server.AsgiApp(poll_app, threads=1)
+
+    with mock.patch('tfi_gtfs.web_routes.datetime') as dt:
+        dt.now.return_value = datetime.datetime.now().replace(hour=10, minute=0)
+
+        status, headers, _ = asgi_request(asgi_app, '/api/v2/departures/poll?stop=271')
+        token = headers[b'x-departures-token'].decode()
+        assert status == 200
+
+        status, headers, _ = asgi_request(asgi_app, f'/api/v2/departures/poll?stop=271&token={token}&timeout=0.2')
+        assert status == 304
+        assert b'x-wait-timeout' not in headers
+
+        # a waiting poll doesn't hold the only thread of the pool
+        async def requests():
+            poll = asyncio.create_task(asyncio.to_thread(
+                asgi_request, asgi_app, f'/api/v2/departures/poll?stop=271&token={token}&timeout=10'))
+            await asyncio.sleep(0.1)
+
+            start = time.perf_counter()
+            await asyncio.to_thread(asgi_request, asgi_app, '/api/v2/departures?stop=5')
+            assert time.perf_counter() - start < 1
+
+            later_update(gtfs, dt, realtime_data)
+            return await poll
+
+        status, headers, _ = asyncio.run(requests())
+        assert status == 200
+        assert headers[b'x-departures-token'].decode() != token
+
+
 @unittest.skip("debug only")
 def test_webpage_in_browser(client):
     with tempfile.NamedTemporaryFile('w', delete=False, delete_on_close=False,
@@ -98,7 +458,7 @@ def test_webpage_in_browser(client):
 def test_webpage_by_serving(client):
     """Start the server and open the test page with dummy data."""
     t = threading.Thread(target=web_server.serve_forever,
-                         kwargs={'host': 'localhost', 'port': 10101},
+                         kwargs={'app': app, 'host': 'localhost', 'port': 10101},
                          daemon=True)
     t.start()
 
@@ -109,3 +469,13 @@ def test_webpage_by_serving(client):
         time.sleep(1)
 
 
+
+
+def test_server_options():
+    with mock.patch('waitress.serve') as serve:
+        web_server.serve_forever(app, 'localhost', 10101,
+                                 web_server.ServerOptions(threads=8, channel_timeout=30))
+
+    assert serve.call_args.kwargs == {'host': 'localhost', 'port': 10101, 'threads': 8,
+                                      'connection_limit': 100, 'backlog': 1024,
+                                      'channel_timeout': 30}